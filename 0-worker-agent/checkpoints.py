@@ -0,0 +1,125 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Job checkpoints (#HYPER -k), synced to the main region worker bucket while the job runs and restored when it runs again
+
+import time
+from datetime import datetime
+import threading
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from worker_settings import *
+from log_shipping import shipper
+from input_cache import delete_file, stage_files, transfer_file
+
+
+def checkpoint_directive(cmd):
+    """Checkpoint directory declared with #HYPER -k [dir], None when the job does not checkpoint"""
+    for line in cmd.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == '#HYPER' and parts[1] == '-k':
+            return parts[2] if len(parts) > 2 else ''
+    return None
+
+
+class job_checkpoint:
+    """Checkpoint directory of a job, synced to the main region worker bucket while the job runs so a retry after a spot
+    interruption or worker failure starts from it. Only files added or changed since the last sync are uploaded and files the
+    job removed are deleted. Jobs should write a checkpoint to a temporary name and rename it so a sync never sees half a file"""
+    def __init__(self, path, JobName, JobQueue):
+        # without a directory each job gets its own, slots of a worker share the working directory
+        self.owned = path == ''
+        self.path = os.path.abspath(path if not self.owned else os.path.join('cyclone-checkpoints', JobName))
+        self.JobName = JobName
+        self.JobQueue = JobQueue
+        self.remote = 's3://' + stack_name + '-worker-' + main_region + '/checkpoints/' + JobQueue + '/' + JobName + '/'
+        self.synced = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def scan(self):
+        files = {}
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[os.path.relpath(path, self.path).replace(os.sep, '/')] = (st.st_size, st.st_mtime_ns)
+        return files
+
+    def restore(self):
+        """Download the checkpoint of an earlier attempt of the job, if there is one"""
+        os.makedirs(self.path, exist_ok=True)
+        pairs = stage_files(self.remote, self.path, 'in', s3_main)
+        for _, local in pairs:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, STAGE_CONCURRENCY)) as pool:
+            list(pool.map(lambda pair: transfer_file(pair[0], pair[1], 'in', s3_main), pairs))
+        self.synced = self.scan()
+        if len(pairs) > 0:
+            cyc_root_log.info('## RESTORED CHECKPOINT WITH ' + str(len(pairs)) + ' FILES' + ' -- ' + datetime.now().isoformat())
+
+    def sync(self):
+        with self.lock:
+            started = time.perf_counter()
+            files = self.scan()
+            changed = [name for name, state in files.items() if not self.synced.get(name) == state]
+            removed = [name for name in self.synced if not name in files]
+            with ThreadPoolExecutor(max_workers=max(1, STAGE_CONCURRENCY)) as pool:
+                list(pool.map(lambda name: transfer_file(self.remote + name, os.path.join(self.path, name), 'out', s3_main), changed))
+                list(pool.map(lambda name: delete_file(self.remote + name, s3_main), removed))
+            # a file changed while it was uploaded is newer than its scanned state and goes again next time
+            self.synced = files
+            if len(changed) + len(removed) == 0 or not (not ENABLE_QLOG == 'False' or ENABLE_QLOG == False):
+                return
+            data = {'checkpoint_files': len(changed), 'checkpoint_bytes': sum(files[name][0] for name in changed), 'checkpoint_removed': len(removed), 'checkpoint_seconds': time.perf_counter() - started}
+            shipper.submit([{'time_stamp': datetime.now().isoformat(), 'log_type': 'METRICS', 'id': self.JobName, 'jobDefinition': jobDefinition, 'jobQueue': self.JobQueue, 'data': data}], jobDefinition)
+
+    def run(self):
+        while not self.stopped.wait(CHECKPOINT_SECONDS):
+            try:
+                self.sync()
+            except Exception as e:
+                cyc_root_log.error('## CHECKPOINT SYNC FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self, sync):
+        """Stop the periodic sync, a job that will run again gets a last sync so its retry starts from the latest checkpoint"""
+        self.stopped.set()
+        if not self.thread == None:
+            self.thread.join()
+        if sync:
+            try:
+                self.sync()
+            except Exception as e:
+                cyc_root_log.error('## FINAL CHECKPOINT SYNC FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        if self.owned:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def discard(self):
+        """The job finished, its checkpoint is not needed anymore"""
+        with self.lock:
+            for name in list(self.synced):
+                try:
+                    delete_file(self.remote + name, s3_main)
+                except Exception as e:
+                    cyc_root_log.error('## COULD NOT DELETE CHECKPOINT FILE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            self.synced = {}
@@ -0,0 +1,199 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Direct mode: jobs taken straight from the definition queue, the worker writes their status to the queue table
+
+import time
+from datetime import datetime
+import json
+from worker_settings import *
+from log_shipping import log_push
+from job_monitor import heartbeat, heartbeats, interrupted, startup
+from job_runner import do_work, linger
+
+
+def set_job_status(JobQueue, JobName, Status, Output, RetriesAvailable):
+    """Direct mode: write a job status to its queue table the way the async stream lambda does for state machine jobs"""
+    names = {'#attr1': 'Status', '#attr2': 'Output'}
+    values = {':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': datetime.now().isoformat()}}
+    expression = "set #attr1 = :p, #attr2 = :r, #attr3 = :t"
+    if Status == 'Failed' or Status == 'JobFailed':
+        # a job that failed on its own is not retried, a worker failure uses one retry
+        NewRetries = 0 if Status == 'JobFailed' else max(0, RetriesAvailable - 1)
+        names['#attr3'] = 'tRetry' if Status == 'JobFailed' or RetriesAvailable > 0 else 'tFailed'
+        names['#attr4'] = 'RetriesAvailable'
+        values[':p'] = {'S': 'Failed'}
+        values[':q'] = {'N': str(NewRetries)}
+        expression = expression + ", #attr4 = :q"
+    else:
+        names['#attr3'] = 't' + str(Status)
+    names['#attr0'] = 'id'
+    try:
+        dynamo_main.update_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            UpdateExpression=expression,
+            ConditionExpression="attribute_exists(#attr0)",
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW"
+            )
+    except dynamo_main.exceptions.ConditionalCheckFailedException:
+        # deleted with qdel, writing the status would bring back part of the item
+        cyc_root_log.info('## JOB ' + JobName + ' IS NO LONGER IN ITS QUEUE TABLE, NOT UPDATING IT' + ' -- ' + datetime.now().isoformat())
+
+
+def claim_direct_job(JobQueue, JobName, LastStatus):
+    """Direct mode: mark a job Running with a claim that expires after LEASE_SECONDS unless renewed, fails if another worker changed it since it was read"""
+    try:
+        dynamo_main.update_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            UpdateExpression="set #attr1 = :p, #attr2 = :t, #attr3 = :n, #attr4 = :l",
+            ConditionExpression="#attr1 = :s",
+            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'tRunning', '#attr3': 'Output', '#attr4': 'LeaseExpires'},
+            ExpressionAttributeValues={':p': {'S': 'Running'}, ':t': {'S': datetime.now().isoformat()}, ':n': {'S': 'null'}, ':s': {'S': LastStatus}, ':l': {'N': str(int(time.time()) + LEASE_SECONDS)}},
+            ReturnValues="UPDATED_NEW"
+            )
+        return True
+    except dynamo_main.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def run_direct_job(message, queue_url):
+    """Direct mode: run one job received from the definition queue, the message is deleted once the result is in the queue table"""
+    try:
+        job = json.loads(message['Body'])
+        JobName = job['id']
+        JobQueue = job['jobQueue']
+        command = job['commands']
+        walltime = job.get('walltime', 'null')
+    except Exception as e:
+        cyc_root_log.error('## COULD NOT PARSE JOB MESSAGE, DELETING IT: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        sqs_main.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        return
+
+    try:
+        res = dynamo_main.get_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            ConsistentRead=True,
+            AttributesToGet=['Status', 'RetriesAvailable', 'LeaseExpires'])
+        if not 'Item' in res:
+            # deleted with qdel before it ran
+            sqs_main.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+            return
+        RetriesAvailable = int(res['Item']['RetriesAvailable']['N'])
+        LastStatus = res['Item']['Status']['S']
+        LeaseExpires = int(res['Item']['LeaseExpires']['N']) if 'LeaseExpires' in res['Item'] else None
+    except Exception as e:
+        # left for the visibility timeout to hand it out again
+        cyc_root_log.error('## COULD NOT READ JOB FROM QUEUE TABLE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        return
+
+    if LastStatus == 'Running':
+        received = int(message.get('Attributes', {}).get('ApproximateReceiveCount', '1'))
+        if (LeaseExpires == None and received < 2) or (not LeaseExpires == None and LeaseExpires > time.time()):
+            # duplicate delivery of a job another worker still runs, look again once its claim would have run out
+            remaining = LEASE_SECONDS if LeaseExpires == None else int(LeaseExpires - time.time()) + 1
+            try:
+                sqs_main.change_message_visibility(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=max(1, min(remaining, 43200)))
+            except Exception as e:
+                cyc_root_log.error('## COULD NOT RETURN DUPLICATE JOB MESSAGE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            return
+        # the worker running it died without writing a status, the redelivery uses one retry and the dynamo stream queues it again if any are left
+        cyc_root_log.info('## JOB ' + JobName + ' LOST ITS WORKER, RECEIVED ' + str(received) + ' TIMES' + ' -- ' + datetime.now().isoformat())
+        try:
+            set_job_status(JobQueue, JobName, 'Failed', 'worker lost while running the job', RetriesAvailable)
+            sqs_main.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT FAIL JOB THAT LOST ITS WORKER: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        return
+
+    # SQS delivers at least once, only waiting jobs and those the dynamo stream queued again are run, anything else is taken off the queue
+    if not (LastStatus == 'Waiting' or LastStatus == 'Interrupted' or (LastStatus == 'Failed' and RetriesAvailable > 0)):
+        sqs_main.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        return
+
+    cyc_root_log.info('## RUNNING JOB: ' + datetime.now().isoformat())
+    try:
+        if not claim_direct_job(JobQueue, JobName, LastStatus):
+            # another delivery of the same message got there first
+            return
+    except Exception as e:
+        cyc_root_log.error('## COULD NOT UPDATE QUEUE TABLE WITH RUNNING STATUS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    beat = heartbeat(None, JobName, JobQueue)
+    beat.lease = {'QueueUrl': queue_url, 'ReceiptHandle': message['ReceiptHandle']}
+    beat.job_running = True
+    beat.claim = 'direct'
+    heartbeats.register(beat)
+
+    startup.first_job(JobName, JobQueue)
+
+    result, status = do_work(command, log_push, stack_name, JobName, jobDefinition, JobQueue, beat, walltime)
+
+    if not beat.sampler == None:
+        heartbeats.send_metrics([beat], final=True)
+    heartbeats.unregister(beat)
+
+    try:
+        set_job_status(JobQueue, JobName, status, result, RetriesAvailable)
+    except Exception as e:
+        # the message comes back once the lease runs out and the job runs again
+        cyc_root_log.error('## COULD NOT UPDATE QUEUE TABLE WITH JOB STATUS AND RESULTS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        return
+
+    # retries and interrupted jobs are queued again by the dynamo stream from the status just written
+    try:
+        sqs_main.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+    except Exception as e:
+        cyc_root_log.error('## COULD NOT DELETE FINISHED JOB FROM QUEUE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+def run_direct_slot(slot_index, queue_url):
+    """Direct mode: long-polls the definition queue and runs jobs until nothing arrives for IDLE_TIMEOUT seconds plus the linger time"""
+    key = worker_id + '.' + str(slot_index)
+    idle_since = time.perf_counter()
+    linger_seconds = LINGER_MIN
+    while not interrupted.is_set():
+        try:
+            response = sqs_main.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=1,
+                AttributeNames=['ApproximateReceiveCount'],
+                VisibilityTimeout=LEASE_SECONDS,
+                WaitTimeSeconds=max(1, min(20, IDLE_TIMEOUT))
+            )
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO RECEIVE FROM DEFINITION QUEUE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            time.sleep(1)
+            continue
+
+        messages = response.get('Messages', [])
+        if len(messages) == 0:
+            if time.perf_counter() - idle_since >= IDLE_TIMEOUT + linger_seconds:
+                cyc_root_log.info('## No new Job in definition queue within ' + str(IDLE_TIMEOUT + linger_seconds) + ' seconds, closing slot ' + str(slot_index))
+                break
+            continue
+
+        linger.release(key)
+        linger.arrived()
+        try:
+            run_direct_job(messages[0], queue_url)
+        except Exception as e:
+            cyc_root_log.error('## DIRECT JOB FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        linger_seconds = linger.hold(key)
+        idle_since = time.perf_counter()
+    linger.release(key)
@@ -0,0 +1,303 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# File staging for #HYPER -i/-o directives and the input cache shared by the worker containers of an instance
+
+import time
+from datetime import datetime
+import json
+import threading
+import os
+import shutil
+import fcntl
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from worker_settings import *
+from log_shipping import shipper
+
+
+def staging_directives(cmd):
+    """Inputs and outputs declared in the job script as #HYPER -i <remote> [local] and #HYPER -o <remote> [local], local defaults to the remote file name"""
+    inputs = []
+    outputs = []
+    for line in cmd.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or not parts[0] == '#HYPER' or not parts[1] in ['-i', '-o']:
+            continue
+        remote = parts[2]
+        local = parts[3] if len(parts) > 3 else os.path.basename(remote.rstrip('/'))
+        if parts[1] == '-i':
+            inputs.append((remote, local))
+        else:
+            outputs.append((remote, local))
+    return inputs, outputs
+
+
+def stage_path(remote):
+    """Local path of a file:// url or of an s3:// url under the local stand-in, None when the url is in S3"""
+    if remote.startswith('file://'):
+        return remote[len('file://'):]
+    if not STAGE_LOCAL_ROOT == None:
+        return os.path.join(STAGE_LOCAL_ROOT, remote.replace('s3://', '', 1))
+    return None
+
+
+def stage_files(remote, local, direction, client=None):
+    """Expand a directive into (remote, local) file pairs, a remote ending in / is a prefix and local is then a directory"""
+    if direction == 'out':
+        if not os.path.isdir(local):
+            return [(remote, local)]
+        prefix = remote if remote.endswith('/') else remote + '/'
+        pairs = []
+        for root, _, files in os.walk(local):
+            for name in files:
+                path = os.path.join(root, name)
+                pairs.append((prefix + os.path.relpath(path, local).replace(os.sep, '/'), path))
+        return pairs
+
+    if not remote.endswith('/'):
+        return [(remote, local)]
+    pairs = []
+    path = stage_path(remote)
+    if not path == None:
+        for root, _, files in os.walk(path):
+            for name in files:
+                relative = os.path.relpath(os.path.join(root, name), path)
+                pairs.append((remote + relative.replace(os.sep, '/'), os.path.join(local, relative)))
+        return pairs
+    bucket, _, prefix = remote.replace('s3://', '', 1).partition('/')
+    for page in (client or s3).get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            relative = obj['Key'][len(prefix):]
+            pairs.append((remote + relative, os.path.join(local, relative)))
+    return pairs
+
+
+def transfer_file(remote, local, direction, client=None):
+    """Copy one file between S3 (or its local stand-in) and a local path, large files go in parallel multipart parts"""
+    path = stage_path(remote)
+    if not path == None:
+        if direction == 'in':
+            shutil.copyfile(path, local)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(local, path)
+        return
+    bucket, _, key = remote.replace('s3://', '', 1).partition('/')
+    if direction == 'in':
+        (client or s3).download_file(bucket, key, local, Config=transfer_config)
+    else:
+        (client or s3).upload_file(local, bucket, key, Config=transfer_config)
+
+
+def delete_file(remote, client=None):
+    path = stage_path(remote)
+    if not path == None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    bucket, _, key = remote.replace('s3://', '', 1).partition('/')
+    (client or s3).delete_object(Bucket=bucket, Key=key)
+
+
+def cache_address(remote):
+    """Cache key of a remote file, the ETag and size of the S3 object (path, size and mtime for the local stand-in)"""
+    path = stage_path(remote)
+    if not path == None:
+        st = os.stat(path)
+        version = path + ':' + str(st.st_size) + ':' + str(st.st_mtime_ns)
+    else:
+        bucket, _, key = remote.replace('s3://', '', 1).partition('/')
+        head = s3.head_object(Bucket=bucket, Key=key)
+        version = head['ETag'] + ':' + str(head['ContentLength'])
+    return hashlib.sha256(version.encode('utf-8')).hexdigest()
+
+
+class input_cache:
+    """Content-addressed cache of staged inputs on a host volume shared by the worker containers of an instance.
+
+    Entries are downloaded to a temporary file and renamed into place, so a reader never sees a partial file. A lock
+    file per entry makes concurrent fetches of the same object (from any container) wait for a single download, and the
+    least recently used entries are evicted with their lock files once the cache is over its size budget.
+    """
+    # temporary files older than this were left by a worker that died while filling an entry
+    STALE_TMP_SECONDS = 3600
+
+    def __init__(self, root, budget_bytes):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        for sub in ['objects', 'locks', 'tmp']:
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+
+    def entry(self, address):
+        return os.path.join(self.root, 'objects', address[:2], address)
+
+    def lock_path(self, address):
+        return os.path.join(self.root, 'locks', address + '.lock')
+
+    def lock(self, address):
+        """Open and lock the lock file of an entry, again if eviction removed the file while this waited for it"""
+        path = self.lock_path(address)
+        while True:
+            lock = open(path, 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def remove(self, address, entry):
+        """Remove an entry and its lock file, skipped while a fetch holds the lock. Returns whether it was removed"""
+        path = self.lock_path(address)
+        with open(path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                for name in [entry, path]:
+                    try:
+                        os.remove(name)
+                    except FileNotFoundError:
+                        pass
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fill(self, address, remote):
+        """Download an entry unless another fetch filled it while this one waited for the lock"""
+        entry = self.entry(address)
+        with self.lock(address) as lock:
+            try:
+                if os.path.exists(entry):
+                    return False
+                os.makedirs(os.path.dirname(entry), exist_ok=True)
+                tmp = os.path.join(self.root, 'tmp', address + '.' + worker_id + '.' + str(threading.get_ident()))
+                try:
+                    transfer_file(remote, tmp, 'in')
+                    os.rename(tmp, entry)
+                finally:
+                    if os.path.exists(tmp):
+                        os.remove(tmp)
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fetch(self, remote, local):
+        """Copy a remote file to local through the cache, returns True when this fetch did not download it (a cached entry or one filled by a concurrent fetch)"""
+        address = cache_address(remote)
+        entry = self.entry(address)
+        filled = False
+        for attempt in range(3):
+            try:
+                # an open entry can still be read if it is evicted while copying
+                with open(entry, 'rb') as source:
+                    os.utime(source.fileno())
+                    with open(local, 'wb') as target:
+                        shutil.copyfileobj(source, target, 1024 * 1024)
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                filled = self.fill(address, remote) or filled
+        if filled:
+            self.evict()
+        return not filled
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its budget, one container evicts at a time"""
+        with open(os.path.join(self.root, 'locks', 'evict.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                entries = []
+                for dirpath, _, files in os.walk(os.path.join(self.root, 'objects')):
+                    for name in files:
+                        path = os.path.join(dirpath, name)
+                        try:
+                            st = os.stat(path)
+                        except FileNotFoundError:
+                            continue
+                        entries.append((st.st_mtime, st.st_size, path))
+                total = sum(e[1] for e in entries)
+                for _, size, path in sorted(entries):
+                    if total <= self.budget_bytes:
+                        break
+                    if self.remove(os.path.basename(path), path):
+                        total -= size
+                # lock files of entries that were never filled, a failed download leaves one behind
+                for name in os.listdir(os.path.join(self.root, 'locks')):
+                    address = name[:-len('.lock')]
+                    if not name.endswith('.lock') or name == 'evict.lock' or os.path.exists(self.entry(address)):
+                        continue
+                    try:
+                        if time.time() - os.stat(os.path.join(self.root, 'locks', name)).st_mtime > self.STALE_TMP_SECONDS:
+                            self.remove(address, self.entry(address))
+                    except FileNotFoundError:
+                        pass
+                for name in os.listdir(os.path.join(self.root, 'tmp')):
+                    path = os.path.join(self.root, 'tmp', name)
+                    try:
+                        if time.time() - os.stat(path).st_mtime > self.STALE_TMP_SECONDS:
+                            os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+cache = None
+if not INPUT_CACHE_DIR == None:
+    try:
+        cache = input_cache(INPUT_CACHE_DIR, int(INPUT_CACHE_GB * 1000000000))
+    except Exception as e:
+        cyc_root_log.error('## INPUT CACHE DISABLED, COULD NOT USE ' + INPUT_CACHE_DIR + ': ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+def stage_file(remote, local, direction):
+    """Stage one file, inputs go through the instance input cache when there is one. Returns bytes moved and whether the cache had the file"""
+    target = local if direction == 'in' else stage_path(remote)
+    if not target == None and not os.path.dirname(target) == '':
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+    hit = False
+    if direction == 'in' and not cache == None:
+        hit = cache.fetch(remote, local)
+    else:
+        transfer_file(remote, local, direction)
+    return os.path.getsize(local), hit
+
+
+def stage(directives, direction, JobName, JobQueue):
+    """Transfer the files of all directives concurrently and send the bytes and duration as a METRICS record, raises on the first failed file"""
+    started = time.perf_counter()
+    pairs = []
+    for remote, local in directives:
+        pairs.extend(stage_files(remote, local, direction))
+    with ThreadPoolExecutor(max_workers=max(1, STAGE_CONCURRENCY)) as pool:
+        results = list(pool.map(lambda pair: stage_file(pair[0], pair[1], direction), pairs))
+    seconds = time.perf_counter() - started
+    data = {'stage_' + direction + '_files': len(pairs), 'stage_' + direction + '_bytes': sum(r[0] for r in results), 'stage_' + direction + '_seconds': seconds}
+    if direction == 'in' and not cache == None:
+        data['stage_in_cache_hits'] = sum(1 for r in results if r[1])
+    cyc_root_log.info('## STAGED FILES: ' + json.dumps(data) + ' -- ' + datetime.now().isoformat())
+    if not ENABLE_QLOG == 'False' or ENABLE_QLOG == False:
+        shipper.submit([{'time_stamp': datetime.now().isoformat(), 'log_type': 'METRICS', 'id': JobName, 'jobDefinition': jobDefinition, 'jobQueue': JobQueue, 'data': data}], jobDefinition)
@@ -0,0 +1,169 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Processes the worker runs next to its jobs, they start without the worker's imports: the warm runtime zygote
+# (job_helper.py --warm-runtime socket modules) and the client jobs use to submit children (python3 $CYCLONE_AGENT --submit)
+
+import os
+import sys
+import json
+import runpy
+import array
+import socket
+import signal
+import importlib
+import traceback
+
+
+def warm_runtime_server(socket_path, modules):
+    """Zygote of the warm Python runtime: imports the declared modules once, then forks every Python job sent over the unix socket from
+    the warm interpreter. Started by the worker as job_helper.py --warm-runtime"""
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print('## WARM RUNTIME FAILED TO IMPORT ' + name + ': ' + str(e), file=sys.stderr)
+    parent = os.getppid()
+    # runners are reaped by the kernel, the zygote never waits for them
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # bound to a temporary name and renamed, the worker takes the socket path as the sign that the modules are loaded
+    server.bind(socket_path + '.tmp')
+    server.listen(64)
+    os.rename(socket_path + '.tmp', socket_path)
+    server.settimeout(5)
+    while os.getppid() == parent:
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        fds = array.array('i')
+        data = b''
+        try:
+            # the output pipe comes with the first part of the request
+            msg, ancdata, _, _ = conn.recvmsg(65536, socket.CMSG_SPACE(fds.itemsize))
+            for level, kind, cmsg in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(cmsg[:len(cmsg) - (len(cmsg) % fds.itemsize)])
+            data = msg
+            while not data.endswith(b'\n'):
+                msg = conn.recv(65536)
+                if not msg:
+                    raise EOFError('request cut short')
+                data += msg
+            request = json.loads(data)
+        except Exception as e:
+            print('## WARM RUNTIME BAD REQUEST: ' + str(e), file=sys.stderr)
+            for fd in fds:
+                os.close(fd)
+            conn.close()
+            continue
+        if len(fds) == 0:
+            conn.close()
+            continue
+        # a runner per job keeps the zygote single threaded, it forks the job, reports its pid and waits for its exit code
+        if os.fork() == 0:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                os.setsid()
+                null = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(null, 0)
+                os.dup2(fds[0], 1)
+                os.dup2(fds[0], 2)
+                os.close(null)
+                os.close(fds[0])
+                code = 0
+                try:
+                    if len(request.get('cpus', [])) > 0:
+                        os.sched_setaffinity(0, request['cpus'])
+                    os.chdir(request['cwd'])
+                    os.environ.clear()
+                    os.environ.update(request['env'])
+                    sys.argv = request['argv']
+                    if not request.get('module') == None:
+                        sys.path[0] = os.getcwd()
+                        runpy.run_module(request['module'], run_name='__main__', alter_sys=True)
+                    else:
+                        sys.path[0] = os.path.dirname(os.path.abspath(request['script']))
+                        runpy.run_path(request['script'], run_name='__main__')
+                except SystemExit as e:
+                    if e.code == None:
+                        code = 0
+                    elif isinstance(e.code, int):
+                        code = e.code
+                    else:
+                        print(e.code, file=sys.stderr)
+                        code = 1
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                except Exception:
+                    pass
+                os._exit(code & 0xff)
+            os.close(fds[0])
+            try:
+                conn.sendall((json.dumps({'pid': pid}) + '\n').encode())
+            except Exception:
+                pass
+            _, status = os.waitpid(pid, 0)
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            try:
+                conn.sendall((json.dumps({'returncode': returncode}) + '\n').encode())
+            except Exception:
+                pass
+            os._exit(0)
+        os.close(fds[0])
+        conn.close()
+    os.unlink(socket_path)
+
+
+def submit_client(path):
+    """Submit child jobs from inside a running job: python3 $CYCLONE_AGENT --submit [file], one JSON job per line of the file or stdin.
+    A job is {"commands": "..."} plus any of jobName, jobQueue, jobDefinition, RetriesAvailable, walltime. The worker writes them to
+    the queue table under its own role with the running job as parent and prints the child ids"""
+    source = sys.stdin if path == None or path == '-' else open(path)
+    items = [json.loads(line) for line in source if len(line.strip()) > 0]
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(os.environ['CYCLONE_SUBMIT_SOCKET'])
+    conn.sendall((json.dumps({'parent': os.environ.get('CYCLONE_JOB_ID'), 'queue': os.environ.get('CYCLONE_JOB_QUEUE'), 'items': items}) + '\n').encode())
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    conn.close()
+    response = json.loads(data)
+    if 'error' in response:
+        print('FAILED - ' + response['error'], file=sys.stderr)
+        return 1
+    for child in response['ids']:
+        print(child)
+    return 0
+
+
+if __name__ == '__main__' and sys.argv[1:2] == ['--warm-runtime']:
+    warm_runtime_server(sys.argv[2], [name for name in sys.argv[3].split(',') if len(name) > 0])
+    sys.exit(0)
+if __name__ == '__main__' and sys.argv[1:2] == ['--submit']:
+    sys.exit(submit_client(sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1,436 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Watching the worker and its running jobs: process and cgroup samples, spot interruptions, startup timings and the heartbeat service
+
+import time
+from datetime import datetime
+import json
+import threading
+from cpuinfo import get_cpu_info
+import psutil
+import os
+import random
+import urllib.request
+from worker_settings import *
+from log_shipping import shipper
+
+
+def cgroup_path():
+    """cgroup v2 directory of this worker, None on cgroup v1 hosts"""
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    path = '/sys/fs/cgroup' + line.strip()[3:]
+                    if os.path.exists(os.path.join(path, 'cpu.stat')):
+                        return path
+                    # inside a cgroup namespace the worker sees its own cgroup as the root
+                    if os.path.exists('/sys/fs/cgroup/cpu.stat'):
+                        return '/sys/fs/cgroup'
+    except Exception:
+        pass
+    return None
+
+
+CGROUP_PATH = cgroup_path()
+
+
+class job_sampler:
+    """Samples the process tree of one job and the worker cgroup, keeps the peaks between samples"""
+    def __init__(self, pid):
+        self.process = psutil.Process(pid)
+        self.rss_peak = 0
+        self.last = {}
+
+    def sample(self):
+        data = {}
+        try:
+            cpu = self.process.cpu_times()
+            # children_* holds the cpu time of descendants the shell already waited for
+            cpu_seconds = cpu.user + cpu.system + cpu.children_user + cpu.children_system
+            rss = self.process.memory_info().rss
+            read_bytes = 0
+            write_bytes = 0
+            procs = [self.process] + self.process.children(recursive=True)
+            for p in procs:
+                try:
+                    if not p == self.process:
+                        t = p.cpu_times()
+                        cpu_seconds = cpu_seconds + t.user + t.system
+                        rss = rss + p.memory_info().rss
+                    io = p.io_counters()
+                    read_bytes = read_bytes + io.read_bytes
+                    write_bytes = write_bytes + io.write_bytes
+                except (psutil.NoSuchProcess, psutil.AccessDenied, AttributeError):
+                    pass
+            self.rss_peak = max(self.rss_peak, rss)
+            data.update({'job_cpu_seconds': cpu_seconds, 'job_rss_gb': rss/1000000000, 'job_rss_peak_gb': self.rss_peak/1000000000,
+                         'job_read_bytes': read_bytes, 'job_write_bytes': write_bytes, 'job_processes': len(procs)})
+        except psutil.NoSuchProcess:
+            # job finished, keep reporting what was seen last
+            return self.last
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO SAMPLE JOB PROCESSES: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+        data.update(cgroup_sample())
+        self.last = data
+        return data
+
+
+def cgroup_sample():
+    """cpu, memory peak, io and throttling from cgroup v2, shared by every slot of the worker"""
+    data = {}
+    if CGROUP_PATH == None:
+        return data
+    try:
+        with open(os.path.join(CGROUP_PATH, 'cpu.stat')) as f:
+            stat = dict(line.split() for line in f if len(line.split()) == 2)
+        data['cgroup_cpu_seconds'] = int(stat.get('usage_usec', 0))/1000000
+        data['cgroup_nr_throttled'] = int(stat.get('nr_throttled', 0))
+        data['cgroup_throttled_seconds'] = int(stat.get('throttled_usec', 0))/1000000
+    except Exception:
+        pass
+    for name, key in [('memory.current', 'cgroup_mem_gb'), ('memory.peak', 'cgroup_mem_peak_gb')]:
+        try:
+            with open(os.path.join(CGROUP_PATH, name)) as f:
+                data[key] = int(f.read().strip())/1000000000
+        except Exception:
+            pass
+    try:
+        rbytes = 0
+        wbytes = 0
+        with open(os.path.join(CGROUP_PATH, 'io.stat')) as f:
+            for line in f:
+                for field in line.split()[1:]:
+                    k, _, v = field.partition('=')
+                    if k == 'rbytes':
+                        rbytes = rbytes + int(v)
+                    elif k == 'wbytes':
+                        wbytes = wbytes + int(v)
+        data['cgroup_read_bytes'] = rbytes
+        data['cgroup_write_bytes'] = wbytes
+    except Exception:
+        pass
+    return data
+
+
+# set once the instance is being reclaimed, slots stop taking jobs and running jobs are handed back
+interrupted = threading.Event()
+
+
+class spot_watcher:
+    """Polls the spot interruption notice and sets interrupted when the instance is about to be reclaimed"""
+    def __init__(self, endpoint):
+        self._running = True
+        self.endpoint = endpoint
+
+    def terminate(self):
+        self._running = False
+
+    def notice(self):
+        headers = {}
+        if self.endpoint.startswith('http://169.254.169.254/'):
+            try:
+                token_request = urllib.request.Request('http://169.254.169.254/latest/api/token', method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+                headers['X-aws-ec2-metadata-token'] = urllib.request.urlopen(token_request, timeout=1).read().decode()
+            except Exception:
+                pass
+        try:
+            response = urllib.request.urlopen(urllib.request.Request(self.endpoint, headers=headers), timeout=1)
+            # the endpoint answers 404 until a notice is posted
+            return response.status == 200
+        except Exception:
+            return False
+
+    def run(self):
+        while self._running:
+            if self.notice():
+                cyc_root_log.error('## SPOT INTERRUPTION NOTICE, HANDING BACK JOBS' + ' -- ' + datetime.now().isoformat())
+                interrupted.set()
+                return
+            for i in range(SPOT_POLL_SECONDS):
+                if not self._running:
+                    return
+                time.sleep(1)
+
+
+class startup_timer:
+    """Seconds spent in each startup phase, sent once as a STARTUP log record with the first job the worker runs"""
+    def __init__(self):
+        self.phases = {}
+        self.sent = False
+        self._lock = threading.Lock()
+        # start.sh exports when the container started and when the agent download finished
+        boot = os.getenv("CYCLONE_BOOT_TIME")
+        fetched = os.getenv("CYCLONE_FETCH_TIME")
+        try:
+            if not boot == None and not fetched == None:
+                self.phases['agent_download'] = float(fetched) - float(boot)
+                self.phases['interpreter_and_imports'] = time.time() - float(fetched)
+            self.boot = float(boot) if not boot == None else AGENT_START
+        except ValueError:
+            self.boot = AGENT_START
+
+    def record(self, phase, seconds):
+        # phases run by every slot or lane keep the slowest one
+        with self._lock:
+            self.phases[phase] = max(seconds, self.phases.get(phase, 0))
+
+    def timed(self, phase, fn, *args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.record(phase, time.perf_counter() - t)
+
+    def first_job(self, JobName, JobQueue):
+        with self._lock:
+            if self.sent:
+                return
+            self.sent = True
+            data = dict(self.phases)
+        data['time_to_first_job'] = time.time() - self.boot
+        data['worker_id'] = worker_id
+        data['slots'] = slots
+        cyc_root_log.info('## STARTUP TIMINGS: ' + json.dumps(data) + ' -- ' + datetime.now().isoformat())
+        if not ENABLE_QLOG == 'False' or ENABLE_QLOG == False:
+            shipper.submit([{'time_stamp': datetime.now().isoformat(), 'log_type': 'STARTUP', 'id': JobName, 'jobDefinition': jobDefinition, 'jobQueue': JobQueue, 'data': data}], jobDefinition)
+
+
+startup = startup_timer()
+
+
+def instance_type():
+    """EC2 instance type from the instance metadata service, None when it can not be reached (e.g. Fargate)"""
+    if not os.getenv("CYCLONE_INSTANCE_TYPE") == None:
+        return os.getenv("CYCLONE_INSTANCE_TYPE")
+    try:
+        token_request = urllib.request.Request('http://169.254.169.254/latest/api/token', method='PUT', headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        token = urllib.request.urlopen(token_request, timeout=0.5).read().decode()
+        type_request = urllib.request.Request('http://169.254.169.254/latest/meta-data/instance-type', headers={'X-aws-ec2-metadata-token': token})
+        return urllib.request.urlopen(type_request, timeout=0.5).read().decode()
+    except Exception:
+        return None
+
+
+def cached_cpu_info():
+    """cpu info of the instance type from the local cache, then the worker bucket, computing it only on a miss"""
+    itype = instance_type()
+    if itype == None:
+        return get_cpu_info()
+
+    path = os.path.join(CPUINFO_CACHE_DIR, itype + '.json')
+    key = 'cpuinfo/' + itype + '.json'
+    bucket = stack_name + '-worker-' + region
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except Exception:
+        pass
+    try:
+        info = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    except Exception:
+        info = None
+
+    if info == None:
+        full = get_cpu_info()
+        # only the fields the worker reports
+        info = {k: full.get(k, 'null') for k in ['arch', 'count', 'brand_raw', 'hz_advertised_friendly']}
+        try:
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(info))
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO CACHE CPU INFO IN S3: ' + str(e) + ' -- ' + datetime.now().isoformat())
+    try:
+        os.makedirs(CPUINFO_CACHE_DIR, exist_ok=True)
+        with open(path + '.' + worker_id, 'w') as f:
+            json.dump(info, f)
+        os.rename(path + '.' + worker_id, path)
+    except Exception:
+        pass
+    return info
+
+
+class heartbeat:
+    """Heartbeat state of one claimed job, sent by the worker wide heartbeat_service. Direct mode jobs have no TaskToken and only hold their lease"""
+    def __init__(self, TaskToken, JobName, JobQueue):
+        self.TaskToken = TaskToken
+        self.JobName = JobName
+        self.JobQueue = JobQueue
+        # set while the job runs, a prefetched job only gets heartbeats and lease renewals until then
+        self.job_running = False
+        self.lease = None
+        # 'static' or 'direct' for jobs that also hold a claim in the queue table, it expires unless renewed
+        self.claim = None
+        self.next_beat = 0
+        self.sampler = None
+        # set by the heartbeat service when the job was deleted from its queue table while running
+        self.cancelled = False
+
+
+class heartbeat_service:
+    """One thread per worker that sends the state machine heartbeats for every claimed job, renews leases and sends metrics on its own cadence"""
+    def __init__(self, heartbeat_seconds, metrics_seconds):
+        self._running = True
+        self.heartbeat_seconds = heartbeat_seconds
+        self.metrics_seconds = metrics_seconds
+        self._beats = []
+        self._lock = threading.Lock()
+
+    def register(self, beat):
+        # first heartbeat goes out on the next tick
+        beat.next_beat = 0
+        with self._lock:
+            self._beats.append(beat)
+
+    def unregister(self, beat):
+        with self._lock:
+            if beat in self._beats:
+                self._beats.remove(beat)
+
+    def terminate(self):
+        self._running = False
+
+    def run(self):
+        next_metrics = time.perf_counter() + self.metrics_seconds
+        next_sample = time.perf_counter()
+        # spread over the interval so workers started together do not check in step
+        next_cancel_check = time.perf_counter() + random.uniform(1, CANCEL_CHECK_SECONDS)
+        while self._running:
+            now = time.perf_counter()
+            with self._lock:
+                beats = list(self._beats)
+
+            for beat in beats:
+                if now < beat.next_beat:
+                    continue
+                beat.next_beat = now + self.heartbeat_seconds
+                if not beat.TaskToken == None:
+                    try:
+                        sf.send_task_heartbeat(
+                            taskToken=beat.TaskToken
+                        )
+                        cyc_root_log.info('## SENT HEARTBEAT TO SF: ' + datetime.now().isoformat())
+                    except Exception as e:
+                        cyc_root_log.error('## FAILED TO SEND HEARTBEAT TO SF: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                        # the task token is gone, stop beating for it
+                        self.unregister(beat)
+                        continue
+
+                # state machine jobs drop their lease when they start, direct jobs hold it until they finish
+                if not beat.lease == None:
+                    try:
+                        sqs_main.change_message_visibility(
+                            QueueUrl=beat.lease['QueueUrl'],
+                            ReceiptHandle=beat.lease['ReceiptHandle'],
+                            VisibilityTimeout=LEASE_SECONDS
+                        )
+                        cyc_root_log.info('## RENEWED LEASE ON JOB: ' + datetime.now().isoformat())
+                    except Exception as e:
+                        cyc_root_log.error('## FAILED TO RENEW LEASE ON JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                if not beat.claim == None:
+                    renew_claim(beat.JobQueue, beat.JobName, beat.claim)
+
+            if now >= next_sample:
+                next_sample = now + SAMPLE_SECONDS
+                for beat in beats:
+                    if not beat.sampler == None:
+                        beat.sampler.sample()
+
+            if now >= next_metrics:
+                next_metrics = now + self.metrics_seconds
+                self.send_metrics([beat for beat in beats if beat.job_running])
+
+            if now >= next_cancel_check:
+                next_cancel_check = now + CANCEL_CHECK_SECONDS
+                self.check_cancelled([beat for beat in beats if beat.job_running and not beat.cancelled])
+
+            time.sleep(1)
+
+    def check_cancelled(self, beats):
+        """Flag running jobs that are no longer in their queue table, one BatchGetItem per 100 distinct jobs"""
+        # a bundle moves its heartbeat on to the next job, only the job that was checked is cancelled
+        checked = [(beat, beat.JobQueue, beat.JobName) for beat in beats]
+        keys = list(set((JobQueue, JobName) for beat, JobQueue, JobName in checked))
+        found = set()
+        for i in range(0, len(keys), 100):
+            request = {}
+            for JobQueue, JobName in keys[i:i + 100]:
+                request.setdefault(JobQueue, {'Keys': [], 'ProjectionExpression': '#attr1', 'ExpressionAttributeNames': {'#attr1': 'id'}})
+                request[JobQueue]['Keys'].append({'id': {'S': JobName}})
+            try:
+                res = dynamo_main.batch_get_item(RequestItems=request)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO CHECK FOR CANCELLED JOBS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                found.update(keys[i:i + 100])
+                continue
+            for JobQueue, items in res.get('Responses', {}).items():
+                for item in items:
+                    found.add((JobQueue, item['id']['S']))
+            # keys dynamodb did not get to are checked again next round
+            for JobQueue, unprocessed in res.get('UnprocessedKeys', {}).items():
+                for key in unprocessed['Keys']:
+                    found.add((JobQueue, key['id']['S']))
+        for beat, JobQueue, JobName in checked:
+            if not (JobQueue, JobName) in found and beat.JobName == JobName:
+                cyc_root_log.info('## JOB ' + JobName + ' WAS DELETED FROM ITS QUEUE, CANCELLING IT' + ' -- ' + datetime.now().isoformat())
+                beat.cancelled = True
+
+    def send_metrics(self, beats, final=False):
+        if len(beats) == 0 or not (not ENABLE_QLOG == 'False' or ENABLE_QLOG == False):
+            return
+        try:
+            # Get host metric data on cpu and mem usage once, job numbers come from each job's sampler
+            mem_data = psutil.virtual_memory()._asdict()
+            host_data = {'cpu_count': psutil.cpu_count(), 'cpu_percent': psutil.cpu_percent(), 'mem_total_gb': mem_data['total']/1000000000, 'mem_used_gb':mem_data['used']/1000000000, 'mem_percent': mem_data['percent']}
+            time_stamp = datetime.now().isoformat()
+            for beat in beats:
+                metric_data = dict(host_data)
+                if not beat.sampler == None:
+                    metric_data.update(beat.sampler.last)
+                if final:
+                    metric_data['final'] = True
+                package = [{'time_stamp': time_stamp, 'log_type': 'METRICS', 'id': beat.JobName, 'jobDefinition': jobDefinition, 'jobQueue': beat.JobQueue, 'data': metric_data}]
+                shipper.submit(package, jobDefinition)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO SEND METRICS PACKAGE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+heartbeats = heartbeat_service(HEARTBEAT_SECONDS, METRICS_SECONDS)
+
+
+def renew_claim(JobQueue, JobName, claim):
+    """Push back LeaseExpires of a running job, a static claim is only renewed while the job is still static"""
+    names = {'#attr1': 'Status', '#attr4': 'LeaseExpires'}
+    values = {':r': {'S': 'Running'}, ':l': {'N': str(int(time.time()) + LEASE_SECONDS)}}
+    condition = "#attr1 = :r"
+    if claim == 'static':
+        names['#attr3'] = 'Dispatch'
+        values[':d'] = {'S': 'static'}
+        condition = condition + " AND #attr3 = :d"
+    try:
+        dynamo_main.update_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            UpdateExpression="set #attr4 = :l",
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW"
+            )
+    except dynamo_main.exceptions.ConditionalCheckFailedException:
+        # requeued by the failed worker lambda or deleted with qdel, the cancel check stops it if it is gone
+        pass
+    except Exception as e:
+        cyc_root_log.error('## FAILED TO RENEW JOB CLAIM: ' + str(e) + ' -- ' + datetime.now().isoformat())
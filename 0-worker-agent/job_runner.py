@@ -0,0 +1,836 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Running one job: walltime, profiling, cpu pinning, the warm runtime, child job submission, do_work and how long idle slots linger
+
+import time
+from datetime import datetime
+import json
+from time import sleep
+import uuid
+import subprocess
+import threading
+import os
+import sys
+import queue
+import select
+import collections
+import signal
+import shutil
+import fcntl
+import hashlib
+import math
+import socket
+import array
+import shlex
+from boto3.dynamodb.types import TypeSerializer
+from worker_settings import *
+from log_shipping import shipper, stdout_archive
+from input_cache import stage, staging_directives
+from checkpoints import checkpoint_directive, job_checkpoint
+from job_monitor import interrupted, job_sampler
+
+
+def signal_job(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+    except Exception as e:
+        cyc_root_log.error('## FAILED TO SIGNAL JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+def walltime_seconds(walltime):
+    """Seconds of a walltime given as seconds or [[HH:]MM:]SS, None when there is none"""
+    if walltime == None or str(walltime).strip() in ['', 'null']:
+        return None
+    seconds = 0
+    for part in str(walltime).strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds if seconds > 0 else None
+
+
+def walltime_directive(cmd):
+    for line in cmd.splitlines():
+        parts = line.split()
+        if len(parts) >= 3 and parts[0] == '#HYPER' and parts[1] == '-t':
+            return parts[2]
+    return None
+
+
+def profile_directive(cmd):
+    """Sampling rate asked for with #HYPER -P [rate], None when the job is not profiled"""
+    for line in cmd.splitlines():
+        parts = line.split()
+        if len(parts) >= 2 and parts[0] == '#HYPER' and parts[1] == '-P':
+            return int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else PROFILE_RATE
+    return None
+
+
+class job_profiler:
+    """Sampling profiler for the process tree of one job (#HYPER -P). py-spy gives Python and native stacks when the image has it and the
+    container may ptrace, otherwise the state of every thread is sampled from /proc (running, waiting on disk or sleeping, with the
+    kernel wait channel). Collapsed stacks are written next to the job's logs as a PROFILE record, qlog -t PROFILE prints them for flamegraph.pl"""
+    def __init__(self, rate, JobName, JobQueue):
+        self.rate = max(1, rate)
+        self.JobName = JobName
+        self.JobQueue = JobQueue
+        self.key = 'logs/' + JobQueue + '/' + JobName + '/profile-' + worker_id + '.json'
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.sampler = 'proc'
+        self.stopped = threading.Event()
+        self.spy = None
+        self.output = None
+        self.thread = None
+
+    def start(self, pid):
+        self.pid = pid
+        if not shutil.which('py-spy') == None:
+            self.output = os.path.join('/tmp', 'cyclone-profile-' + worker_id + '-' + self.JobName + '.txt')
+            try:
+                self.spy = subprocess.Popen(['py-spy', 'record', '--pid', str(pid), '--subprocesses', '--nonblocking', '--rate', str(self.rate),
+                                             '--format', 'raw', '--output', self.output], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO START PY-SPY, SAMPLING /proc: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                self.spy = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        last_upload = time.perf_counter()
+        while not self.stopped.wait(1.0 / min(self.rate, PROC_PROFILE_MAX_RATE) if self.spy == None else 1):
+            if not self.spy == None and not self.spy.poll() == None and not self.spy.returncode == 0:
+                # usually a missing SYS_PTRACE capability, the /proc sampler still shows where the job spends its time
+                cyc_root_log.error('## PY-SPY FAILED, SAMPLING /proc: ' + self.spy.stderr.read().decode('utf-8', errors='replace') + ' -- ' + datetime.now().isoformat())
+                self.spy = None
+            if self.spy == None:
+                self.sample()
+                if time.perf_counter() - last_upload >= PROFILE_UPLOAD_SECONDS:
+                    self.upload(False)
+                    last_upload = time.perf_counter()
+
+    def sample(self):
+        procs = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/' + name + '/stat') as f:
+                        stat = f.read()
+                except OSError:
+                    continue
+                procs[int(name)] = (int(stat[stat.rindex(')') + 2:].split()[1]), stat[stat.index('(') + 1:stat.rindex(')')].replace(';', '_'))
+        if not self.pid in procs:
+            return
+        children = {}
+        for pid, (ppid, _) in procs.items():
+            children.setdefault(ppid, []).append(pid)
+        todo = [(self.pid, procs[self.pid][1])]
+        while len(todo) > 0:
+            pid, path = todo.pop()
+            for child in children.get(pid, []):
+                todo.append((child, path + ';' + procs[child][1]))
+            try:
+                tasks = os.listdir('/proc/' + str(pid) + '/task')
+            except OSError:
+                continue
+            for tid in tasks:
+                task = '/proc/' + str(pid) + '/task/' + tid
+                try:
+                    with open(task + '/stat') as f:
+                        stat = f.read()
+                    with open(task + '/wchan') as f:
+                        wchan = f.read().strip()
+                except OSError:
+                    continue
+                state = stat[stat.rindex(')') + 2]
+                wait = '' if wchan in ['', '0'] else ' ' + wchan
+                if state == 'R':
+                    frame = '[running]'
+                elif state == 'D':
+                    frame = '[disk wait' + wait + ']'
+                elif state == 'S':
+                    frame = '[sleeping' + wait + ']'
+                else:
+                    frame = '[' + state + ']'
+                thread = '' if tid == str(pid) else ';' + stat[stat.index('(') + 1:stat.rindex(')')].replace(';', '_')
+                self.stacks[path + thread + ';' + frame] += 1
+        self.samples += 1
+
+    def upload(self, final):
+        data = {'sampler': self.sampler, 'rate': self.rate, 'samples': self.samples, 'final': final,
+                'stacks': '\n'.join(stack + ' ' + str(count) for stack, count in self.stacks.most_common())}
+        record = {'time_stamp': datetime.now().isoformat(), 'log_type': 'PROFILE', 'id': self.JobName, 'jobDefinition': jobDefinition, 'jobQueue': self.JobQueue, 'data': data}
+        try:
+            # same layout the log stream lambda writes, so qlog finds the profile with the job's other logs
+            s3_main.put_object(Body=json.dumps({'data': [record]}), Bucket=stack_name + '-images-' + main_region, Key=self.key)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO UPLOAD PROFILE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def stop(self):
+        self.stopped.set()
+        if not self.thread == None:
+            self.thread.join()
+        if not self.spy == None:
+            try:
+                # py-spy ends with the job, an interrupt makes it write what it has when part of the tree is still around
+                self.spy.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.spy.send_signal(signal.SIGINT)
+                try:
+                    self.spy.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.spy.kill()
+            try:
+                with open(self.output) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        if count.isdigit():
+                            self.stacks[stack] += int(count)
+                            self.samples += int(count)
+                self.sampler = 'py-spy'
+                os.remove(self.output)
+            except OSError as e:
+                cyc_root_log.error('## NO PY-SPY PROFILE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        self.upload(True)
+
+
+class cpu_pinner:
+    """Claims free cores for each job with a lock file per core and sizes the thread pools of numerical libraries to the job vCPUs.
+    Cores are only pinned when the lock files are shared by all containers of the instance or the container has its own cpuset,
+    pinning without knowing the neighbours would stack their jobs on the same cores"""
+    def __init__(self, enabled, lock_dir, job_vcpus):
+        self.enabled = enabled
+        self.threads = max(1, int(math.ceil(job_vcpus)))
+        self.cores = sorted(os.sched_getaffinity(0))
+        if lock_dir == None and len(self.cores) <= math.ceil(CONTAINER_VCPUS):
+            lock_dir = '/tmp/cyclone-cpus'
+        self.lock_dir = lock_dir
+        if self.enabled and not self.lock_dir == None:
+            try:
+                os.makedirs(self.lock_dir, exist_ok=True)
+            except Exception as e:
+                cyc_root_log.error('## CPU PINNING DISABLED, COULD NOT USE ' + self.lock_dir + ': ' + str(e) + ' -- ' + datetime.now().isoformat())
+                self.lock_dir = None
+
+    def environment(self, env):
+        """Job environment with thread counts matching the job vCPUs, variables set by the definition win"""
+        if not self.enabled:
+            return env
+        env = dict(os.environ if env == None else env)
+        for name in THREAD_VARIABLES:
+            env.setdefault(name, str(self.threads))
+        return env
+
+    def claim(self):
+        """Locks on free cores for one job, an empty list when pinning is off or not enough cores are free"""
+        if not self.enabled or self.lock_dir == None or self.threads >= len(self.cores):
+            return []
+        held = []
+        # every worker starts looking at its own offset so containers rarely try the same cores
+        offset = int(hashlib.md5(worker_id.encode()).hexdigest(), 16) % len(self.cores)
+        for i in range(len(self.cores)):
+            core = self.cores[(offset + i) % len(self.cores)]
+            lock = open(os.path.join(self.lock_dir, 'cpu-' + str(core) + '.lock'), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            held.append((core, lock))
+            if len(held) == self.threads:
+                return held
+        self.release(held)
+        return []
+
+    def pin(self, held):
+        """Pin the calling slot thread, and so the job it starts, to the claimed cores"""
+        if len(held) == 0:
+            return
+        try:
+            os.sched_setaffinity(0, [core for core, _ in held])
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO PIN JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def restore(self, held):
+        """Give the slot thread all cores back once its pinned job is done, the next job might not claim any"""
+        if len(held) == 0:
+            return
+        try:
+            os.sched_setaffinity(0, self.cores)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO UNPIN SLOT: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def release(self, held):
+        # closing the lock file drops the lock, a dead worker's cores free up on their own
+        for _, lock in held:
+            lock.close()
+
+
+pinner = cpu_pinner(not CPU_PINNING == 'False', CPU_LOCK_DIR, JOB_VCPUS)
+
+
+def python_command(cmd):
+    """Script or module and argv of a job that only runs python script.py [args] or python -m module [args] with the worker's own
+    interpreter, None for anything else. Comments and #HYPER directives are ignored, shell syntax sends the job through the shell"""
+    lines = [line.strip() for line in cmd.splitlines() if len(line.strip()) > 0 and not line.strip().startswith('#')]
+    if not len(lines) == 1 or any(c in lines[0] for c in '|&;<>()$`\\*?[]{}~'):
+        return None
+    try:
+        argv = shlex.split(lines[0])
+    except ValueError:
+        return None
+    if len(argv) < 2 or not os.path.basename(argv[0]).startswith('python'):
+        return None
+    # forking from the zygote only matches running the job when python resolves to the same interpreter
+    interpreter = shutil.which(argv[0])
+    if interpreter == None or not os.path.realpath(interpreter) == os.path.realpath(sys.executable):
+        return None
+    if argv[1] == '-m' and len(argv) >= 3:
+        return {'module': argv[2], 'argv': argv[2:]}
+    elif argv[1].endswith('.py'):
+        return {'script': argv[1], 'argv': argv[1:]}
+    return None
+
+
+class warm_process:
+    """Popen stand-in for a job forked by the warm runtime, output comes through the pipe and the pid and exit code over the runner's socket"""
+    def __init__(self, conn, read_fd):
+        self.conn = conn
+        self.partial = b''
+        self.returncode = None
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.pid = self.message(10)['pid']
+
+    def message(self, timeout):
+        deadline = None if timeout == None else time.perf_counter() + timeout
+        while not b'\n' in self.partial:
+            readable, _, _ = select.select([self.conn], [], [], None if deadline == None else max(0, deadline - time.perf_counter()))
+            if not readable:
+                raise subprocess.TimeoutExpired('warm runtime job', timeout)
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                raise EOFError('warm runtime runner closed the socket')
+            self.partial += chunk
+        line, self.partial = self.partial.split(b'\n', 1)
+        return json.loads(line)
+
+    def wait(self, timeout=None):
+        if self.returncode == None:
+            try:
+                self.returncode = self.message(timeout)['returncode']
+            except EOFError as e:
+                # the runner is gone without reporting, the job counts as failed
+                cyc_root_log.error('## WARM RUNTIME LOST JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                self.returncode = -1
+            self.conn.close()
+        return self.returncode
+
+
+class warm_runtime:
+    """Forks plain Python jobs from a zygote interpreter that already imported WARM_MODULES, saving the interpreter start and imports of
+    every job. Jobs run through the shell until the zygote is up, when they are not plain python commands and whenever the zygote fails"""
+    def __init__(self, modules):
+        self.modules = modules
+        self.socket_path = os.path.join('/tmp', 'cyclone-warm-' + worker_id + '.sock')
+        self.proc = None
+
+    def start(self):
+        if len(self.modules) == 0:
+            return
+        try:
+            # thread pools of preloaded libraries are sized at import, so the zygote gets the job thread counts up front
+            self.proc = subprocess.Popen([sys.executable, JOB_HELPER, '--warm-runtime', self.socket_path, ','.join(self.modules)],
+                                         env = pinner.environment(None))
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO START WARM RUNTIME: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def ready(self):
+        return not self.proc == None and self.proc.poll() == None and os.path.exists(self.socket_path)
+
+    def launch(self, cmd, env, cpus=None):
+        """Fork the job from the zygote, None when it has to run through the shell"""
+        if not self.ready():
+            return None
+        request = python_command(cmd)
+        if request == None:
+            return None
+        read_fd, write_fd = os.pipe()
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.settimeout(10)
+            conn.connect(self.socket_path)
+            data = (json.dumps(dict(request, cwd=os.getcwd(), env=dict(os.environ if env == None else env), cpus=[] if cpus == None else cpus)) + '\n').encode()
+            # the write end of the job's output pipe goes along with the request
+            sent = conn.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [write_fd]))])
+            conn.sendall(data[sent:])
+            os.close(write_fd)
+            write_fd = None
+            proc = warm_process(conn, read_fd)
+            cyc_root_log.info('## JOB FORKED FROM WARM RUNTIME: ' + str(proc.pid) + ' -- ' + datetime.now().isoformat())
+            return proc
+        except Exception as e:
+            cyc_root_log.error('## WARM RUNTIME LAUNCH FAILED, RUNNING THROUGH THE SHELL: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            if not write_fd == None:
+                os.close(write_fd)
+            try:
+                os.close(read_fd)
+            except OSError:
+                pass
+            conn.close()
+            return None
+
+    def terminate(self):
+        if not self.proc == None and self.proc.poll() == None:
+            self.proc.terminate()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+warm = warm_runtime(WARM_MODULES)
+
+
+class submit_service:
+    """Unix socket jobs use to submit child jobs without going through the API (job_helper.py --submit is the client).
+    Children are written to the queue table in the main region with BatchWriteItem under the worker role, each records the job that
+    submitted it in parentId and parentQueue. Their queue and definition default to the parent's and #HYPER directives apply as in qsub"""
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.server = None
+        self.serializer = TypeSerializer()
+
+    def start(self):
+        try:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.socket_path)
+            self.server.listen(64)
+            threading.Thread(target=self.run, daemon=True).start()
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO START SUBMIT SOCKET: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            self.server = None
+
+    def environment(self, env, JobName, JobQueue):
+        """Job environment that lets the job find the socket and name itself as parent"""
+        if self.server == None:
+            return env
+        return dict(os.environ if env == None else env, CYCLONE_SUBMIT_SOCKET=self.socket_path, CYCLONE_JOB_ID=JobName, CYCLONE_JOB_QUEUE=JobQueue,
+                    CYCLONE_AGENT=JOB_HELPER)
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        try:
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            request = json.loads(data)
+            ids = self.submit(request['items'], request.get('parent'), request.get('queue'))
+            conn.sendall((json.dumps({'ids': ids}) + '\n').encode())
+        except Exception as e:
+            cyc_root_log.error('## CHILD SUBMIT FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            try:
+                conn.sendall((json.dumps({'error': str(e)}) + '\n').encode())
+            except Exception:
+                pass
+        finally:
+            conn.close()
+
+    def child_item(self, job, parent, queue, now):
+        """Queue table item for one child, the fields qsub would send through the API plus lineage"""
+        if not type(job) == dict or not type(job.get('commands')) == str:
+            raise ValueError('every child job needs its commands')
+        item = {'jobQueue': queue, 'jobDefinition': jobDefinition, 'RetriesAvailable': 0}
+        inputs = []
+        outputs = []
+        for line in job['commands'].splitlines():
+            if line.startswith('#HYPER -n '):
+                item['jobName'] = line.replace('#HYPER -n ', '').strip()
+            elif line.startswith('#HYPER -q '):
+                item['jobQueue'] = line.replace('#HYPER -q ', '').strip()
+            elif line.startswith('#HYPER -r '):
+                item['RetriesAvailable'] = line.replace('#HYPER -r ', '').strip()
+            elif line.startswith('#HYPER -d '):
+                item['jobDefinition'] = line.replace('#HYPER -d ', '').strip()
+            elif line.startswith('#HYPER -i '):
+                inputs.append(line.replace('#HYPER -i ', '').strip())
+            elif line.startswith('#HYPER -o '):
+                outputs.append(line.replace('#HYPER -o ', '').strip())
+            elif line.strip() == '#HYPER -k' or line.startswith('#HYPER -k '):
+                item['checkpoint'] = line.replace('#HYPER -k', '').strip() or 'True'
+            elif line.startswith('#HYPER -t '):
+                item['walltime'] = line.replace('#HYPER -t ', '').strip()
+        for k in ['jobName', 'jobQueue', 'jobDefinition', 'RetriesAvailable', 'walltime']:
+            if not job.get(k) == None:
+                item[k] = job[k]
+        item['RetriesAvailable'] = int(item['RetriesAvailable'])
+        if len(inputs) > 0:
+            item['inputs'] = inputs
+        if len(outputs) > 0:
+            item['outputs'] = outputs
+        item['commands'] = job['commands']
+        item['id'] = str(uuid.uuid4())
+        item['Status'] = 'Waiting'
+        item['Output'] = ' '
+        item['tCreated'] = now
+        # children of one parent share a job name so qstat -j and qdel -n handle them together
+        item.setdefault('jobName', parent if not parent == None else item['id'])
+        if not parent == None:
+            item['parentId'] = parent
+            item['parentQueue'] = queue
+        return item
+
+    def submit(self, jobs, parent, queue):
+        started = time.perf_counter()
+        now = datetime.now().isoformat()
+        items = [self.child_item(job, parent, queue, now) for job in jobs]
+        requests = {}
+        for item in items:
+            requests.setdefault(item['jobQueue'], []).append({'PutRequest': {'Item': {k: self.serializer.serialize(v) for k, v in item.items()}}})
+        for table_name, puts in requests.items():
+            for i in range(0, len(puts), 25):
+                pending = {table_name: puts[i:i + 25]}
+                attempt = 0
+                while len(pending) > 0:
+                    response = dynamo_main.batch_write_item(RequestItems=pending)
+                    pending = response.get('UnprocessedItems', {})
+                    if len(pending) > 0:
+                        attempt += 1
+                        if attempt > 8:
+                            raise Exception('queue table ' + table_name + ' kept throttling child submits')
+                        sleep(min(5, 0.05 * 2 ** attempt))
+        data = {'children_submitted': len(items), 'submit_seconds': time.perf_counter() - started}
+        cyc_root_log.info('## SUBMITTED CHILD JOBS: ' + json.dumps(data) + ' -- ' + datetime.now().isoformat())
+        if not parent == None and (not ENABLE_QLOG == 'False' or ENABLE_QLOG == False):
+            shipper.submit([{'time_stamp': datetime.now().isoformat(), 'log_type': 'METRICS', 'id': parent, 'jobDefinition': jobDefinition, 'jobQueue': queue, 'data': data}], jobDefinition)
+        return [item['id'] for item in items]
+
+    def terminate(self):
+        if not self.server == None:
+            self.server.close()
+            try:
+                os.unlink(self.socket_path)
+            except OSError:
+                pass
+
+
+submitter = submit_service(os.path.join('/tmp', 'cyclone-submit-' + worker_id + '.sock'))
+
+
+def do_work(cmd, callback, stack_name, JobName, jobDefinition, JobQueue, beat=None, walltime=None):
+    """Run the job command, streams its output to callback in batches and returns the last TAIL_LINES lines with the job status.
+    A job still running after its walltime (from the job item, else #HYPER -t) has its process group killed and ends TimedOut.
+    The job runs on cores claimed for it by pinner with thread pools sized to its vCPUs"""
+    tail = collections.deque(maxlen=TAIL_LINES)
+    try:
+        limit = walltime_seconds(walltime)
+        if limit == None:
+            limit = walltime_seconds(walltime_directive(cmd))
+    except ValueError:
+        cyc_root_log.error('## INVALID WALLTIME, RUNNING WITHOUT ONE: ' + str(walltime) + ' -- ' + datetime.now().isoformat())
+        limit = None
+    inputs, outputs = staging_directives(cmd)
+    if len(inputs) > 0:
+        try:
+            stage(inputs, 'in', JobName, JobQueue)
+        except Exception as e:
+            cyc_root_log.error('## STAGING INPUTS FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            return ['CYCLONE: Staging job inputs failed', str(e)], 'Failed'
+    checkpoint = None
+    job_env = None
+    if not checkpoint_directive(cmd) == None:
+        try:
+            checkpoint = job_checkpoint(checkpoint_directive(cmd), JobName, JobQueue)
+            checkpoint.restore()
+            job_env = dict(os.environ, CYCLONE_CHECKPOINT_DIR=checkpoint.path)
+        except Exception as e:
+            cyc_root_log.error('## RESTORING CHECKPOINT FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            return ['CYCLONE: Restoring job checkpoint failed', str(e)], 'Failed'
+    job_env = submitter.environment(pinner.environment(job_env), JobName, JobQueue)
+    cores = pinner.claim()
+    pinner.pin(cores)
+    profile_rate = profile_directive(cmd)
+    profiler = None
+    archive = None
+    if STDOUT_ARCHIVE == 'True':
+        archive = stdout_archive(JobName, JobQueue)
+        callback = archive.push
+    try:
+        proc = warm.launch(cmd, job_env, [core for core, _ in cores])
+        if proc == None:
+            proc = subprocess.Popen([cmd],
+                                    stdout = subprocess.PIPE,
+                                    stderr = subprocess.STDOUT,
+                                    shell = True,
+                                    env = job_env,
+                                    # own process group so the whole job tree can be signalled
+                                    start_new_session = True
+                                    )
+        if not checkpoint == None:
+            checkpoint.start()
+        if not profile_rate == None:
+            profiler = job_profiler(profile_rate, JobName, JobQueue)
+            profiler.start(proc.pid)
+        if not beat == None:
+            try:
+                beat.sampler = job_sampler(proc.pid)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO START JOB SAMPLER: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        fd = proc.stdout.fileno()
+        buffer = []
+        partial = b''
+        old_time = time.perf_counter()
+        started = old_time
+        terminated_at = None
+        timed_out_at = None
+        cancelled_at = None
+
+        def enforce():
+            """Stop the job group on spot interruption or once it is past its walltime, SIGKILL follows SIGTERM after the grace time.
+            A cancelled job is killed at once"""
+            nonlocal terminated_at, timed_out_at, cancelled_at
+            if not beat == None and beat.cancelled:
+                if cancelled_at == None:
+                    cancelled_at = time.perf_counter()
+                signal_job(proc, signal.SIGKILL)
+            elif interrupted.is_set() and timed_out_at == None:
+                if terminated_at == None:
+                    terminated_at = time.perf_counter()
+                    signal_job(proc, signal.SIGTERM)
+                elif time.perf_counter() - terminated_at >= SPOT_GRACE_SECONDS:
+                    signal_job(proc, signal.SIGKILL)
+            elif not limit == None and terminated_at == None:
+                if timed_out_at == None and time.perf_counter() - started >= limit:
+                    timed_out_at = time.perf_counter()
+                    cyc_root_log.error('## JOB PAST WALLTIME OF ' + str(limit) + ' SECONDS, STOPPING IT' + ' -- ' + datetime.now().isoformat())
+                    signal_job(proc, signal.SIGTERM)
+                elif not timed_out_at == None and time.perf_counter() - timed_out_at >= WALLTIME_GRACE_SECONDS:
+                    signal_job(proc, signal.SIGKILL)
+
+        while True:
+            enforce()
+            # wait at most a second for output so quiet jobs still get their buffered lines shipped on time
+            readable, _, _ = select.select([fd], [], [], 1.0)
+            if readable:
+                chunk = os.read(fd, READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.flush()
+                lines = (partial + chunk).split(b'\n')
+                partial = lines.pop()
+                if len(partial) > MAX_LINE_BYTES:
+                    lines.append(partial)
+                    partial = b''
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace')
+                    tail.append(line)
+                    buffer.append(line)
+
+            if len(buffer) > 1000 or (len(buffer) > 0 and time.perf_counter() - old_time >= 10):
+                callback(stack_name, JobName, jobDefinition, JobQueue, buffer)
+
+                buffer = []
+                old_time = time.perf_counter()
+        if len(partial) > 0:
+            line = partial.decode('utf-8', errors='replace')
+            tail.append(line)
+            buffer.append(line)
+        if len(buffer) > 0:
+            callback(stack_name, JobName, jobDefinition, JobQueue, buffer)
+        if not archive == None:
+            archive.close()
+        proc.stdout.close()
+        # a job can close its output and keep running, the walltime and interruption still apply until it exits
+        while True:
+            try:
+                proc.wait(timeout=1)
+                break
+            except subprocess.TimeoutExpired:
+                enforce()
+        if not checkpoint == None:
+            # only a job that runs again needs its latest checkpoint: an interrupted job, or one whose outputs still have to be
+            # uploaded since a failed upload reruns it. Jobs that fail or time out are not retried
+            interrupted_job = not terminated_at == None and not proc.returncode == 0
+            staging_outputs = proc.returncode == 0 and len(outputs) > 0
+            checkpoint.stop(sync=(interrupted_job or staging_outputs) and cancelled_at == None and timed_out_at == None)
+        if not cancelled_at == None:
+            if not checkpoint == None:
+                checkpoint.discard()
+            tail.append('CYCLONE: Job cancelled, it was deleted from its queue while running.')
+            cyc_root_log.error('## JOB CANCELLED' + ' -- ' + datetime.now().isoformat())
+            return list(tail), 'Cancelled'
+        elif not timed_out_at == None:
+            # even when the job exits cleanly on SIGTERM, it did not finish its work
+            if not checkpoint == None:
+                checkpoint.discard()
+            tail.append('CYCLONE: Job stopped after its walltime of ' + str(limit) + ' seconds, it is not retried.')
+            cyc_root_log.error('## JOB TIMED OUT' + ' -- ' + datetime.now().isoformat())
+            return list(tail), 'TimedOut'
+        elif proc.returncode == 0:
+            cyc_root_log.info('## JOB SUCCESSFUL: ' + ' -- ' + datetime.now().isoformat())
+            if len(outputs) > 0:
+                try:
+                    stage(outputs, 'out', JobName, JobQueue)
+                except Exception as e:
+                    cyc_root_log.error('## STAGING OUTPUTS FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                    tail.append('CYCLONE: Staging job outputs failed')
+                    tail.append(str(e))
+                    return list(tail), 'Failed'
+            if not checkpoint == None:
+                checkpoint.discard()
+            return list(tail), 'Successful'
+        elif not terminated_at == None:
+            tail.append('CYCLONE: Job stopped by spot interruption, it is queued again without using a retry.')
+            cyc_root_log.error('## JOB INTERRUPTED' + ' -- ' + datetime.now().isoformat())
+            return list(tail), 'Interrupted'
+        else:
+            if not checkpoint == None:
+                checkpoint.discard()
+            tail.append('CYCLONE: Job executable had a non 0 exit code, retries set to zero.')
+            status = 'JobFailed'
+            cyc_root_log.error('## JOB FAILED: ' + '\n'.join(tail) + ' -- ' + datetime.now().isoformat())
+            return list(tail), status
+    except Exception as e:
+        if not checkpoint == None and not checkpoint.stopped.is_set():
+            checkpoint.stop(sync=True)
+        cyc_root_log.error('## JOB EXECUTION SUBPROCESS FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        tail.append('CYCLONE: Worker Subprocess for executable failed')
+        tail.append(str(e))
+        status = 'Failed'
+        return list(tail), status
+    finally:
+        if not archive == None:
+            archive.close()
+        if not profiler == None:
+            profiler.stop()
+        pinner.restore(cores)
+        pinner.release(cores)
+
+
+class linger_policy:
+    """Decides how long an idle slot waits for the next job. Lingers up to the longest recent gap between jobs when arrivals come in bursts
+    or the queue backlog is growing, exits after the minimum when the queue is empty and arrivals are steady. Lingering slots reserve their
+    vCPUs in the warm pool table, reservations expire on their own if the worker dies"""
+    def __init__(self, min_seconds, max_seconds, vcpu_cap):
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.vcpu_cap = vcpu_cap
+        self.arrivals = collections.deque(maxlen=32)
+        self.backlog = None
+        self.previous_backlog = None
+        self.sampled_at = None
+        self.queue_url = None
+        self.held = set()
+        self.lock = threading.Lock()
+        # the whole Batch queue shares one pool, the async table name carries the core stack name
+        self.pool = os.getenv("AWS_BATCH_JQ_NAME", jobDefinition)
+        self.table = table.rsplit('_table', 1)[0] + '_warm_pool'
+
+    def arrived(self):
+        with self.lock:
+            self.arrivals.append(time.perf_counter())
+
+    def sample_backlog(self):
+        if not self.sampled_at == None and time.perf_counter() - self.sampled_at < BACKLOG_SAMPLE_SECONDS:
+            return
+        self.sampled_at = time.perf_counter()
+        try:
+            if self.queue_url == None:
+                self.queue_url = sqs_main.get_queue_url(QueueName=jobDefinition)['QueueUrl']
+            response = sqs_main.get_queue_attributes(QueueUrl=self.queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+            self.previous_backlog = self.backlog
+            self.backlog = int(response['Attributes']['ApproximateNumberOfMessages'])
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT SAMPLE QUEUE BACKLOG: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def seconds(self):
+        if self.max_seconds <= self.min_seconds:
+            return self.min_seconds
+        self.sample_backlog()
+        with self.lock:
+            times = list(self.arrivals)
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        rising = not self.backlog == None and not self.previous_backlog == None and self.backlog > self.previous_backlog
+        waiting = not self.backlog == None and self.backlog > 0
+        bursty = False
+        if len(gaps) >= 3:
+            mean = sum(gaps) / len(gaps)
+            # coefficient of variation above 1, gaps vary more than a steady (poisson) stream of jobs would
+            bursty = mean > 0 and (sum((g - mean) ** 2 for g in gaps) / len(gaps)) ** 0.5 > mean
+        if not (bursty or rising or waiting):
+            return self.min_seconds
+        if len(gaps) == 0:
+            return self.max_seconds
+        return int(max(self.min_seconds, min(self.max_seconds, max(gaps))))
+
+    def hold(self, key):
+        """Linger seconds for an idle slot, falls back to the minimum when the warm pool of the Batch queue is full"""
+        seconds = self.seconds()
+        if seconds <= self.min_seconds or self.vcpu_cap <= 0:
+            return seconds
+        now = int(time.time())
+        try:
+            # soft cap, slots reserving at the same moment can overshoot it by their own vCPUs
+            response = dynamo.query(
+                TableName=self.table,
+                KeyConditionExpression="#attr1 = :p",
+                FilterExpression="#attr2 > :q",
+                ExpressionAttributeNames={'#attr1': 'pool', '#attr2': 'expires'},
+                ExpressionAttributeValues={':p': {'S': self.pool}, ':q': {'N': str(now)}},
+                ConsistentRead=True)
+            idle = sum(float(i['vcpus']['N']) for i in response.get('Items', []) if not i['holder']['S'] == key)
+            if idle + JOB_VCPUS > self.vcpu_cap:
+                cyc_root_log.info('## Warm pool full (' + str(idle) + ' idle vCPUs), not lingering')
+                return self.min_seconds
+            dynamo.put_item(
+                TableName=self.table,
+                Item={
+                    'pool': {'S': self.pool},
+                    'holder': {'S': key},
+                    'vcpus': {'N': str(JOB_VCPUS)},
+                    'worker_id': {'S': worker_id},
+                    'expires': {'N': str(now + IDLE_TIMEOUT + seconds)}
+                })
+            with self.lock:
+                self.held.add(key)
+            return seconds
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT RESERVE WARM POOL VCPUS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            return self.min_seconds
+
+    def release(self, key):
+        with self.lock:
+            if not key in self.held:
+                return
+            self.held.discard(key)
+        try:
+            dynamo.delete_item(TableName=self.table, Key={'pool': {'S': self.pool}, 'holder': {'S': key}})
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT RELEASE WARM POOL VCPUS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+linger = linger_policy(LINGER_MIN, LINGER_MAX, IDLE_VCPU_CAP)
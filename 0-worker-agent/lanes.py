@@ -0,0 +1,634 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# State machine mode: slots in the async table, the wake queue that hands them jobs, prefetch lanes and bundles
+
+import time
+import boto3
+from datetime import datetime
+import json
+import uuid
+import threading
+import psutil
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from worker_settings import *
+from log_shipping import log_push
+from job_monitor import cached_cpu_info, heartbeat, heartbeats, interrupted, startup
+from job_runner import do_work, linger
+
+
+def wake_queue_name(stack_name, worker_id):
+    """Wake queue of this worker, named after its Batch job (array children as <job id>-<index>) so the failed worker lambda can
+    delete the queue of a worker that died without closing it"""
+    batch_job_id = os.getenv("AWS_BATCH_JOB_ID")
+    return stack_name + '-wake-' + (batch_job_id.replace(':', '-') if not batch_job_id == None else worker_id)
+
+
+class sqs_channel:
+    """Per-worker wake queue, get-start-delete-lambda sends the job it wrote to the async table here so the worker does not have to poll DynamoDB"""
+    def __init__(self, stack_name, worker_id, region):
+        self.sqs = boto3.client('sqs', region_name=region, config=client_config)
+        # the tags let the periodic sweep of the failed worker lambda find queues whose worker is gone
+        response = self.sqs.create_queue(
+            QueueName=wake_queue_name(stack_name, worker_id),
+            Attributes={'MessageRetentionPeriod': '60', 'ReceiveMessageWaitTimeSeconds': '20'},
+            tags={'cyclone:worker': worker_id, 'cyclone:batch-job': os.getenv("AWS_BATCH_JOB_ID", 'null')}
+        )
+        self.url = response['QueueUrl']
+
+    def wait(self, timeout):
+        response = self.sqs.receive_message(
+            QueueUrl=self.url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=max(0, min(20, int(timeout)))
+        )
+        messages = response.get('Messages', [])
+        if len(messages) > 0:
+            self.sqs.delete_message_batch(
+                QueueUrl=self.url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']} for i, m in enumerate(messages)]
+            )
+        return [json.loads(m['Body']) for m in messages]
+
+    def close(self):
+        try:
+            self.sqs.delete_queue(QueueUrl=self.url)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO DELETE WAKE QUEUE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+class local_channel:
+    """In-process stand-in for the wake queue, call notify() with the same payload the lambda would send"""
+    def __init__(self):
+        self.url = 'null'
+        self._queue = queue.Queue()
+
+    def notify(self, payload):
+        self._queue.put(payload)
+
+    def wait(self, timeout):
+        try:
+            return [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+    def close(self):
+        pass
+
+
+def open_channel(stack_name, worker_id, region):
+    if HANDOFF_MODE == 'local':
+        return local_channel()
+    if HANDOFF_MODE == 'push':
+        try:
+            return sqs_channel(stack_name, worker_id, region)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO CREATE WAKE QUEUE, FALLING BACK TO POLLING: ' + str(e) + ' -- ' + datetime.now().isoformat())
+    return None
+
+
+class dispatcher:
+    """Single reader of the worker wake queue, routes each wake message to the inbox of the slot it is addressed to"""
+    def __init__(self, channel):
+        self._running = True
+        self.channel = channel
+        self.inboxes = {}
+
+    def terminate(self):
+        self._running = False
+
+    def register(self, uuid, inbox):
+        self.inboxes[uuid] = inbox
+
+    def unregister(self, uuid):
+        self.inboxes.pop(uuid, None)
+
+    def run(self):
+        while self._running:
+            try:
+                payloads = self.channel.wait(5)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO RECEIVE FROM WAKE QUEUE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                time.sleep(1)
+                continue
+            for payload in payloads:
+                inbox = self.inboxes.get(payload.get('uuid'))
+                if not inbox == None:
+                    inbox.put(payload)
+
+
+def get_slot(uuid):
+    res = dynamo.get_item(
+        TableName=table,
+        Key={
+            'uuid': {
+                'S': uuid}},
+        ConsistentRead=True,
+        AttributesToGet=[
+            'command',
+            'LeaveRunning',
+            'Callback',
+            'id',
+            'JobQueue',
+            'Leased',
+            'ReceiptHandle',
+            'QueueUrl',
+            'Bundle',
+            'Walltime'
+        ])
+    return res['Item']
+
+
+class lane:
+    """One async table item and one state machine execution. A slot runs its jobs through 1 + PREFETCH lanes so the next job is claimed while the current one runs"""
+    def __init__(self, slot_index, lane_index):
+        self.uuid = str(uuid.uuid4())
+        self.slot_index = slot_index
+        self.lane_index = lane_index
+        self.JobName = 'null'
+        self.item = None
+        self.claimed_at = None
+        self.beat = None
+        self.closed = False
+        self.waiting_since = time.perf_counter()
+        # seconds the state machine long-polls for the next job of this lane, set from the linger policy after each job
+        self.linger = LINGER_MIN
+
+    def register(self, info, mem_info, cpu_count):
+        #create dynamodb slot for command pickup
+        response = dynamo.put_item(
+            TableName=table,
+            Item={
+                'uuid': {
+                    'S': self.uuid},
+                'command': {
+                    'S':'null'},
+                'LeaveRunning': {
+                    "S":"True"},
+                'Callback': {
+                    'S':'null'},
+                'id': {
+                    'S':'null'},
+                'Output': {
+                    'S':'null'},
+                'CurrentTime': {
+                    'S': datetime.now().isoformat()},
+                'hostname': {
+                    'S': os.getenv("HOSTNAME", 'null')},
+                'aws_batch_job_id': {
+                    'S': os.getenv("AWS_BATCH_JOB_ID", 'null')},
+                'worker_id': {
+                    'S': worker_id},
+                'slot': {
+                    'S': str(self.slot_index) + '.' + str(self.lane_index)},
+                'Status': {
+                    'S':'null'},
+                'jobDefinition': {
+                    'S':jobDefinition},
+                'cpu_arch': {
+                    'S': info.get('arch', 'null')},
+                'cpu_count': {
+                    'S': cpu_count},
+                'cpu_brand': {
+                    'S':info.get('brand_raw', 'null')},
+                'cpu_Hz': {
+                    'S':info.get('hz_advertised_friendly', 'null')},
+                'mem_total_gb': {
+                    'S':str(mem_info['total']/1000000000) or None},
+                'mem_available_gb': {
+                    'S':str(mem_info['available']/1000000000) or None},
+                'JobQueue': {
+                    'S':'null'}
+                })
+
+    def start(self, notify_url):
+        #get queue name and launch SF with queue and uuid slot 
+        input = {"sqs_name": jobDefinition,
+                    "uuid": self.uuid,
+                    "Callback": 'null',
+                    "LeaveRunning": 'True',
+                    "Output": 'null',
+                    "Status": 'null',
+                    "id": 'null',
+                    "table": table,
+                    "notify_url": notify_url,
+                    "lease_seconds": str(LEASE_SECONDS) if PREFETCH > 0 else 'null',
+                    "bundle_size": str(BUNDLE_SIZE) if BUNDLE_SIZE > 1 else 'null',
+                    "linger_seconds": str(self.linger)
+                }
+
+        #can include an x-ray id with line: traceHeader='string'
+        response = sf.start_execution(
+            stateMachineArn=sf_arn,
+            name=self.uuid,
+            input=json.dumps(input)
+        )
+
+    def offer(self, item):
+        """Take a job (or shutdown) handed to the lane by the state machine, ignores repeats of the job the lane already has"""
+        if self.closed or not self.item == None:
+            return
+        if item['LeaveRunning']['S'] == 'True' and item['id']['S'] == self.JobName:
+            return
+        self.item = item
+        self.claimed_at = time.perf_counter()
+        linger.release(self.uuid)
+        if not item['LeaveRunning']['S'] == 'True':
+            return
+        linger.arrived()
+        cyc_root_log.info('## FOUND NEW JOB IN DYNAMODB - JOB ID: ' + json.dumps(item))
+        try:
+            self.beat = heartbeat(item['Callback']['S'], item['id']['S'], item['JobQueue']['S'])
+            if item.get('Leased', {'S': 'False'})['S'] == 'True':
+                self.beat.lease = {'QueueUrl': item['QueueUrl']['S'], 'ReceiptHandle': item['ReceiptHandle']['S']}
+            heartbeats.register(self.beat)
+        except Exception as e:
+            cyc_root_log.error('## HEARTBEAT REGISTRATION FAILED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def release(self):
+        if not self.beat == None:
+            heartbeats.unregister(self.beat)
+        self.beat = None
+        self.item = None
+        self.waiting_since = time.perf_counter()
+
+
+def collect_handoffs(lanes, inbox, block):
+    """Hand new jobs from the wake queue (or the async table when polling) to the lanes waiting for them"""
+    waiting = [l for l in lanes if not l.closed and l.item == None]
+    if len(waiting) == 0:
+        return
+    if not inbox == None:
+        payloads = []
+        try:
+            payloads.append(inbox.get(timeout=1 if block else 0.001))
+            while True:
+                payloads.append(inbox.get_nowait())
+        except queue.Empty:
+            pass
+        for payload in payloads:
+            for l in waiting:
+                if l.uuid == payload.get('uuid'):
+                    if 'command' in payload:
+                        l.offer({k: {'S': str(v)} for k, v in payload.items()})
+                    else:
+                        # command was too large for the wake message, read it from the slot
+                        l.offer(get_slot(l.uuid))
+    else:
+        # polling fallback, one read per waiting lane per second
+        for l in waiting:
+            l.offer(get_slot(l.uuid))
+        if block and all(l.item == None for l in waiting):
+            time.sleep(1)
+
+    for l in waiting:
+        if l.item == None and time.perf_counter() - l.waiting_since >= IDLE_TIMEOUT + l.linger:
+            # a wake message can be lost, check the slot once before giving up
+            if not inbox == None:
+                l.offer(get_slot(l.uuid))
+            if l.item == None:
+                cyc_root_log.info('## No new Job handed to slot within ' + str(IDLE_TIMEOUT + l.linger) + ' seconds, closing it')
+                linger.release(l.uuid)
+                l.closed = True
+
+
+def run_job(l):
+    """Run the job claimed by a lane and hand the lane back to the state machine for the next one"""
+
+    item = l.item
+    JobName = item['id']['S']
+    JobQueue = item['JobQueue']['S']
+    command = item['command']['S']
+    token = item['Callback']['S']
+
+    if not l.beat == None and not l.beat.lease == None:
+        # take the job off the definition queue now that it runs here, if the lease was lost another worker has it
+        try:
+            sqs_main.delete_message(QueueUrl=l.beat.lease['QueueUrl'], ReceiptHandle=l.beat.lease['ReceiptHandle'])
+            l.beat.lease = None
+        except Exception as e:
+            cyc_root_log.error('## LOST LEASE ON PREFETCHED JOB, NOT RUNNING IT: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            try:
+                sf.send_task_success(
+                    taskToken=token,
+                    output=json.dumps({"sqs_name": jobDefinition,
+                                            "uuid": l.uuid,
+                                            "Callback": 'null',
+                                            "LeaveRunning": 'True',
+                                            "Output": 'null',
+                                            "Status": 'LeaseLost',
+                                            "id": str(JobName),
+                                            "table": table
+                                            })
+                )
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO NOTIFY SF THAT LEASE WAS LOST: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                l.closed = True
+            l.JobName = JobName
+            l.linger = LINGER_MIN
+            l.release()
+            return
+
+    bundle = None
+    if not item.get('Bundle', {'S': 'null'})['S'] == 'null':
+        bundle = json.loads(item['Bundle']['S'])
+
+    #run a new job found
+    names = {'#attr1': 'Status', '#attr3': 'CurrentTime', '#attr4': 'Leased'}
+    values = {':p': {'S': 'Running'}, ':q': {'S': datetime.now().isoformat()}, ':r': {'S': 'False'}}
+    expression = "set #attr1 = :p, #attr3 = :q, #attr4 = :r"
+    if not bundle == None:
+        names['#attr5'] = 'BundleResults'
+        values[':b'] = {'S': json.dumps(bundle_progress(bundle, []))}
+        expression = expression + ", #attr5 = :b"
+    update1 = dynamo.update_item(
+        TableName=table,
+        Key={'uuid': {'S': l.uuid}},
+        UpdateExpression=expression,
+        ExpressionAttributeNames=names,
+        ExpressionAttributeValues=values,
+        ReturnValues="UPDATED_NEW"
+        )
+    
+    now = datetime.now()
+    cyc_root_log.info('## RUNNING JOB: ' + now.isoformat())
+
+    l.JobName = JobName
+    if not l.beat == None:
+        l.beat.job_running = True
+
+    startup.first_job(JobName, JobQueue)
+
+    if bundle == None:
+        result, status = do_work(command, log_push, stack_name, JobName, jobDefinition, JobQueue, l.beat, item.get('Walltime', {'S': 'null'})['S'])
+
+        if not l.beat == None and not l.beat.sampler == None:
+            # last numbers of the job with its peaks, the next sample would find the process gone
+            heartbeats.send_metrics([l.beat], final=True)
+
+        # do_work only keeps the last lines of output
+        output = result
+    else:
+        status, output, results = run_bundle(l, bundle)
+
+    names = {'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'CurrentTime'}
+    values = {':p': {'S': str(status)}, ':r': {'S': str(output)}, ':q': {'S': datetime.now().isoformat()}}
+    expression = "set #attr1 = :p, #attr2 = :r, #attr3 = :q"
+    if not bundle == None:
+        names['#attr5'] = 'BundleResults'
+        values[':b'] = {'S': json.dumps(results)}
+        expression = expression + ", #attr5 = :b"
+    try: 
+        update1 = dynamo.update_item(
+                    TableName=table,
+                    Key={'uuid': {'S': l.uuid}},
+                    UpdateExpression=expression,
+                    ExpressionAttributeNames=names,
+                    ExpressionAttributeValues=values,
+                    ReturnValues="UPDATED_NEW"
+                    )
+    except Exception as e:
+        cyc_root_log.error('## COULD NOT UPDATE DYNAMODB WITH JOB STATUS AND RESULTS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        l.release()
+        l.closed = True
+        return
+
+    cyc_root_log.info('## MARKED JOB AS FINISHED IN DYNAMODB' + ' -- ' + datetime.now().isoformat())
+    
+    # Signal termination of heartbeat
+    l.release()
+
+    # an interrupted worker closes the lane, the state machine cleans up instead of waiting for a heartbeat timeout
+    LeaveRunning = 'False' if status == 'Interrupted' else 'True'
+    if LeaveRunning == 'False':
+        l.closed = True
+    else:
+        l.linger = linger.hold(l.uuid)
+
+    try:
+        response = sf.send_task_success(
+            taskToken=token,
+            output=json.dumps({"sqs_name": jobDefinition,
+                                    "uuid": l.uuid,
+                                    "Callback": 'null',
+                                    "LeaveRunning": LeaveRunning,
+                                    "Output": str(output),
+                                    "Status": str(status),
+                                    "id": str(JobName),
+                                    "table": table,
+                                    "linger_seconds": str(l.linger)
+                                    })
+        )
+        cyc_root_log.info('## NOTIFIED SF THAT JOB FINISHED' + ' -- ' + datetime.now().isoformat())
+    except Exception as e:
+        cyc_root_log.error('## FAILED TO NOTIFY SF THAT JOB IS FINISHED: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        linger.release(l.uuid)
+        l.closed = True
+
+
+def clip_output(output, limit):
+    """End of output that encodes to at most limit bytes"""
+    if limit <= 0:
+        return ''
+    output = output[-limit:]
+    while len(output) > 0 and len(json.dumps(output)) > limit:
+        output = output[len(output) // 2:]
+    return output
+
+
+def bundle_progress(bundle, results):
+    """BundleResults while a bundle runs: the results so far, the next job Running and the rest Starting.
+    If the bundle fails the async stream lambda keeps the results, fails the running job and queues the unstarted ones again"""
+    progress = list(results)
+    for n, job in enumerate(bundle[len(results):]):
+        progress.append({'id': job['job_id'], 'JobQueue': job['queue'], 'Status': 'Running' if n == 0 else 'Starting', 'Output': 'null'})
+    return progress
+
+
+def run_bundle(l, bundle):
+    """Run the jobs of a bundle one after the other, each job keeps its own status and output tail for the queue table"""
+    # every job gets an equal share of the item for its output tail
+    output_bytes = max(0, BUNDLE_RESULTS_BYTES // len(bundle) - 200)
+    results = []
+    for job in bundle:
+        if interrupted.is_set():
+            results.append({'id': job['job_id'], 'JobQueue': job['queue'], 'Status': 'Interrupted', 'Output': 'null'})
+            continue
+        if len(results) > 0:
+            # the first job was marked Running with the bundle itself
+            try:
+                dynamo.update_item(
+                    TableName=table,
+                    Key={'uuid': {'S': l.uuid}},
+                    UpdateExpression="set #attr5 = :b",
+                    ExpressionAttributeNames={'#attr5': 'BundleResults'},
+                    ExpressionAttributeValues={':b': {'S': json.dumps(bundle_progress(bundle, results))}},
+                    ReturnValues="UPDATED_NEW"
+                    )
+            except Exception as e:
+                cyc_root_log.error('## COULD NOT UPDATE DYNAMODB WITH BUNDLE PROGRESS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+        if not l.beat == None:
+            l.beat.JobName = job['job_id']
+            l.beat.JobQueue = job['queue']
+            l.beat.cancelled = False
+        result, status = do_work(job['commands'], log_push, stack_name, job['job_id'], jobDefinition, job['queue'], l.beat, job.get('walltime', 'null'))
+        if not l.beat == None and not l.beat.sampler == None:
+            heartbeats.send_metrics([l.beat], final=True)
+        results.append({'id': job['job_id'], 'JobQueue': job['queue'], 'Status': status, 'Output': clip_output(str(result[-BUNDLE_TAIL_LINES:]), output_bytes)})
+
+    # the bundle itself succeeded once every job has a result, failed jobs are retried one by one from the queue table
+    status = 'Successful'
+    if any(r['Status'] == 'Interrupted' for r in results):
+        status = 'Interrupted'
+    output = [r['id'] + ': ' + r['Status'] for r in results]
+    return status, output, results
+
+
+def close_lane(l, status='null'):
+    """Tell the state machine the lane is done (LeaveRunning False), a claimed job is first marked with status so it is queued again"""
+    JobName = 'null'
+    if not status == 'null':
+        JobName = l.item['id']['S']
+        try:
+            dynamo.update_item(
+                TableName=table,
+                Key={'uuid': {'S': l.uuid}},
+                UpdateExpression="set #attr1 = :p, #attr3 = :q",
+                ExpressionAttributeNames={'#attr1': 'Status', '#attr3': 'CurrentTime'},
+                ExpressionAttributeValues={':p': {'S': status}, ':q': {'S': datetime.now().isoformat()}},
+                ReturnValues="UPDATED_NEW"
+                )
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT UPDATE DYNAMODB WITH JOB STATUS: ' + str(e) + ' -- ' + datetime.now().isoformat())
+    try:
+        response = sf.send_task_success(
+            taskToken=l.item['Callback']['S'],
+            output=json.dumps({"sqs_name": jobDefinition,
+                                "uuid": l.uuid,
+                                "Callback": 'null',
+                                "LeaveRunning": 'False',
+                                "Output": 'null',
+                                "Status": status,
+                                "id": JobName,
+                                "table": table
+                                })
+        )
+    except Exception as e:
+        cyc_root_log.error('## FAILED TO NOTIFY SF THAT LANE IS CLOSING: ' + str(e) + ' -- ' + datetime.now().isoformat())
+    if not l.beat == None and not l.beat.lease == None:
+        # a prefetched job that never started goes back to its queue now instead of when the lease runs out
+        lease = l.beat.lease
+        l.beat.lease = None
+        heartbeats.unregister(l.beat)
+        try:
+            sqs_main.change_message_visibility(QueueUrl=lease['QueueUrl'], ReceiptHandle=lease['ReceiptHandle'], VisibilityTimeout=0)
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO RELEASE LEASE ON JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+    linger.release(l.uuid)
+    l.release()
+    l.closed = True
+
+
+def run_slot(slot_index, info, mem_info, cpu_count, channel, router):
+    """Runs the jobs handed to the slot one after the other, with prefetch the lanes of the slot claim the next jobs while one runs"""
+
+    inbox = queue.Queue() if not router == None else None
+    notify_url = channel.url if not channel == None else 'null'
+
+    lanes = []
+    for lane_index in range(1 + max(0, PREFETCH)):
+        l = lane(slot_index, lane_index)
+        if not router == None:
+            router.register(l.uuid, inbox)
+        startup.timed('register_slot', l.register, info, mem_info, cpu_count)
+        startup.timed('start_execution', l.start, notify_url)
+        lanes.append(l)
+
+    # start loop through jobs
+    while True:
+        open_lanes = [l for l in lanes if not l.closed]
+        if len(open_lanes) == 0:
+            break
+
+        if interrupted.is_set():
+            # claimed jobs that have not started go back to the queue, lanes still waiting just close
+            for l in open_lanes:
+                if not l.item == None and l.item['LeaveRunning']['S'] == 'True':
+                    close_lane(l, 'Interrupted')
+                elif not l.item == None:
+                    close_lane(l)
+                else:
+                    l.closed = True
+            continue
+
+        ready = sorted([l for l in open_lanes if not l.item == None], key=lambda l: l.claimed_at)
+        collect_handoffs(lanes, inbox, block=len(ready) == 0)
+        ready = sorted([l for l in open_lanes if not l.item == None and not l.closed], key=lambda l: l.claimed_at)
+        if len(ready) == 0:
+            continue
+
+        # run jobs in the order they were claimed
+        l = ready[0]
+        if not l.item['LeaveRunning']['S'] == 'True':
+            cyc_root_log.info('## LeaveRunning set to False by State Machine, exiting')
+            close_lane(l)
+            continue
+
+        run_job(l)
+
+    for l in lanes:
+        linger.release(l.uuid)
+        l.release()
+        if not router == None:
+            router.unregister(l.uuid)
+
+
+def run_slots():
+    """State machine mode: register the slots in the async table and run them until they close"""
+
+    # the cpu info lookup and the wake queue creation do not depend on each other
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        info_future = pool.submit(startup.timed, 'cpu_info', cached_cpu_info)
+        channel_future = pool.submit(startup.timed, 'open_channel', open_channel, stack_name, worker_id, region)
+        channel = channel_future.result()
+        try:
+            info = info_future.result()
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO GET CPU INFO: ' + str(e) + ' -- ' + datetime.now().isoformat())
+            info = {}
+    mem_info = psutil.virtual_memory()._asdict()
+
+    try:
+        cpu_count = str(info.get('count', '0'))
+    except Exception:
+        cpu_count = '0'
+        pass
+
+    router = None
+    if not channel == None:
+        router = dispatcher(channel)
+        threading.Thread(target=router.run, daemon=True).start()
+
+    # one thread per slot, each slot has its own async table item and state machine execution
+    threads = []
+    for slot_index in range(slots):
+        t = threading.Thread(target=run_slot, args=(slot_index, info, mem_info, cpu_count, channel, router))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    return channel, router
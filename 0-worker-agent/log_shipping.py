@@ -0,0 +1,262 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Log records of jobs and the worker to the log stream, spooled to disk while Kinesis throttles, and the stdout archive in S3
+
+import time
+from datetime import datetime
+import json
+from time import sleep
+import uuid
+import threading
+import os
+import queue
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from worker_settings import *
+
+
+class log_shipper:
+    """Ships log entries to the Kinesis log stream from a background thread so job output never waits on Kinesis.
+
+    Entries are packed into records under the Kinesis record size limit and sent with put_records, failed
+    records are retried and records that still fail are spooled to disk and replayed later.
+    """
+    # Kinesis limits: 1 MiB per record (data plus partition key), 500 records and 5 MiB per put_records call
+    MAX_RECORD_BYTES = 1000000
+    MAX_BATCH_RECORDS = 500
+    MAX_BATCH_BYTES = 5000000
+    MAX_ATTEMPTS = 5
+    QUEUE_SIZE = 10000
+
+    def __init__(self, stream_name, spool_dir):
+        self.stream_name = stream_name
+        self.spool_dir = spool_dir
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self._running = True
+        self._thread = None
+        self._spool_lock = threading.Lock()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def submit(self, entries, partition_key):
+        """Queue a list of log entries, never blocks the caller"""
+        for record in self.pack(entries, partition_key):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.spool([record])
+
+    def pack(self, entries, partition_key):
+        """Split entries into as few JSON list records as fit under the record size limit"""
+        limit = self.MAX_RECORD_BYTES - len(partition_key.encode('utf-8'))
+        records = []
+        current = []
+        size = 2
+        for entry in entries:
+            encoded = json.dumps(entry, default=str)
+            if len(encoded) + 2 > limit:
+                # a single line longer than the record limit is cut down rather than dropped
+                entry = dict(entry)
+                entry['data'] = str(entry['data'])[:limit // 2] + ' [CYCLONE: line truncated]'
+                encoded = json.dumps(entry, default=str)
+            if len(current) > 0 and size + len(encoded) + 1 > limit:
+                records.append({'PartitionKey': partition_key, 'Data': ('[' + ','.join(current) + ']').encode('utf-8')})
+                current = []
+                size = 2
+            current.append(encoded)
+            size = size + len(encoded) + 1
+        if len(current) > 0:
+            records.append({'PartitionKey': partition_key, 'Data': ('[' + ','.join(current) + ']').encode('utf-8')})
+        return records
+
+    def run(self):
+        while True:
+            batch = []
+            size = 0
+            try:
+                record = self.queue.get(timeout=1)
+                batch.append(record)
+                size = len(record['Data'])
+                while len(batch) < self.MAX_BATCH_RECORDS:
+                    record = self.queue.get_nowait()
+                    if size + len(record['Data']) > self.MAX_BATCH_BYTES:
+                        self.send([record])
+                        break
+                    batch.append(record)
+                    size = size + len(record['Data'])
+            except queue.Empty:
+                pass
+
+            if len(batch) > 0:
+                self.send(batch)
+            elif not self._running:
+                break
+            else:
+                self.replay()
+
+    def send(self, records):
+        """put_records with retry of only the failed entries, what is left after MAX_ATTEMPTS goes to the spool"""
+        attempt = 0
+        while len(records) > 0 and attempt < self.MAX_ATTEMPTS:
+            if attempt > 0:
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+            attempt = attempt + 1
+            try:
+                response = kinesis.put_records(StreamName=self.stream_name, Records=records)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO SEND LOGS PACKAGE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                continue
+            if response.get('FailedRecordCount', 0) == 0:
+                cyc_root_log.info('## SENT LOG PACKAGE: ' + datetime.now().isoformat())
+                return True
+            records = [r for r, result in zip(records, response['Records']) if 'ErrorCode' in result]
+            cyc_root_log.info('## RETRYING ' + str(len(records)) + ' LOG RECORDS: ' + datetime.now().isoformat())
+        if len(records) > 0:
+            self.spool(records)
+            return False
+        return True
+
+    def spool(self, records):
+        try:
+            with self._spool_lock:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                path = os.path.join(self.spool_dir, '%.6f-%s.jsonl' % (time.time(), uuid.uuid4().hex[:8]))
+                with open(path + '.tmp', 'w') as f:
+                    for r in records:
+                        f.write(json.dumps({'PartitionKey': r['PartitionKey'], 'Data': r['Data'].decode('utf-8')}) + '\n')
+                os.rename(path + '.tmp', path)
+            cyc_root_log.error('## SPOOLED ' + str(len(records)) + ' LOG RECORDS TO DISK: ' + path + ' -- ' + datetime.now().isoformat())
+        except Exception as e:
+            cyc_root_log.error('## FAILED TO SPOOL LOGS PACKAGE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+    def replay(self):
+        """Send spooled files oldest first, stops at the first file that can not be sent"""
+        try:
+            files = sorted(f for f in os.listdir(self.spool_dir) if f.endswith('.jsonl'))
+        except Exception:
+            return
+        for name in files:
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path) as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                os.remove(path)
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO READ LOG SPOOL FILE: ' + str(e) + ' -- ' + datetime.now().isoformat())
+                continue
+            records = [{'PartitionKey': r['PartitionKey'], 'Data': r['Data'].encode('utf-8')} for r in records]
+            for i in range(0, len(records), self.MAX_BATCH_RECORDS):
+                if not self.send(records[i:i + self.MAX_BATCH_RECORDS]):
+                    # still throttled, send() spooled what failed so leave the rest for the next round
+                    for j in range(i + self.MAX_BATCH_RECORDS, len(records), self.MAX_BATCH_RECORDS):
+                        self.spool(records[j:j + self.MAX_BATCH_RECORDS])
+                    return
+
+    def close(self):
+        """Flush what is queued, one last attempt on the spool and stop the thread"""
+        self._running = False
+        if not self._thread == None:
+            self._thread.join()
+        self.replay()
+
+
+shipper = log_shipper(stack_name + '_log_stream', SPOOL_DIR)
+
+
+def log_push(stack_name, JobName, jobDefinition, JobQueue, buffer):
+    if not ENABLE_QLOG == 'False' or ENABLE_QLOG == False:
+        # Handed to the log shipper thread, sent to kinesis log stream in main region
+        list_pack =[]
+        time_stamp = datetime.now().isoformat()
+        for line in buffer:
+            list_pack.append({'time_stamp': time_stamp, 'log_type': 'STDOUT', 'id': JobName, 'jobDefinition': jobDefinition, 'jobQueue': JobQueue, 'data': line})
+        shipper.submit(list_pack, jobDefinition)
+
+
+class stdout_archive:
+    """Writes the stdout of one job run to s3://<stack>-images-<main region>/stdout/<queue>/<id>/<start>-<worker>/. Lines are gzipped
+    in blocks and blocks are concatenated into chunk objects, index.json lists every block as [chunk, byte offset, byte length, first
+    line, lines] so a reader fetches only the blocks of the lines it wants with a ranged GET. Takes the place of log_push for the job"""
+    def __init__(self, JobName, JobQueue):
+        self.JobName = JobName
+        self.JobQueue = JobQueue
+        self.bucket = stack_name + '-images-' + main_region
+        self.prefix = 'stdout/' + JobQueue + '/' + JobName + '/' + datetime.now().strftime('%Y%m%dT%H%M%S') + '-' + worker_id + '/'
+        self.block = []
+        self.block_bytes = 0
+        self.chunk = bytearray()
+        self.chunk_number = 0
+        self.blocks = []
+        self.lines = 0
+        self.stored_bytes = 0
+        self.raw_bytes = 0
+        self.last_flush = time.perf_counter()
+        # uploads run off the thread that reads the job pipe, one at a time so the index never lists a chunk that is not there yet
+        self.uploads = ThreadPoolExecutor(max_workers=1)
+        self.closed = False
+
+    def push(self, stack_name, JobName, jobDefinition, JobQueue, buffer):
+        for line in buffer:
+            self.block.append(line)
+            self.block_bytes += len(line) + 1
+            if len(self.block) >= ARCHIVE_BLOCK_LINES or self.block_bytes >= ARCHIVE_BLOCK_BYTES:
+                self.seal()
+        if len(self.chunk) >= ARCHIVE_CHUNK_BYTES or time.perf_counter() - self.last_flush >= ARCHIVE_FLUSH_SECONDS:
+            self.flush(False)
+
+    def seal(self):
+        if len(self.block) == 0:
+            return
+        data = gzip.compress(('\n'.join(self.block) + '\n').encode('utf-8', errors='replace'), compresslevel=6)
+        self.blocks.append([self.chunk_number, len(self.chunk), len(data), self.lines, len(self.block)])
+        self.chunk += data
+        self.lines += len(self.block)
+        self.raw_bytes += self.block_bytes
+        self.block = []
+        self.block_bytes = 0
+
+    def flush(self, complete):
+        self.seal()
+        if len(self.chunk) > 0:
+            self.uploads.submit(self.put, 'chunk-%06d.gz' % self.chunk_number, bytes(self.chunk), 'application/gzip')
+            self.stored_bytes += len(self.chunk)
+            self.chunk_number += 1
+            self.chunk = bytearray()
+        index = {'lines': self.lines, 'complete': complete, 'blocks': list(self.blocks)}
+        self.uploads.submit(self.put, 'index.json', json.dumps(index).encode(), 'application/json')
+        self.last_flush = time.perf_counter()
+
+    def put(self, name, body, content_type):
+        for attempt in range(5):
+            try:
+                s3_main.put_object(Body=body, Bucket=self.bucket, Key=self.prefix + name, ContentType=content_type)
+                return
+            except Exception as e:
+                cyc_root_log.error('## FAILED TO UPLOAD STDOUT ARCHIVE ' + name + ': ' + str(e) + ' -- ' + datetime.now().isoformat())
+                sleep(2 ** attempt)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.flush(True)
+        self.uploads.shutdown(wait=True)
+        data = {'stdout_archive': 's3://' + self.bucket + '/' + self.prefix, 'stdout_archive_lines': self.lines,
+                'stdout_archive_bytes': self.raw_bytes, 'stdout_archive_stored_bytes': self.stored_bytes}
+        cyc_root_log.info('## STDOUT ARCHIVED: ' + json.dumps(data) + ' -- ' + datetime.now().isoformat())
+        if not ENABLE_QLOG == 'False' or ENABLE_QLOG == False:
+            shipper.submit([{'time_stamp': datetime.now().isoformat(), 'log_type': 'METRICS', 'id': self.JobName, 'jobDefinition': jobDefinition, 'jobQueue': self.JobQueue, 'data': data}], jobDefinition)
@@ -0,0 +1,122 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# Static array jobs: each array child runs its slice of the manifest, claims are held in the queue table
+
+import time
+from datetime import datetime
+import json
+import queue
+from worker_settings import *
+from log_shipping import log_push
+from job_monitor import heartbeat, heartbeats, interrupted, startup
+from job_runner import do_work
+from direct_mode import set_job_status
+
+
+def static_slice():
+    """Static arrays: queue and job ids of this array child's slice of the manifest"""
+    bucket, _, key = STATIC_MANIFEST.replace('s3://', '', 1).partition('/')
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    per_child = int(manifest['per_child'])
+    return manifest['queue'], manifest['ids'][ARRAY_INDEX * per_child:(ARRAY_INDEX + 1) * per_child]
+
+
+def fetch_static_jobs(JobQueue, ids):
+    """Read the jobs of a slice with BatchGetItem, 100 keys at a time, in manifest order"""
+    jobs = []
+    for i in range(0, len(ids), 100):
+        request = {JobQueue: {
+            'Keys': [{'id': {'S': job_id}} for job_id in ids[i:i + 100]],
+            'ConsistentRead': True,
+            'ProjectionExpression': '#attr1, #attr2, #attr3, #attr4, #attr5, #attr6',
+            'ExpressionAttributeNames': {'#attr1': 'id', '#attr2': 'commands', '#attr3': 'Status', '#attr4': 'RetriesAvailable', '#attr5': 'Dispatch', '#attr6': 'walltime'}
+        }}
+        attempt = 0
+        while len(request) > 0:
+            if attempt > 0:
+                time.sleep(min(0.1 * 2 ** attempt, 5))
+            attempt = attempt + 1
+            res = dynamo_main.batch_get_item(RequestItems=request)
+            jobs.extend(res['Responses'].get(JobQueue, []))
+            request = res.get('UnprocessedKeys', {})
+    order = {job_id: n for n, job_id in enumerate(ids)}
+    return sorted(jobs, key=lambda job: order[job['id']['S']])
+
+
+def claim_static_job(JobQueue, JobName):
+    """Mark a static job Running unless it was already taken or handed to the queue, the condition keeps it from running twice.
+    The claim expires after LEASE_SECONDS unless the heartbeat service renews it, the failed worker lambda requeues expired claims"""
+    try:
+        dynamo_main.update_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            UpdateExpression="set #attr1 = :p, #attr2 = :t, #attr4 = :l",
+            ConditionExpression="#attr1 = :w AND #attr3 = :d",
+            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'tRunning', '#attr3': 'Dispatch', '#attr4': 'LeaseExpires'},
+            ExpressionAttributeValues={':p': {'S': 'Running'}, ':t': {'S': datetime.now().isoformat()}, ':w': {'S': 'Waiting'}, ':d': {'S': 'static'}, ':l': {'N': str(int(time.time()) + LEASE_SECONDS)}},
+            ReturnValues="UPDATED_NEW"
+            )
+        return True
+    except dynamo_main.exceptions.ConditionalCheckFailedException:
+        return False
+
+
+def release_static_job(JobQueue, JobName):
+    """Hand a static job that was not started to the dynamic queue path, the dynamo stream sends it to SQS"""
+    try:
+        dynamo_main.update_item(
+            TableName=JobQueue,
+            Key={'id': {'S': JobName}},
+            UpdateExpression="set #attr3 = :d",
+            ConditionExpression="#attr1 = :w AND #attr3 = :s",
+            ExpressionAttributeNames={'#attr1': 'Status', '#attr3': 'Dispatch'},
+            ExpressionAttributeValues={':d': {'S': 'dynamic'}, ':w': {'S': 'Waiting'}, ':s': {'S': 'static'}},
+            ReturnValues="UPDATED_NEW"
+            )
+    except dynamo_main.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as e:
+        cyc_root_log.error('## COULD NOT RELEASE STATIC JOB: ' + str(e) + ' -- ' + datetime.now().isoformat())
+
+
+def run_static_slot(slot_index, JobQueue, jobs):
+    """Static arrays: run jobs of the slice shared by the slots of this worker, no SQS or state machine in the path"""
+    while True:
+        try:
+            job = jobs.get_nowait()
+        except queue.Empty:
+            return
+        JobName = job['id']['S']
+        if interrupted.is_set():
+            release_static_job(JobQueue, JobName)
+            continue
+        if not job['Status']['S'] == 'Waiting' or not claim_static_job(JobQueue, JobName):
+            continue
+
+        beat = heartbeat(None, JobName, JobQueue)
+        beat.job_running = True
+        beat.claim = 'static'
+        heartbeats.register(beat)
+        startup.first_job(JobName, JobQueue)
+
+        result, status = do_work(job['commands']['S'], log_push, stack_name, JobName, jobDefinition, JobQueue, beat, list(job.get('walltime', {'S': 'null'}).values())[0])
+
+        if not beat.sampler == None:
+            heartbeats.send_metrics([beat], final=True)
+        heartbeats.unregister(beat)
+        try:
+            set_job_status(JobQueue, JobName, status, result, int(job['RetriesAvailable']['N']))
+        except Exception as e:
+            cyc_root_log.error('## COULD NOT UPDATE QUEUE TABLE WITH JOB STATUS AND RESULTS: ' + str(e) + ' -- ' + datetime.now().isoformat())
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import importlib
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+AGENT = os.path.join(HERE, '..')
+REPO = os.path.join(HERE, '..', '..')
+sys.path.insert(0, AGENT)
+
+# the worker parses its arguments on import
+sys.argv = ['batch_processor.py', '--sf_arn', 'arn:aws:states:us-east-1:000000000000:stateMachine:test', '--async_table', 'test-async',
+            '--sqs_job_definition', 'test-definition', '--region', 'us-east-1', '--main_region', 'us-east-1', '--stack_name', 'test', '--slots', '1']
+os.environ.setdefault('CYCLONE_SPOOL_DIR', '/tmp/cyclone-test-spool')
+# local stand-ins for S3, the spot endpoint and the wake queue
+STAGE_ROOT = os.environ.setdefault('CYCLONE_STAGE_LOCAL_ROOT', tempfile.mkdtemp(prefix='cyclone-stage-'))
+os.environ.setdefault('CYCLONE_SPOT_ENDPOINT', 'off')
+os.environ.setdefault('CYCLONE_HANDOFF', 'local')
+os.environ.setdefault('MAIN_REGION', 'us-east-1')
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def load(name, path):
+    """Load a module from a file once, the lambdas have dashes in their file names"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def worker():
+    return load('batch_processor', os.path.join(AGENT, 'batch_processor.py'))
+
+
+def agent(name):
+    """One of the modules next to batch_processor.py, loaded the way the worker loads them"""
+    worker()
+    return importlib.import_module(name)
+
+
+def lambda_module(directory, file_name):
+    return load(file_name.replace('-', '_')[:-3], os.path.join(REPO, directory, file_name))
@@ -0,0 +1,146 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+import loader
+
+log_shipping = loader.agent('log_shipping')
+api = loader.lambda_module('1-api-handler-lambda', 'api-handler-lambda.py')
+
+
+class memory_s3:
+    """Objects kept in a dict, enough of the S3 client for the archive writer and reader"""
+    def __init__(self):
+        self.objects = {}
+        self.gets = []
+
+    def put_object(self, Body, Bucket, Key, ContentType=None):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.gets.append(Key)
+        body = self.objects[(Bucket, Key)]
+        if not Range == None:
+            first, last = Range[len('bytes='):].split('-')
+            body = body[int(first):int(last) + 1]
+        return {'Body': io.BytesIO(body)}
+
+    def get_paginator(self, name):
+        s3 = self
+
+        class paginator:
+            def paginate(self, Bucket, Prefix):
+                yield {'Contents': [{'Key': key} for bucket, key in sorted(s3.objects) if bucket == Bucket and key.startswith(Prefix)]}
+        return paginator()
+
+
+class ArchiveLinesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.s3 = memory_s3()
+        for module, name, value in ((log_shipping, 's3_main', self.s3), (log_shipping, 'shipper', mock.MagicMock()),
+                                    (log_shipping, 'ARCHIVE_BLOCK_LINES', 10), (log_shipping, 'ARCHIVE_CHUNK_BYTES', 200)):
+            patcher = mock.patch.object(module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def archive(self, lines, JobName='job-1'):
+        archive = log_shipping.stdout_archive(JobName, 'queue-1')
+        for i in range(0, len(lines), 7):
+            archive.push('test', JobName, 'test-definition', 'queue-1', lines[i:i + 7])
+        archive.close()
+        return archive
+
+    def read(self, start=0, count=100, tail=False, JobName='job-1'):
+        self.s3.gets = []
+        return api.read_archive_lines(self.s3, 'test-images-us-east-1', 'queue-1', JobName, start, count, tail)
+
+    def chunks_read(self):
+        return [key for key in self.s3.gets if not key.endswith('index.json')]
+
+    def blocks_holding(self, archive, start, end):
+        return [b for b in archive.blocks if b[3] + b[4] > start and b[3] < end]
+
+    def test_range_reads_only_the_blocks_holding_it(self):
+        lines = ['line ' + str(i) for i in range(100)]
+        archive = self.archive(lines)
+        self.assertGreater(archive.chunk_number, 1)
+
+        res = self.read(start=25, count=12)
+
+        self.assertEqual(res['lines'], lines[25:37])
+        self.assertEqual((res['start'], res['end'], res['next_start'], res['total_lines'], res['complete']), (25, 37, 37, 100, True))
+        self.assertEqual(len(self.chunks_read()), len(self.blocks_holding(archive, 25, 37)))
+        self.assertLess(len(self.chunks_read()), len(archive.blocks))
+
+    def test_tail_returns_the_last_lines(self):
+        lines = ['line ' + str(i) for i in range(95)]
+        archive = self.archive(lines)
+
+        res = self.read(count=15, tail=True)
+
+        self.assertEqual(res['lines'], lines[80:])
+        self.assertEqual((res['start'], res['end'], res['next_start']), (80, 95, None))
+        self.assertEqual(len(self.chunks_read()), len(self.blocks_holding(archive, 80, 95)))
+        self.assertLess(len(self.chunks_read()), len(archive.blocks))
+
+    def test_range_past_the_end_is_clipped(self):
+        lines = ['line ' + str(i) for i in range(30)]
+        self.archive(lines)
+
+        self.assertEqual(self.read(start=25, count=100)['lines'], lines[25:])
+        res = self.read(start=40, count=10)
+        self.assertEqual((res['lines'], res['start'], res['end'], res['next_start']), ([], 40, 40, None))
+        self.assertEqual(self.read(count=100, tail=True)['lines'], lines)
+
+    def test_latest_run_is_read(self):
+        self.archive(['first run'])
+        with mock.patch.object(log_shipping, 'datetime') as clock:
+            clock.now.return_value.strftime.return_value = '99991231T235959'
+            clock.now.return_value.isoformat.return_value = ''
+            self.archive(['second run'])
+
+        res = self.read()
+
+        self.assertEqual(res['lines'], ['second run'])
+        self.assertIn('/99991231T235959-', res['archive'])
+
+    def test_job_without_an_archive(self):
+        with self.assertRaises(ValueError):
+            self.read(JobName='job-none')
+
+    def test_byte_cap_stops_the_range_and_pages_on(self):
+        lines = ['x' * 100 + str(i).zfill(2) for i in range(40)]
+        self.archive(lines)
+        line_size = len(json.dumps(lines[0])) + 2
+
+        with mock.patch.object(api, 'MAX_ARCHIVE_BYTES', line_size * 12 + 1):
+            res = self.read(start=5, count=30)
+            self.assertEqual(res['lines'], lines[5:17])
+            self.assertEqual((res['start'], res['end'], res['next_start']), (5, 17, 17))
+
+            res = self.read(count=30, tail=True)
+            self.assertEqual(res['lines'], lines[28:])
+            self.assertEqual((res['start'], res['end'], res['next_start']), (28, 40, None))
+
+    def test_single_line_over_the_cap_is_cut(self):
+        self.archive(['short', 'y' * 1000, 'short'])
+
+        with mock.patch.object(api, 'MAX_ARCHIVE_BYTES', 600):
+            res = self.read(start=1, count=2)
+
+        self.assertEqual(res['lines'], ['y' * 100])
+        self.assertEqual((res['start'], res['end'], res['next_start']), (1, 2, 2))
+
+    def test_count_is_capped(self):
+        self.archive(['line ' + str(i) for i in range(30)])
+
+        with mock.patch.object(api, 'MAX_ARCHIVE_LINES', 4):
+            res = self.read(start=3, count=100)
+
+        self.assertEqual((res['start'], res['end']), (3, 7))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import unittest
+from unittest import mock
+
+import loader
+
+lanes = loader.agent('lanes')
+get_start_delete = loader.lambda_module('4-get-start-delete-lambda', 'get-start-delete-lambda.py')
+async_stream = loader.lambda_module('5-async-stream-lambda', 'async-stream-lambda.py')
+
+
+def bundle(count):
+    return [{'job_id': 'job-' + str(n), 'queue': 'queue-1', 'commands': 'echo ' + str(n)} for n in range(count)]
+
+
+class RunBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = mock.MagicMock()
+        patches = [
+            mock.patch.object(lanes, 'dynamo', self.dynamo),
+            mock.patch.object(lanes, 'heartbeats'),
+            mock.patch.object(lanes, 'do_work'),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(lanes.interrupted.clear)
+        self.lane = lanes.lane(0, 0)
+
+    def test_clip_output_keeps_the_end_within_limit(self):
+        output = 'first line\n' + 'x' * 500 + '\nlast line "quoted"'
+        clipped = lanes.clip_output(output, 100)
+        self.assertLessEqual(len(json.dumps(clipped)), 100)
+        self.assertTrue(clipped.endswith('last line "quoted"'))
+        self.assertEqual(lanes.clip_output('short', 100), 'short')
+        self.assertEqual(lanes.clip_output('anything', 0), '')
+
+    def test_each_job_keeps_its_own_result(self):
+        lanes.do_work.side_effect = [(['ok'], 'Successful'), (['boom'], 'JobFailed'), (['y' * 100000], 'Successful')]
+
+        status, output, results = lanes.run_bundle(self.lane, bundle(3))
+
+        self.assertEqual(status, 'Successful')
+        self.assertEqual(output, ['job-0: Successful', 'job-1: JobFailed', 'job-2: Successful'])
+        self.assertEqual([r['Status'] for r in results], ['Successful', 'JobFailed', 'Successful'])
+        self.assertLessEqual(len(json.dumps(results)), lanes.BUNDLE_RESULTS_BYTES)
+
+    def test_progress_is_written_before_each_later_job(self):
+        lanes.do_work.return_value = (['ok'], 'Successful')
+
+        lanes.run_bundle(self.lane, bundle(3))
+
+        writes = [json.loads(c.kwargs['ExpressionAttributeValues'][':b']['S']) for c in self.dynamo.update_item.call_args_list]
+        self.assertEqual([[e['Status'] for e in w] for w in writes], [['Successful', 'Running', 'Starting'], ['Successful', 'Successful', 'Running']])
+
+    def test_interrupted_bundle_leaves_the_rest(self):
+        def work(*args):
+            lanes.interrupted.set()
+            return ['ok'], 'Successful'
+        lanes.do_work.side_effect = work
+
+        status, output, results = lanes.run_bundle(self.lane, bundle(3))
+
+        self.assertEqual(status, 'Interrupted')
+        self.assertEqual([r['Status'] for r in results], ['Successful', 'Interrupted', 'Interrupted'])
+        self.assertEqual(lanes.do_work.call_count, 1)
+
+
+class GetBundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sqs = mock.MagicMock()
+        patch = mock.patch.object(get_start_delete, 'SQS', self.sqs)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.event = {'queue_url': 'url', 'Input': {}}
+
+    def test_get_bundle_stops_at_empty_receive(self):
+        self.sqs.receive_message.side_effect = [{'Messages': [{'ReceiptHandle': str(n)} for n in range(10)]}, {'Messages': [{'ReceiptHandle': 'a'}]}, {}]
+
+        messages = get_start_delete.get_bundle(self.event, 25)
+
+        self.assertEqual(len(messages), 11)
+        self.assertEqual([c.kwargs['MaxNumberOfMessages'] for c in self.sqs.receive_message.call_args_list], [10, 10, 10])
+        for c in self.sqs.receive_message.call_args_list:
+            self.assertEqual(c.kwargs['VisibilityTimeout'], get_start_delete.BUNDLE_CLAIM_SECONDS)
+
+    def test_release_bundle_returns_messages_in_batches(self):
+        self.sqs.change_message_visibility_batch.return_value = {}
+
+        get_start_delete.release_bundle(self.event, [{'ReceiptHandle': str(n)} for n in range(23)])
+
+        batches = [c.kwargs['Entries'] for c in self.sqs.change_message_visibility_batch.call_args_list]
+        self.assertEqual([len(b) for b in batches], [10, 10, 3])
+        self.assertTrue(all(e['VisibilityTimeout'] == 0 for b in batches for e in b))
+
+    def test_bundle_starts_with_every_job_unstarted(self):
+        dynamo = mock.MagicMock()
+        event = {'Input': {'table': 'async', 'uuid': 'u', 'LeaveRunning': 'True'}, 'TaskToken': 't', 'job_details': bundle(1)[0], 'bundle': bundle(3)}
+        with mock.patch.object(get_start_delete, 'dynamo', dynamo), mock.patch.object(get_start_delete, 'notify_worker'):
+            get_start_delete.grid_start_job(event)
+
+        results = json.loads(dynamo.update_item.call_args.kwargs['ExpressionAttributeValues'][':n']['S'])
+        self.assertEqual([r['Status'] for r in results], ['Starting', 'Starting', 'Starting'])
+
+
+class BundleResultsTest(unittest.TestCase):
+
+    def record(self, status, entries):
+        image = {'id': {'S': 'job-0'}, 'Status': {'S': status}, 'Output': {'S': 'null'}, 'JobQueue': {'S': 'queue-1'}, 'CurrentTime': {'S': 'now'},
+                 'BundleResults': {'S': json.dumps([{'id': 'job-' + str(n), 'JobQueue': 'queue-1', 'Status': s, 'Output': 'null'} for n, s in enumerate(entries)])}}
+        return {'Records': [{'eventName': 'MODIFY', 'dynamodb': {'NewImage': image}}]}
+
+    def updates(self, status, entries):
+        with mock.patch.object(async_stream, 'update_job') as update_job, mock.patch.object(async_stream.boto3, 'client'):
+            async_stream.lambda_handler(self.record(status, entries), None)
+        return [(c.args[1], c.args[2]) for c in update_job.call_args_list]
+
+    def test_failed_bundle_requeues_unstarted_jobs(self):
+        self.assertEqual(self.updates('Failed', ['Successful', 'Running', 'Starting']),
+                         [('job-0', 'Successful'), ('job-1', 'Failed'), ('job-2', 'Interrupted')])
+
+    def test_progress_only_marks_the_running_job(self):
+        self.assertEqual(self.updates('Running', ['Successful', 'Running', 'Starting']), [('job-1', 'Running')])
+        self.assertEqual(self.updates('Starting', ['Starting', 'Starting']), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import loader
+from test_walltime import wait_gone
+
+job_monitor = loader.agent('job_monitor')
+job_runner = loader.agent('job_runner')
+
+
+class CheckCancelledTest(unittest.TestCase):
+
+    def beat(self, JobName, JobQueue='queue-1'):
+        beat = job_monitor.heartbeat('token', JobName, JobQueue)
+        beat.job_running = True
+        return beat
+
+    def test_jobs_missing_from_their_queue_table_are_cancelled(self):
+        kept, deleted, other_queue = self.beat('job-1'), self.beat('job-2'), self.beat('job-1', 'queue-2')
+        dynamo_main = mock.MagicMock()
+        dynamo_main.batch_get_item.return_value = {'Responses': {'queue-1': [{'id': {'S': 'job-1'}}]},
+                                                   'UnprocessedKeys': {'queue-2': {'Keys': [{'id': {'S': 'job-1'}}]}}}
+
+        with mock.patch.object(job_monitor, 'dynamo_main', dynamo_main):
+            job_monitor.heartbeats.check_cancelled([kept, deleted, other_queue])
+
+        self.assertFalse(kept.cancelled)
+        self.assertTrue(deleted.cancelled)
+        # keys dynamodb did not get to are not taken as deleted
+        self.assertFalse(other_queue.cancelled)
+        request = dynamo_main.batch_get_item.call_args.kwargs['RequestItems']
+        self.assertEqual(sorted(key['id']['S'] for key in request['queue-1']['Keys']), ['job-1', 'job-2'])
+
+    def test_failed_check_cancels_nothing(self):
+        beat = self.beat('job-1')
+        dynamo_main = mock.MagicMock()
+        dynamo_main.batch_get_item.side_effect = Exception('throttled')
+
+        with mock.patch.object(job_monitor, 'dynamo_main', dynamo_main):
+            job_monitor.heartbeats.check_cancelled([beat])
+
+        self.assertFalse(beat.cancelled)
+
+    def test_bundle_beat_that_moved_on_is_not_cancelled(self):
+        beat = self.beat('job-1')
+        dynamo_main = mock.MagicMock()
+
+        def moved_on(RequestItems):
+            beat.JobName = 'job-2'
+            return {'Responses': {'queue-1': []}}
+        dynamo_main.batch_get_item.side_effect = moved_on
+
+        with mock.patch.object(job_monitor, 'dynamo_main', dynamo_main):
+            job_monitor.heartbeats.check_cancelled([beat])
+
+        self.assertFalse(beat.cancelled)
+
+
+class CancelledJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = mock.patch.object(job_runner, 'STDOUT_ARCHIVE', 'False')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cancelled_job_group_is_killed_at_once(self):
+        pid_file = os.path.join(self.directory.name, 'child.pid')
+        # SIGTERM is ignored, only the SIGKILL of the cancel stops the job
+        cmd = 'trap "" TERM; echo started; sleep 30 & echo $! > ' + pid_file + '; wait'
+        beat = job_monitor.heartbeat('token', 'job-1', 'queue-1')
+        timer = threading.Timer(1, lambda: setattr(beat, 'cancelled', True))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        started = time.time()
+        tail, status = job_runner.do_work(cmd, lambda *args: None, 'test', 'job-1', 'test-definition', 'queue-1', beat)
+
+        self.assertEqual(status, 'Cancelled')
+        self.assertLess(time.time() - started, 10)
+        self.assertIn('started', tail)
+        self.assertIn('deleted from its queue', tail[-1])
+        with open(pid_file) as f:
+            self.assertTrue(wait_gone(int(f.read())))
+
+
+if __name__ == '__main__':
+    unittest.main()
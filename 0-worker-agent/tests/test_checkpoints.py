@@ -0,0 +1,120 @@
+import os
+import uuid
+import tempfile
+import unittest
+from unittest import mock
+
+import loader
+
+checkpoints = loader.agent('checkpoints')
+
+
+class CheckpointDirectiveTest(unittest.TestCase):
+
+    def test_directive_with_and_without_a_directory(self):
+        self.assertEqual(checkpoints.checkpoint_directive('#HYPER -q queue\n#HYPER -k state\npython run.py'), 'state')
+        self.assertEqual(checkpoints.checkpoint_directive('#HYPER -k\npython run.py'), '')
+        self.assertEqual(checkpoints.checkpoint_directive('python run.py -k state'), None)
+
+
+class JobCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.JobName = 'job-' + uuid.uuid4().hex
+        self.path = os.path.join(self.directory.name, 'state')
+        os.makedirs(self.path)
+        patcher = mock.patch.object(checkpoints, 'shipper')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def remote(self, name):
+        return os.path.join(loader.STAGE_ROOT, 'test-worker-us-east-1', 'checkpoints', 'queue-1', self.JobName, name)
+
+    def write(self, root, name, body):
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(body)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_sync_uploads_only_changed_files_and_deletes_removed_ones(self):
+        checkpoint = checkpoints.job_checkpoint(self.path, self.JobName, 'queue-1')
+        self.write(self.path, 'a.dat', 'first')
+        self.write(self.path, 'sub/b.dat', 'second')
+
+        checkpoint.sync()
+
+        self.assertEqual(self.read(self.remote('a.dat')), 'first')
+        self.assertEqual(self.read(self.remote('sub/b.dat')), 'second')
+
+        self.write(self.path, 'sub/b.dat', 'second, longer')
+        self.write(self.path, 'c.dat', 'third')
+        os.remove(os.path.join(self.path, 'a.dat'))
+        with mock.patch.object(checkpoints, 'transfer_file', wraps=checkpoints.transfer_file) as transfer:
+            checkpoint.sync()
+            self.assertEqual(sorted(c.args[0] for c in transfer.call_args_list), [checkpoint.remote + 'c.dat', checkpoint.remote + 'sub/b.dat'])
+
+        self.assertFalse(os.path.exists(self.remote('a.dat')))
+        self.assertEqual(self.read(self.remote('sub/b.dat')), 'second, longer')
+        self.assertEqual(self.read(self.remote('c.dat')), 'third')
+
+        with mock.patch.object(checkpoints, 'transfer_file') as transfer:
+            checkpoint.sync()
+            transfer.assert_not_called()
+
+    def test_restore_brings_back_the_last_sync_of_an_earlier_attempt(self):
+        first = checkpoints.job_checkpoint(self.path, self.JobName, 'queue-1')
+        self.write(self.path, 'a.dat', 'first')
+        self.write(self.path, 'sub/b.dat', 'second')
+        first.stop(sync=True)
+
+        retry_path = os.path.join(self.directory.name, 'retry')
+        retry = checkpoints.job_checkpoint(retry_path, self.JobName, 'queue-1')
+        retry.restore()
+
+        self.assertEqual(self.read(os.path.join(retry_path, 'a.dat')), 'first')
+        self.assertEqual(self.read(os.path.join(retry_path, 'sub', 'b.dat')), 'second')
+        # restored files are already in the bucket and are not uploaded again
+        with mock.patch.object(checkpoints, 'transfer_file') as transfer:
+            retry.sync()
+            transfer.assert_not_called()
+
+    def test_restore_without_an_earlier_attempt_starts_empty(self):
+        checkpoint = checkpoints.job_checkpoint(os.path.join(self.directory.name, 'fresh'), self.JobName, 'queue-1')
+
+        checkpoint.restore()
+
+        self.assertEqual(os.listdir(checkpoint.path), [])
+
+    def test_discard_deletes_the_synced_files(self):
+        checkpoint = checkpoints.job_checkpoint(self.path, self.JobName, 'queue-1')
+        self.write(self.path, 'a.dat', 'first')
+        checkpoint.sync()
+
+        checkpoint.discard()
+
+        self.assertFalse(os.path.exists(self.remote('a.dat')))
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'a.dat')))
+
+    def test_owned_directory_is_removed_on_stop(self):
+        cwd = os.getcwd()
+        os.chdir(self.directory.name)
+        self.addCleanup(os.chdir, cwd)
+        checkpoint = checkpoints.job_checkpoint('', self.JobName, 'queue-1')
+        self.assertEqual(checkpoint.path, os.path.join(os.path.realpath(self.directory.name), 'cyclone-checkpoints', self.JobName))
+        checkpoint.restore()
+        self.write(checkpoint.path, 'a.dat', 'first')
+
+        checkpoint.stop(sync=True)
+
+        self.assertFalse(os.path.exists(checkpoint.path))
+        self.assertEqual(self.read(self.remote('a.dat')), 'first')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import loader
+
+job_runner = loader.agent('job_runner')
+
+
+class CpuPinnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.lock_dir.cleanup)
+
+    def pinner(self, job_vcpus, cores=(0, 1, 2, 3)):
+        with mock.patch.object(job_runner.os, 'sched_getaffinity', return_value=set(cores)):
+            return job_runner.cpu_pinner(True, self.lock_dir.name, job_vcpus)
+
+    def test_claims_distinct_free_cores(self):
+        pinner = self.pinner(2)
+        first = pinner.claim()
+        second = pinner.claim()
+        self.addCleanup(pinner.release, first + second)
+
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 2)
+        self.assertEqual(set(core for core, _ in first) | set(core for core, _ in second), {0, 1, 2, 3})
+        self.assertEqual(pinner.claim(), [])
+
+    def test_released_cores_can_be_claimed_again(self):
+        pinner = self.pinner(3)
+        held = pinner.claim()
+        self.assertEqual(pinner.claim(), [])
+        pinner.release(held)
+        again = pinner.claim()
+        self.addCleanup(pinner.release, again)
+        self.assertEqual(len(again), 3)
+
+    def test_no_claim_when_job_needs_every_core_or_pinning_is_off(self):
+        self.assertEqual(self.pinner(4).claim(), [])
+        with mock.patch.object(job_runner.os, 'sched_getaffinity', return_value={0, 1, 2, 3}):
+            self.assertEqual(job_runner.cpu_pinner(False, self.lock_dir.name, 1).claim(), [])
+
+    def test_thread_variables_follow_job_vcpus(self):
+        env = self.pinner(1.5).environment({'OMP_NUM_THREADS': '8'})
+        self.assertEqual(env['OMP_NUM_THREADS'], '8')
+        self.assertEqual(env['MKL_NUM_THREADS'], '2')
+
+    def test_pin_and_restore_slot_affinity(self):
+        pinner = self.pinner(1)
+        held = pinner.claim()
+        self.addCleanup(pinner.release, held)
+        with mock.patch.object(job_runner.os, 'sched_setaffinity') as setaffinity:
+            pinner.pin(held)
+            pinner.restore(held)
+            pinner.pin([])
+            pinner.restore([])
+        self.assertEqual([c.args for c in setaffinity.call_args_list], [(0, [held[0][0]]), (0, [0, 1, 2, 3])])
+
+    def test_do_work_restores_affinity_after_a_pinned_job(self):
+        pinner = self.pinner(1)
+        with mock.patch.object(job_runner, 'pinner', pinner), \
+                mock.patch.object(job_runner, 'STDOUT_ARCHIVE', 'False'), \
+                mock.patch.object(job_runner.os, 'sched_setaffinity') as setaffinity:
+            tail, status = job_runner.do_work('echo pinned', lambda *args: None, 'test', 'job-1', 'test-definition', 'queue-1', None, 'null')
+
+        self.assertEqual(status, 'Successful')
+        self.assertEqual(setaffinity.call_args_list[-1].args, (0, [0, 1, 2, 3]))
+        # the claimed core is free again
+        held = pinner.claim()
+        self.addCleanup(pinner.release, held)
+        self.assertEqual(len(held), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+import loader
+
+direct_mode = loader.agent('direct_mode')
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+def message(received=1):
+    body = {'id': 'job-1', 'jobQueue': 'queue-1', 'commands': 'echo hello'}
+    return {'Body': json.dumps(body), 'ReceiptHandle': 'handle', 'Attributes': {'ApproximateReceiveCount': str(received)}}
+
+
+class DirectModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = mock.MagicMock()
+        self.dynamo.exceptions.ConditionalCheckFailedException = ConditionalCheckFailed
+        self.sqs = mock.MagicMock()
+        patches = [
+            mock.patch.object(direct_mode, 'dynamo_main', self.dynamo),
+            mock.patch.object(direct_mode, 'sqs_main', self.sqs),
+            mock.patch.object(direct_mode, 'heartbeats'),
+            mock.patch.object(direct_mode, 'startup'),
+            mock.patch.object(direct_mode, 'do_work', return_value=('done', 'Successful')),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.do_work = direct_mode.do_work
+
+    def entry(self, status, retries=2, lease=None):
+        item = {'Status': {'S': status}, 'RetriesAvailable': {'N': str(retries)}}
+        if not lease == None:
+            item['LeaseExpires'] = {'N': str(int(lease))}
+        self.dynamo.get_item.return_value = {'Item': item}
+
+    def written_statuses(self):
+        return [c.kwargs['ExpressionAttributeValues'][':p']['S'] for c in self.dynamo.update_item.call_args_list]
+
+    def test_waiting_job_runs_and_holds_a_claim(self):
+        self.entry('Waiting')
+
+        direct_mode.run_direct_job(message(), 'url')
+
+        self.do_work.assert_called_once()
+        self.assertEqual(self.written_statuses(), ['Running', 'Successful'])
+        claim = self.dynamo.update_item.call_args_list[0].kwargs
+        self.assertIn('LeaseExpires', claim['ExpressionAttributeNames'].values())
+        self.assertEqual(direct_mode.heartbeats.register.call_args.args[0].claim, 'direct')
+        self.sqs.delete_message.assert_called_once()
+
+    def test_requeued_failed_and_interrupted_jobs_run(self):
+        for status in ('Interrupted', 'Failed'):
+            self.entry(status, retries=1)
+            direct_mode.run_direct_job(message(), 'url')
+        self.assertEqual(self.do_work.call_count, 2)
+
+    def test_finished_jobs_are_only_taken_off_the_queue(self):
+        for status, retries in (('Successful', 2), ('TimedOut', 2), ('Failed', 0)):
+            self.entry(status, retries)
+            direct_mode.run_direct_job(message(), 'url')
+        self.do_work.assert_not_called()
+        self.dynamo.update_item.assert_not_called()
+        self.assertEqual(self.sqs.delete_message.call_count, 3)
+
+    def test_duplicate_of_running_job_is_left_alone(self):
+        self.entry('Running', lease=time.time() + 60)
+
+        direct_mode.run_direct_job(message(received=2), 'url')
+
+        self.do_work.assert_not_called()
+        self.dynamo.update_item.assert_not_called()
+        self.sqs.delete_message.assert_not_called()
+        timeout = self.sqs.change_message_visibility.call_args.kwargs['VisibilityTimeout']
+        self.assertTrue(0 < timeout <= 61)
+
+    def test_redelivery_after_lost_worker_spends_a_retry(self):
+        self.entry('Running', retries=2, lease=time.time() - 10)
+
+        direct_mode.run_direct_job(message(received=2), 'url')
+
+        self.do_work.assert_not_called()
+        update = self.dynamo.update_item.call_args.kwargs
+        self.assertEqual(update['ExpressionAttributeValues'][':p']['S'], 'Failed')
+        self.assertEqual(update['ExpressionAttributeValues'][':q']['N'], '1')
+        self.sqs.delete_message.assert_called_once()
+
+    def test_redelivery_without_claim_uses_receive_count(self):
+        self.entry('Running', retries=0)
+        direct_mode.run_direct_job(message(received=1), 'url')
+        self.dynamo.update_item.assert_not_called()
+
+        direct_mode.run_direct_job(message(received=3), 'url')
+        update = self.dynamo.update_item.call_args.kwargs
+        self.assertEqual(update['ExpressionAttributeNames']['#attr3'], 'tFailed')
+
+    def test_lost_claim_race_does_not_run(self):
+        self.entry('Waiting')
+        self.dynamo.update_item.side_effect = ConditionalCheckFailed()
+
+        direct_mode.run_direct_job(message(), 'url')
+
+        self.do_work.assert_not_called()
+        self.sqs.delete_message.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
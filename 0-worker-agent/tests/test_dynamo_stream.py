@@ -0,0 +1,218 @@
+import os
+import unittest
+from unittest import mock
+
+import loader
+
+stream = loader.lambda_module('2-dynamo-stream-lambda', 'dynamo-stream-lambda.py')
+
+
+def job(JobName, jobDefinition='definition-1', Status='Waiting', RetriesAvailable=1, **fields):
+    return dict({'id': JobName, 'jobQueue': 'queue-1', 'jobDefinition': jobDefinition, 'Status': Status, 'RetriesAvailable': RetriesAvailable}, **fields)
+
+
+def image(data):
+    return {name: {'N': str(value)} if isinstance(value, int) else {'S': value} for name, value in data.items()}
+
+
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('clients', 'queue_urls', 'rotations'):
+            patcher = mock.patch.object(stream, name, {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(stream.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.dynamo = mock.MagicMock()
+        self.sqs = mock.MagicMock()
+        self.sqs.get_queue_url.side_effect = lambda QueueName: {'QueueUrl': 'https://sqs/' + QueueName}
+        self.sqs.send_message_batch.return_value = {'Successful': [], 'Failed': []}
+        self.kinesis = mock.MagicMock()
+        self.kinesis.put_records.side_effect = lambda StreamName, Records: {'Records': [{'SequenceNumber': '1'} for _ in Records]}
+
+    def marked(self):
+        return sorted(c.kwargs['Key']['id']['S'] for c in self.dynamo.update_item.call_args_list)
+
+
+class BatchesTest(unittest.TestCase):
+
+    def test_batches_stop_at_the_entry_limit(self):
+        self.assertEqual([len(batch) for batch in stream.batches(range(23), 10, 1000, lambda entry: 1)], [10, 10, 3])
+
+    def test_batches_stop_at_the_byte_limit(self):
+        sizes = [40, 40, 30, 90, 10]
+        self.assertEqual(list(stream.batches(sizes, 10, 100, lambda entry: entry)), [[40, 40], [30], [90, 10]])
+
+    def test_entry_larger_than_the_limit_goes_alone(self):
+        self.assertEqual(list(stream.batches([10, 200, 10], 10, 100, lambda entry: entry)), [[10], [200], [10]])
+        self.assertEqual(list(stream.batches([], 10, 100, lambda entry: entry)), [])
+
+
+class SendWithRetriesTest(StreamTestCase):
+
+    def test_only_failed_entries_are_sent_again(self):
+        calls = []
+
+        def send(entries):
+            calls.append(list(entries))
+            return [(entry, 'throttled') for entry in entries if entry == 'b' and len(calls) == 1]
+
+        self.assertEqual(stream.send_with_retries(send, ['a', 'b', 'c']), [])
+        self.assertEqual(calls, [['a', 'b', 'c'], ['b']])
+
+    def test_entries_still_failing_after_the_last_attempt_are_returned(self):
+        send = mock.MagicMock(side_effect=lambda entries: [(entry, 'too large') for entry in entries if entry == 'b'])
+
+        self.assertEqual(stream.send_with_retries(send, ['a', 'b']), [('b', 'too large')])
+        self.assertEqual(send.call_count, stream.SEND_ATTEMPTS)
+        self.assertEqual(self.sleep.call_args_list, [mock.call(attempt) for attempt in range(1, stream.SEND_ATTEMPTS)])
+
+    def test_a_failed_call_fails_all_of_its_entries(self):
+        error = Exception('unavailable')
+        send = mock.MagicMock(side_effect=error)
+
+        self.assertEqual(stream.send_with_retries(send, ['a', 'b']), [('a', error), ('b', error)])
+
+
+class SendToQueuesTest(StreamTestCase):
+
+    def test_jobs_go_in_batches_per_definition_queue(self):
+        jobs = [job('job-' + str(i)) for i in range(12)] + [job('other-' + str(i), 'definition-2') for i in range(3)]
+
+        sent = stream.send_to_queues(self.sqs, 'us-east-1', self.dynamo, jobs)
+
+        self.assertEqual(sorted(data['id'] for data in sent), sorted(data['id'] for data in jobs))
+        calls = [(c.kwargs['QueueUrl'], len(c.kwargs['Entries'])) for c in self.sqs.send_message_batch.call_args_list]
+        self.assertEqual(calls, [('https://sqs/definition-1', 10), ('https://sqs/definition-1', 2), ('https://sqs/definition-2', 3)])
+        self.assertEqual(self.sqs.get_queue_url.call_count, 2)
+
+    def test_partially_failed_batch_retries_and_marks_what_never_went(self):
+        def send_message_batch(QueueUrl, Entries):
+            return {'Failed': [{'Id': entry['Id'], 'Code': 'InternalError'} for entry in Entries if 'job-1' in entry['MessageBody']]}
+        self.sqs.send_message_batch.side_effect = send_message_batch
+
+        sent = stream.send_to_queues(self.sqs, 'us-east-1', self.dynamo, [job('job-0'), job('job-1'), job('job-2')])
+
+        self.assertEqual([data['id'] for data in sent], ['job-0', 'job-2'])
+        self.assertEqual([len(c.kwargs['Entries']) for c in self.sqs.send_message_batch.call_args_list], [3] + [1] * (stream.SEND_ATTEMPTS - 1))
+        self.assertEqual(self.marked(), ['job-1'])
+        update = self.dynamo.update_item.call_args.kwargs
+        self.assertEqual(update['ExpressionAttributeValues'][':p']['S'], 'ERROR Could not send to task definition queue: definition-1')
+        self.assertEqual(update['ExpressionAttributeValues'][':r']['S'], 'InternalError')
+
+    def test_missing_queue_marks_its_jobs_only(self):
+        def get_queue_url(QueueName):
+            if not QueueName == 'definition-1':
+                raise Exception('no queue')
+            return {'QueueUrl': 'https://sqs/' + QueueName}
+        self.sqs.get_queue_url.side_effect = get_queue_url
+
+        sent = stream.send_to_queues(self.sqs, 'us-east-1', self.dynamo, [job('job-0'), job('other-0', 'definition-2')])
+
+        self.assertEqual([data['id'] for data in sent], ['job-0'])
+        self.assertEqual(self.marked(), ['other-0'])
+
+
+class RequestWorkersTest(StreamTestCase):
+
+    def test_one_put_records_per_region_and_failed_records_are_marked(self):
+        def put_records(StreamName, Records):
+            return {'Records': [{'ErrorCode': 'ProvisionedThroughputExceededException', 'ErrorMessage': 'slow down'} if b'job-1' in record['Data'] else {'SequenceNumber': '1'} for record in Records]}
+        failing = mock.MagicMock()
+        failing.put_records.side_effect = put_records
+        clients = {'us-east-1': self.kinesis, 'us-west-2': failing}
+
+        with mock.patch.object(stream, 'get_client', side_effect=lambda service, region: clients[region]):
+            stream.request_workers(self.dynamo, [(job('job-0'), 'us-east-1'), (job('job-1'), 'us-west-2'), (job('job-2'), 'us-west-2')], 'cluster-stream')
+
+        self.assertEqual(self.kinesis.put_records.call_count, 1)
+        self.assertEqual([len(c.kwargs['Records']) for c in failing.put_records.call_args_list], [2] + [1] * (stream.SEND_ATTEMPTS - 1))
+        self.assertEqual(self.marked(), ['job-1'])
+        self.assertEqual(self.dynamo.update_item.call_args.kwargs['ExpressionAttributeValues'][':r']['S'], 'slow down')
+
+
+class WarmStateTest(StreamTestCase):
+
+    def test_clients_are_created_once_per_service_and_region(self):
+        with mock.patch.object(stream.boto3, 'client', side_effect=lambda service, region_name: mock.MagicMock()) as client:
+            first = stream.get_client('sqs', 'us-east-1')
+            self.assertIs(stream.get_client('sqs', 'us-east-1'), first)
+            self.assertIsNot(stream.get_client('sqs', 'us-west-2'), first)
+            self.assertIsNot(stream.get_client('kinesis', 'us-east-1'), first)
+
+        self.assertEqual(client.call_count, 3)
+
+    def test_queue_urls_are_looked_up_once(self):
+        self.assertEqual(stream.get_queue_url(self.sqs, 'us-east-1', 'definition-1'), 'https://sqs/definition-1')
+        self.assertEqual(stream.get_queue_url(self.sqs, 'us-east-1', 'definition-1'), 'https://sqs/definition-1')
+        stream.get_queue_url(self.sqs, 'us-west-2', 'definition-1')
+
+        self.assertEqual(self.sqs.get_queue_url.call_count, 2)
+
+    def test_failed_send_forgets_the_queue_url(self):
+        self.sqs.send_message_batch.side_effect = Exception('queue does not exist')
+
+        stream.send_to_queues(self.sqs, 'us-east-1', self.dynamo, [job('job-0')])
+        stream.send_to_queues(self.sqs, 'us-east-1', self.dynamo, [job('job-0')])
+
+        # looked up again by the next invocation, not on every retry
+        self.assertEqual(self.sqs.get_queue_url.call_count, 2)
+        self.assertEqual(self.sqs.send_message_batch.call_count, 2 * stream.SEND_ATTEMPTS)
+
+    def test_rotation_is_parsed_once_per_weights_value(self):
+        weights = "{'us-east-1': 2, 'us-west-2': 1}"
+        rotation = stream.get_rotation(weights)
+
+        self.assertEqual(rotation, ['us-east-1', 'us-east-1', 'us-west-2'])
+        self.assertIs(stream.get_rotation(weights), rotation)
+        self.assertEqual(stream.get_rotation('{"eu-west-1": 1}'), ['eu-west-1'])
+
+
+class LambdaHandlerTest(StreamTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, {'CLUSTER_MAPPING': 'cluster-stream', 'MAIN_REGION': 'us-east-1', 'REGION_DISTRIBUTION_WEIGHTS': "{'us-east-1': 1}"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        clients = {'dynamodb': self.dynamo, 'sqs': self.sqs, 'kinesis': self.kinesis}
+        patcher = mock.patch.object(stream, 'get_client', side_effect=lambda service, region: clients[service])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def event(self, *jobs):
+        return {'Records': [{'eventName': 'INSERT', 'dynamodb': {'NewImage': image(data)}} for data in jobs]}
+
+    def requested(self):
+        return [record['Data'] for c in self.kinesis.put_records.call_args_list for record in c.kwargs['Records']]
+
+    def test_dispatches_waiting_and_retried_jobs(self):
+        event = self.event(job('waiting'), job('retry', Status='Failed', RetriesAvailable=1), job('no-retries', Status='Failed', RetriesAvailable=0),
+                           job('interrupted', Status='Interrupted', RetriesAvailable=0), job('running', Status='Running'),
+                           job('static', Dispatch='static'))
+
+        stream.lambda_handler(event, None)
+
+        queued = [entry['MessageBody'] for c in self.sqs.send_message_batch.call_args_list for entry in c.kwargs['Entries']]
+        self.assertEqual(self.sqs.send_message_batch.call_count, 1)
+        self.assertEqual(len(queued), 3)
+        for name in ('"waiting"', '"retry"', '"interrupted"'):
+            self.assertTrue(any(name in body for body in queued), name)
+        # static array jobs only get their worker request
+        self.assertEqual(len(self.requested()), 4)
+        self.assertEqual(self.kinesis.put_records.call_count, 1)
+
+    def test_job_that_was_not_queued_gets_no_worker_request(self):
+        self.sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {'Failed': [{'Id': entry['Id'], 'Code': 'InternalError'} for entry in Entries if '"lost"' in entry['MessageBody']]}
+
+        stream.lambda_handler(self.event(job('kept'), job('lost')), None)
+
+        self.assertEqual(len(self.requested()), 1)
+        self.assertIn(b'"kept"', self.requested()[0])
+        self.assertEqual(self.marked(), ['lost'])
+
+
+if __name__ == '__main__':
+    unittest.main()
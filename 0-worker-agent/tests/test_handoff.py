@@ -0,0 +1,97 @@
+import queue
+import threading
+import unittest
+from unittest import mock
+
+import loader
+
+lanes = loader.agent('lanes')
+
+
+def job_payload(uuid, job_id='job-1'):
+    return {'uuid': uuid, 'command': 'echo hello', 'LeaveRunning': 'True', 'Callback': 'token', 'id': job_id, 'JobQueue': 'queue-1'}
+
+
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        patches = [
+            mock.patch.object(lanes, 'get_slot'),
+            mock.patch.object(lanes, 'heartbeats'),
+            mock.patch.object(lanes, 'IDLE_TIMEOUT', 10),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.get_slot = lanes.get_slot
+
+    def test_local_channel_routes_job_to_lane(self):
+        channel = lanes.local_channel()
+        router = lanes.dispatcher(channel)
+        l = lanes.lane(0, 0)
+        inbox = queue.Queue()
+        router.register(l.uuid, inbox)
+        thread = threading.Thread(target=router.run, daemon=True)
+        thread.start()
+        self.addCleanup(router.terminate)
+
+        channel.notify(job_payload('some-other-lane'))
+        channel.notify(job_payload(l.uuid))
+        for _ in range(50):
+            lanes.collect_handoffs([l], inbox, True)
+            if not l.item == None:
+                break
+
+        self.assertEqual(l.item['id']['S'], 'job-1')
+        self.assertEqual(l.item['command']['S'], 'echo hello')
+        self.get_slot.assert_not_called()
+
+    def test_wake_message_without_command_reads_slot(self):
+        l = lanes.lane(0, 0)
+        inbox = queue.Queue()
+        payload = job_payload(l.uuid)
+        del payload['command']
+        inbox.put(payload)
+        self.get_slot.return_value = {k: {'S': v} for k, v in job_payload(l.uuid).items()}
+
+        lanes.collect_handoffs([l], inbox, False)
+
+        self.get_slot.assert_called_once_with(l.uuid)
+        self.assertEqual(l.item['command']['S'], 'echo hello')
+
+    def test_polling_without_wake_queue(self):
+        l = lanes.lane(0, 0)
+        idle = {'LeaveRunning': {'S': 'True'}, 'id': {'S': 'null'}}
+        self.get_slot.side_effect = [idle, {k: {'S': v} for k, v in job_payload(l.uuid).items()}]
+
+        with mock.patch.object(lanes.time, 'sleep'):
+            lanes.collect_handoffs([l], None, True)
+            lanes.collect_handoffs([l], None, True)
+
+        self.assertEqual(self.get_slot.call_count, 2)
+        self.assertEqual(l.item['id']['S'], 'job-1')
+
+    def test_lost_wake_message_falls_back_to_slot(self):
+        l = lanes.lane(0, 0)
+        l.waiting_since -= lanes.IDLE_TIMEOUT + l.linger
+        self.get_slot.return_value = {k: {'S': v} for k, v in job_payload(l.uuid).items()}
+
+        lanes.collect_handoffs([l], queue.Queue(), False)
+
+        self.get_slot.assert_called_once_with(l.uuid)
+        self.assertEqual(l.item['id']['S'], 'job-1')
+        self.assertFalse(l.closed)
+
+    def test_idle_lane_closes(self):
+        l = lanes.lane(0, 0)
+        l.waiting_since -= lanes.IDLE_TIMEOUT + l.linger
+        self.get_slot.return_value = {'LeaveRunning': {'S': 'True'}, 'id': {'S': 'null'}}
+
+        lanes.collect_handoffs([l], queue.Queue(), False)
+
+        self.assertTrue(l.closed)
+        self.assertEqual(l.item, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import loader
+
+input_cache = loader.agent('input_cache')
+
+
+def put(key, content):
+    path = os.path.join(loader.STAGE_ROOT, 'bucket', key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+    return 's3://bucket/' + key
+
+
+class StagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_directives(self):
+        cmd = '#HYPER -i s3://bucket/in/data.csv\n#HYPER -i s3://bucket/ref/ refs\n#HYPER -o s3://bucket/out/result.txt out.txt\necho run'
+        inputs, outputs = input_cache.staging_directives(cmd)
+        self.assertEqual(inputs, [('s3://bucket/in/data.csv', 'data.csv'), ('s3://bucket/ref/', 'refs')])
+        self.assertEqual(outputs, [('s3://bucket/out/result.txt', 'out.txt')])
+
+    def test_stage_prefix_in_and_directory_out(self):
+        put('ref/a.txt', 'a')
+        put('ref/sub/b.txt', 'b')
+        local = os.path.join(self.directory.name, 'refs')
+        with mock.patch.object(input_cache, 'cache', None):
+            input_cache.stage([('s3://bucket/ref/', local)], 'in', 'job-1', 'queue-1')
+            with open(os.path.join(local, 'sub', 'b.txt')) as f:
+                self.assertEqual(f.read(), 'b')
+
+            input_cache.stage([('s3://bucket/copy/', local)], 'out', 'job-1', 'queue-1')
+        with open(os.path.join(loader.STAGE_ROOT, 'bucket', 'copy', 'sub', 'b.txt')) as f:
+            self.assertEqual(f.read(), 'b')
+
+
+class InputCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = input_cache.input_cache(os.path.join(self.directory.name, 'cache'), 1000)
+
+    def local(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_second_fetch_is_a_hit(self):
+        remote = put('hit.txt', 'content')
+
+        self.assertFalse(self.cache.fetch(remote, self.local('first')))
+        self.assertTrue(self.cache.fetch(remote, self.local('second')))
+        with open(self.local('second')) as f:
+            self.assertEqual(f.read(), 'content')
+
+    def test_concurrent_fetches_download_once(self):
+        remote = put('shared.txt', 'shared')
+        transfer = input_cache.transfer_file
+        calls = []
+
+        def slow_transfer(*args):
+            calls.append(args)
+            time.sleep(0.2)
+            transfer(*args)
+
+        with mock.patch.object(input_cache, 'transfer_file', side_effect=slow_transfer):
+            threads = [threading.Thread(target=self.cache.fetch, args=(remote, self.local('copy' + str(n)))) for n in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(len(calls), 1)
+        for n in range(4):
+            with open(self.local('copy' + str(n))) as f:
+                self.assertEqual(f.read(), 'shared')
+
+    def test_failed_download_leaves_no_entry_or_temporary_file(self):
+        remote = put('broken.txt', 'x')
+        with mock.patch.object(input_cache, 'transfer_file', side_effect=IOError('network')):
+            with self.assertRaises(IOError):
+                self.cache.fetch(remote, self.local('broken'))
+        self.assertEqual(os.listdir(os.path.join(self.cache.root, 'tmp')), [])
+        self.assertFalse(os.path.exists(self.cache.entry(input_cache.cache_address(remote))))
+
+    def test_eviction_removes_oldest_entries_with_their_lock_files(self):
+        remotes = [put('evict' + str(n) + '.txt', 'x' * 400) for n in range(3)]
+        for n, remote in enumerate(remotes):
+            self.cache.fetch(remote, self.local('evict' + str(n)))
+            entry = self.cache.entry(input_cache.cache_address(remote))
+            os.utime(entry, (time.time() - 100 + n, time.time() - 100 + n))
+
+        self.cache.evict()
+
+        addresses = [input_cache.cache_address(remote) for remote in remotes]
+        self.assertEqual([os.path.exists(self.cache.entry(a)) for a in addresses], [False, True, True])
+        self.assertEqual([os.path.exists(self.cache.lock_path(a)) for a in addresses], [False, True, True])
+
+    def test_entry_being_filled_is_not_removed(self):
+        remote = put('busy.txt', 'busy')
+        self.cache.fetch(remote, self.local('busy'))
+        address = input_cache.cache_address(remote)
+
+        lock = self.cache.lock(address)
+        try:
+            self.assertFalse(self.cache.remove(address, self.cache.entry(address)))
+        finally:
+            lock.close()
+        self.assertTrue(os.path.exists(self.cache.entry(address)))
+        self.assertTrue(self.cache.remove(address, self.cache.entry(address)))
+        self.assertFalse(os.path.exists(self.cache.lock_path(address)))
+
+    def test_stale_lock_and_temporary_files_are_cleaned_up(self):
+        stale = time.time() - input_cache.input_cache.STALE_TMP_SECONDS - 10
+        lock = self.cache.lock_path('never-filled')
+        tmp = os.path.join(self.cache.root, 'tmp', 'never-filled.worker')
+        fresh = self.cache.lock_path('being-filled')
+        for path in [lock, tmp, fresh]:
+            open(path, 'w').close()
+        os.utime(lock, (stale, stale))
+        os.utime(tmp, (stale, stale))
+
+        self.cache.evict()
+
+        self.assertFalse(os.path.exists(lock))
+        self.assertFalse(os.path.exists(tmp))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_lock_is_taken_again_when_eviction_removed_its_file(self):
+        address = 'raced'
+        first = self.cache.lock(address)
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.cache.lock(address)))
+        waiter.start()
+        time.sleep(0.1)
+        # eviction removes the lock file while the waiter blocks on the old one
+        os.remove(self.cache.lock_path(address))
+        first.close()
+        waiter.join(5)
+
+        self.assertEqual(len(got), 1)
+        self.assertEqual(os.fstat(got[0].fileno()).st_ino, os.stat(self.cache.lock_path(address)).st_ino)
+        got[0].close()
+
+
+if __name__ == '__main__':
+    unittest.main()
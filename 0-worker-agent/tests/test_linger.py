@@ -0,0 +1,131 @@
+import time
+import unittest
+from unittest import mock
+
+import loader
+
+job_runner = loader.agent('job_runner')
+
+
+class LingerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sqs = mock.MagicMock()
+        self.sqs.get_queue_url.return_value = {'QueueUrl': 'https://sqs/test-definition'}
+        self.sqs.get_queue_attributes.return_value = {'Attributes': {'ApproximateNumberOfMessages': '0'}}
+        self.dynamo = mock.MagicMock()
+        self.dynamo.query.return_value = {'Items': []}
+        for name, value in (('sqs_main', self.sqs), ('dynamo', self.dynamo), ('JOB_VCPUS', 2)):
+            patcher = mock.patch.object(job_runner, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.policy = job_runner.linger_policy(5, 60, 8)
+
+    def arrivals(self, *gaps):
+        now = time.perf_counter()
+        times = [now]
+        for gap in gaps:
+            times.append(times[-1] + gap)
+        self.policy.arrivals.extend(times)
+
+    def backlog(self, *counts):
+        self.sqs.get_queue_attributes.side_effect = [{'Attributes': {'ApproximateNumberOfMessages': str(count)}} for count in counts]
+        for _ in counts:
+            self.policy.sampled_at = None
+            self.policy.sample_backlog()
+
+
+class SecondsTest(LingerTestCase):
+
+    def test_steady_arrivals_and_an_empty_queue_exit_after_the_minimum(self):
+        self.arrivals(10, 11, 9, 10, 10)
+
+        self.assertEqual(self.policy.seconds(), 5)
+
+    def test_bursty_arrivals_linger_for_the_longest_gap(self):
+        self.arrivals(1, 1, 1, 40, 1, 1)
+
+        self.assertEqual(self.policy.seconds(), 40)
+
+    def test_linger_stays_within_the_bounds(self):
+        self.arrivals(0.1, 0.1, 0.1, 500, 0.1)
+        self.assertEqual(self.policy.seconds(), 60)
+
+        self.policy.arrivals.clear()
+        self.arrivals(0.1, 0.1, 0.1, 0.1, 3)
+        self.assertEqual(self.policy.seconds(), 5)
+
+    def test_waiting_jobs_linger_without_arrivals(self):
+        self.backlog(3)
+
+        self.assertEqual(self.policy.seconds(), 60)
+
+    def test_growing_backlog_lingers_for_the_longest_gap(self):
+        self.arrivals(10, 12)
+        self.backlog(0, 2)
+
+        self.assertEqual(self.policy.seconds(), 12)
+
+    def test_backlog_is_sampled_at_most_every_sample_period(self):
+        self.policy.seconds()
+        self.policy.seconds()
+
+        self.assertEqual(self.sqs.get_queue_attributes.call_count, 1)
+        self.assertEqual(self.sqs.get_queue_url.call_count, 1)
+
+    def test_failed_sample_keeps_the_last_backlog(self):
+        self.backlog(3)
+        self.sqs.get_queue_attributes.side_effect = Exception('throttled')
+        self.policy.sampled_at = None
+
+        self.assertEqual(self.policy.seconds(), 60)
+
+    def test_no_range_means_the_minimum(self):
+        policy = job_runner.linger_policy(5, 5, 8)
+
+        self.assertEqual(policy.seconds(), 5)
+        self.sqs.get_queue_attributes.assert_not_called()
+
+
+class WarmPoolTest(LingerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backlog(3)
+
+    def test_lingering_slot_reserves_its_vcpus(self):
+        self.assertEqual(self.policy.hold('slot-1'), 60)
+
+        item = self.dynamo.put_item.call_args.kwargs['Item']
+        self.assertEqual((item['holder']['S'], item['vcpus']['N']), ('slot-1', '2'))
+        self.assertGreater(int(item['expires']['N']), time.time() + 60)
+
+        self.policy.release('slot-1')
+        self.policy.release('slot-1')
+        self.assertEqual(self.dynamo.delete_item.call_count, 1)
+
+    def test_full_pool_falls_back_to_the_minimum(self):
+        self.dynamo.query.return_value = {'Items': [{'holder': {'S': 'other'}, 'vcpus': {'N': '7'}}, {'holder': {'S': 'slot-1'}, 'vcpus': {'N': '2'}}]}
+
+        self.assertEqual(self.policy.hold('slot-1'), 5)
+
+        self.dynamo.put_item.assert_not_called()
+        self.policy.release('slot-1')
+        self.dynamo.delete_item.assert_not_called()
+
+    def test_failed_reservation_falls_back_to_the_minimum(self):
+        self.dynamo.query.side_effect = Exception('throttled')
+
+        self.assertEqual(self.policy.hold('slot-1'), 5)
+
+    def test_without_a_cap_nothing_is_reserved(self):
+        policy = job_runner.linger_policy(5, 60, 0)
+        policy.backlog = 3
+        policy.sampled_at = time.perf_counter()
+
+        self.assertEqual(policy.hold('slot-1'), 60)
+        self.dynamo.query.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
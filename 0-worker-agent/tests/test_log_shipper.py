@@ -0,0 +1,176 @@
+import os
+import json
+import itertools
+import tempfile
+import unittest
+from unittest import mock
+
+import loader
+
+log_shipping = loader.agent('log_shipping')
+
+
+def entry(data, JobName='job-1'):
+    return {'time_stamp': '2024-01-01T00:00:00', 'log_type': 'STDOUT', 'id': JobName, 'jobDefinition': 'test-definition', 'jobQueue': 'queue-1', 'data': data}
+
+
+def unpack(records):
+    return [entry for record in records for entry in json.loads(record['Data'])]
+
+
+class ShipperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.shipper = log_shipping.log_shipper('test_log_stream', self.directory.name)
+        self.kinesis = mock.MagicMock()
+        self.sent = []
+        self.kinesis.put_records.side_effect = self.put_records
+        self.failing = set()
+        # spool files are named by time, a clock that always moves on keeps their order
+        clock = mock.MagicMock()
+        clock.time.side_effect = itertools.count(1000).__next__
+        for name, value in (('kinesis', self.kinesis), ('time', clock)):
+            patcher = mock.patch.object(log_shipping, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def put_records(self, StreamName, Records):
+        results = []
+        for record in Records:
+            if any(e['data'] in self.failing for e in json.loads(record['Data'])):
+                results.append({'ErrorCode': 'ProvisionedThroughputExceededException'})
+            else:
+                self.sent.append(record)
+                results.append({'SequenceNumber': '1'})
+        return {'FailedRecordCount': sum(1 for r in results if 'ErrorCode' in r), 'Records': results}
+
+    def spooled(self):
+        return sorted(name for name in os.listdir(self.directory.name) if name.endswith('.jsonl'))
+
+
+class PackTest(ShipperTestCase):
+
+    def test_entries_share_a_record_under_the_limit(self):
+        entries = [entry('line ' + str(i)) for i in range(50)]
+
+        records = self.shipper.pack(entries, 'test-definition')
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['PartitionKey'], 'test-definition')
+        self.assertEqual(unpack(records), entries)
+
+    def test_records_stay_under_the_limit_with_the_partition_key(self):
+        entries = [entry('x' * 100 + str(i)) for i in range(40)]
+
+        with mock.patch.object(log_shipping.log_shipper, 'MAX_RECORD_BYTES', 1000):
+            records = self.shipper.pack(entries, 'test-definition')
+
+        self.assertGreater(len(records), 1)
+        for record in records:
+            self.assertLessEqual(len(record['Data']) + len('test-definition'), 1000)
+        self.assertEqual(unpack(records), entries)
+
+    def test_entry_over_the_limit_is_truncated(self):
+        with mock.patch.object(log_shipping.log_shipper, 'MAX_RECORD_BYTES', 1000):
+            records = self.shipper.pack([entry('short'), entry('y' * 5000)], 'test-definition')
+
+        entries = unpack(records)
+        self.assertEqual(entries[0]['data'], 'short')
+        self.assertTrue(entries[1]['data'].endswith(' [CYCLONE: line truncated]'))
+        for record in records:
+            self.assertLessEqual(len(record['Data']) + len('test-definition'), 1000)
+
+
+class SendTest(ShipperTestCase):
+
+    def records(self, *names):
+        return [record for name in names for record in self.shipper.pack([entry(name)], 'test-definition')]
+
+    def test_only_failed_records_are_sent_again(self):
+        self.failing = {'b'}
+        calls = []
+
+        def put_records(StreamName, Records):
+            calls.append(len(Records))
+            if len(calls) == 3:
+                self.failing = set()
+            return self.put_records(StreamName, Records)
+        self.kinesis.put_records.side_effect = put_records
+
+        self.assertTrue(self.shipper.send(self.records('a', 'b', 'c')))
+
+        self.assertEqual(calls, [3, 1, 1])
+        self.assertEqual([e['data'] for e in unpack(self.sent)], ['a', 'c', 'b'])
+        self.assertEqual(self.spooled(), [])
+
+    def test_records_still_failing_go_to_the_spool(self):
+        self.failing = {'b'}
+
+        self.assertFalse(self.shipper.send(self.records('a', 'b')))
+
+        self.assertEqual(self.kinesis.put_records.call_count, log_shipping.log_shipper.MAX_ATTEMPTS)
+        self.assertEqual(len(self.spooled()), 1)
+        with open(os.path.join(self.directory.name, self.spooled()[0])) as f:
+            self.assertEqual([e['data'] for line in f for e in json.loads(json.loads(line)['Data'])], ['b'])
+
+    def test_failed_calls_spool_every_record(self):
+        self.kinesis.put_records.side_effect = Exception('unavailable')
+
+        self.assertFalse(self.shipper.send(self.records('a', 'b')))
+
+        self.assertEqual(len(self.spooled()), 1)
+
+    def test_full_queue_spools_instead_of_blocking(self):
+        with mock.patch.object(log_shipping.log_shipper, 'QUEUE_SIZE', 1):
+            shipper = log_shipping.log_shipper('test_log_stream', self.directory.name)
+        with mock.patch.object(log_shipping.log_shipper, 'MAX_RECORD_BYTES', 200):
+            shipper.submit([entry('x' * 100), entry('y' * 100)], 'test-definition')
+
+        self.assertEqual(shipper.queue.qsize(), 1)
+        self.assertEqual(len(self.spooled()), 1)
+
+
+class ReplayTest(ShipperTestCase):
+
+    def spool(self, *names):
+        for name in names:
+            self.shipper.spool(self.shipper.pack([entry(name)], 'test-definition'))
+
+    def test_spooled_records_are_sent_oldest_first(self):
+        self.spool('first', 'second', 'third')
+
+        self.shipper.replay()
+
+        self.assertEqual([e['data'] for e in unpack(self.sent)], ['first', 'second', 'third'])
+        self.assertEqual(self.spooled(), [])
+
+    def test_replay_stops_at_the_first_file_that_can_not_be_sent(self):
+        self.spool('first', 'second', 'third')
+        self.failing = {'second'}
+
+        self.shipper.replay()
+
+        self.assertEqual([e['data'] for e in unpack(self.sent)], ['first'])
+        self.assertEqual(len(self.spooled()), 2)
+
+        self.failing = set()
+        self.shipper.replay()
+
+        self.assertEqual(sorted(e['data'] for e in unpack(self.sent)), ['first', 'second', 'third'])
+        self.assertEqual(self.spooled(), [])
+
+    def test_close_sends_the_queue_and_the_spool(self):
+        self.spool('spooled')
+        self.shipper.start()
+
+        self.shipper.submit([entry('queued')], 'test-definition')
+        self.shipper.close()
+
+        self.assertEqual(sorted(e['data'] for e in unpack(self.sent)), ['queued', 'spooled'])
+        self.assertEqual(self.spooled(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
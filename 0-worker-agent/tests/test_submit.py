@@ -0,0 +1,153 @@
+import os
+import sys
+import uuid
+import tempfile
+import subprocess
+import unittest
+from unittest import mock
+
+import loader
+
+job_runner = loader.agent('job_runner')
+
+
+def plain(item):
+    """Queue table item back from its DynamoDB attribute values"""
+    values = {}
+    for name, value in item.items():
+        (kind, data), = value.items()
+        if kind == 'N':
+            values[name] = int(data)
+        elif kind == 'L':
+            values[name] = [v['S'] for v in data]
+        else:
+            values[name] = data
+    return values
+
+
+class ChildItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.service = job_runner.submit_service('/tmp/unused.sock')
+
+    def test_child_defaults_to_the_parent_queue_and_definition(self):
+        item = self.service.child_item({'commands': 'echo hello'}, 'parent-1', 'queue-1', 'now')
+
+        self.assertEqual((item['jobQueue'], item['jobDefinition'], item['RetriesAvailable']), ('queue-1', 'test-definition', 0))
+        self.assertEqual((item['Status'], item['tCreated'], item['commands']), ('Waiting', 'now', 'echo hello'))
+        self.assertEqual((item['parentId'], item['parentQueue'], item['jobName']), ('parent-1', 'queue-1', 'parent-1'))
+        uuid.UUID(item['id'])
+
+    def test_directives_apply_as_in_qsub(self):
+        cmd = '#HYPER -n sweep\n#HYPER -q queue-2\n#HYPER -r 3\n#HYPER -d other-definition\n#HYPER -i s3://in/a\n#HYPER -i s3://in/b\n' \
+              '#HYPER -o out s3://out/\n#HYPER -k\n#HYPER -t 01:00\nrun'
+
+        item = self.service.child_item({'commands': cmd}, 'parent-1', 'queue-1', 'now')
+
+        self.assertEqual((item['jobName'], item['jobQueue'], item['RetriesAvailable'], item['jobDefinition']), ('sweep', 'queue-2', 3, 'other-definition'))
+        self.assertEqual((item['inputs'], item['outputs'], item['checkpoint'], item['walltime']), (['s3://in/a', 's3://in/b'], ['out s3://out/'], 'True', '01:00'))
+        # lineage points at the queue of the parent, not the child's
+        self.assertEqual(item['parentQueue'], 'queue-1')
+
+    def test_job_fields_win_over_directives(self):
+        job = {'commands': '#HYPER -q queue-2\n#HYPER -r 3\nrun', 'jobQueue': 'queue-3', 'RetriesAvailable': '1', 'walltime': '30'}
+
+        item = self.service.child_item(job, 'parent-1', 'queue-1', 'now')
+
+        self.assertEqual((item['jobQueue'], item['RetriesAvailable'], item['walltime']), ('queue-3', 1, '30'))
+
+    def test_checkpoint_directory(self):
+        item = self.service.child_item({'commands': '#HYPER -k state\nrun'}, 'parent-1', 'queue-1', 'now')
+
+        self.assertEqual(item['checkpoint'], 'state')
+
+    def test_child_without_a_parent_names_itself(self):
+        item = self.service.child_item({'commands': 'run'}, None, 'queue-1', 'now')
+
+        self.assertEqual(item['jobName'], item['id'])
+        self.assertFalse('parentId' in item)
+
+    def test_child_needs_its_commands(self):
+        for job in ({}, {'commands': ['run']}, 'run'):
+            with self.assertRaises(ValueError):
+                self.service.child_item(job, 'parent-1', 'queue-1', 'now')
+
+
+class SubmitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = mock.MagicMock()
+        self.dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+        for name, value in (('dynamo_main', self.dynamo), ('shipper', mock.MagicMock()), ('sleep', mock.MagicMock())):
+            patcher = mock.patch.object(job_runner, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service = job_runner.submit_service('/tmp/unused.sock')
+
+    def written(self):
+        return [plain(put['PutRequest']['Item']) for c in self.dynamo.batch_write_item.call_args_list for puts in c.kwargs['RequestItems'].values() for put in puts]
+
+
+class SubmitTest(SubmitTestCase):
+
+    def test_children_are_written_in_batches_of_25_per_queue(self):
+        jobs = [{'commands': 'run ' + str(i)} for i in range(30)] + [{'commands': '#HYPER -q queue-2\nrun'}]
+
+        ids = self.service.submit(jobs, 'parent-1', 'queue-1')
+
+        self.assertEqual(len(ids), 31)
+        calls = [{name: len(puts) for name, puts in c.kwargs['RequestItems'].items()} for c in self.dynamo.batch_write_item.call_args_list]
+        self.assertEqual(calls, [{'queue-1': 25}, {'queue-1': 5}, {'queue-2': 1}])
+        self.assertEqual([item['id'] for item in self.written()], ids)
+
+    def test_unprocessed_items_are_written_again(self):
+        def batch_write_item(RequestItems):
+            if self.dynamo.batch_write_item.call_count == 1:
+                return {'UnprocessedItems': {'queue-1': RequestItems['queue-1'][1:]}}
+            return {'UnprocessedItems': {}}
+        self.dynamo.batch_write_item.side_effect = batch_write_item
+
+        ids = self.service.submit([{'commands': 'a'}, {'commands': 'b'}], 'parent-1', 'queue-1')
+
+        self.assertEqual([item['id'] for item in self.written()], ids + ids[1:])
+
+    def test_table_that_keeps_throttling_fails_the_submit(self):
+        self.dynamo.batch_write_item.side_effect = lambda RequestItems: {'UnprocessedItems': RequestItems}
+
+        with self.assertRaises(Exception):
+            self.service.submit([{'commands': 'a'}], 'parent-1', 'queue-1')
+        self.assertEqual(self.dynamo.batch_write_item.call_count, 9)
+
+
+class SubmitSocketTest(SubmitTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.service = job_runner.submit_service(os.path.join(self.directory.name, 'submit.sock'))
+        self.service.start()
+        self.addCleanup(self.service.terminate)
+
+    def submit(self, lines):
+        env = self.service.environment(None, 'parent-1', 'queue-1')
+        return subprocess.run([sys.executable, env['CYCLONE_AGENT'], '--submit'], input=lines, env=env, capture_output=True, text=True, timeout=30)
+
+    def test_job_submits_children_through_the_helper(self):
+        result = self.submit('{"commands": "run 1"}\n\n{"commands": "run 2", "jobName": "named"}\n')
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        items = self.written()
+        self.assertEqual(result.stdout.split(), [item['id'] for item in items])
+        self.assertEqual([(item['parentId'], item['parentQueue'], item['jobName']) for item in items], [('parent-1', 'queue-1', 'parent-1'), ('parent-1', 'queue-1', 'named')])
+
+    def test_invalid_child_is_reported_to_the_job(self):
+        result = self.submit('{"jobName": "no commands"}\n')
+
+        self.assertEqual(result.returncode, 1)
+        self.assertIn('every child job needs its commands', result.stderr)
+        self.dynamo.batch_write_item.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
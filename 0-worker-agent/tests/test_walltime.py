@@ -0,0 +1,115 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import loader
+
+job_runner = loader.agent('job_runner')
+
+
+def alive(pid):
+    """A process that is gone or only waits to be reaped is not running anymore"""
+    try:
+        with open('/proc/' + str(pid) + '/stat') as f:
+            return not f.read().rsplit(')', 1)[1].split()[0] in ['Z', 'X']
+    except FileNotFoundError:
+        return False
+
+
+def wait_gone(pid, seconds=5):
+    deadline = time.time() + seconds
+    while alive(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    return not alive(pid)
+
+
+class WalltimeParsingTest(unittest.TestCase):
+
+    def test_seconds_and_clock_formats(self):
+        self.assertEqual(job_runner.walltime_seconds('90'), 90)
+        self.assertEqual(job_runner.walltime_seconds('01:30'), 90)
+        self.assertEqual(job_runner.walltime_seconds('1:00:05'), 3605)
+        self.assertEqual(job_runner.walltime_seconds(45), 45)
+        for walltime in (None, '', 'null', '0'):
+            self.assertEqual(job_runner.walltime_seconds(walltime), None, walltime)
+        with self.assertRaises(ValueError):
+            job_runner.walltime_seconds('soon')
+
+    def test_directive(self):
+        self.assertEqual(job_runner.walltime_directive('#HYPER -q queue\n#HYPER -t 00:10\nrun'), '00:10')
+        self.assertEqual(job_runner.walltime_directive('run -t 10'), None)
+
+
+class WalltimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.pid_file = os.path.join(self.directory.name, 'child.pid')
+        self.lines = []
+        for name, value in (('WALLTIME_GRACE_SECONDS', 1), ('STDOUT_ARCHIVE', 'False')):
+            patcher = mock.patch.object(job_runner, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def callback(self, stack_name, JobName, jobDefinition, JobQueue, lines):
+        self.lines.extend(lines)
+
+    def run_job(self, cmd, walltime=None):
+        started = time.time()
+        tail, status = job_runner.do_work(cmd, self.callback, 'test', 'job-1', 'test-definition', 'queue-1', None, walltime)
+        return tail, status, time.time() - started
+
+    def child_pid(self):
+        with open(self.pid_file) as f:
+            return int(f.read())
+
+    def test_job_past_its_walltime_ends_timed_out(self):
+        tail, status, seconds = self.run_job('echo started; sleep 30', walltime='1')
+
+        self.assertEqual(status, 'TimedOut')
+        self.assertLess(seconds, 10)
+        self.assertIn('started', tail)
+        self.assertIn('walltime of 1.0 seconds', tail[-1])
+
+    def test_directive_applies_without_an_item_walltime(self):
+        _, status, seconds = self.run_job('#HYPER -t 1\nsleep 30')
+
+        self.assertEqual(status, 'TimedOut')
+        self.assertLess(seconds, 10)
+
+    def test_item_walltime_wins_over_the_directive(self):
+        _, status, _ = self.run_job('#HYPER -t 1\nsleep 2; echo done', walltime='30')
+
+        self.assertEqual(status, 'Successful')
+        self.assertIn('done', self.lines)
+
+    def test_whole_process_group_is_killed_when_sigterm_is_ignored(self):
+        cmd = 'trap "" TERM; sleep 30 & echo $! > ' + self.pid_file + '; wait'
+
+        _, status, seconds = self.run_job(cmd, walltime='1')
+
+        self.assertEqual(status, 'TimedOut')
+        # one second of walltime, then SIGKILL after the grace time
+        self.assertLess(seconds, 10)
+        self.assertTrue(wait_gone(self.child_pid()))
+
+    def test_job_that_closes_its_output_is_still_stopped(self):
+        cmd = 'exec > /dev/null 2>&1; sleep 30 & echo $! > ' + self.pid_file + '; wait'
+
+        _, status, seconds = self.run_job(cmd, walltime='1')
+
+        self.assertEqual(status, 'TimedOut')
+        self.assertLess(seconds, 10)
+        self.assertTrue(wait_gone(self.child_pid()))
+
+    def test_invalid_walltime_runs_without_one(self):
+        _, status, _ = self.run_job('echo done', walltime='soon')
+
+        self.assertEqual(status, 'Successful')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import tempfile
+import unittest
+from unittest import mock
+
+import loader
+
+job_runner = loader.agent('job_runner')
+batch_processor = loader.worker()
+
+
+class PythonCommandTest(unittest.TestCase):
+
+    def test_plain_script_and_module(self):
+        self.assertEqual(job_runner.python_command(sys.executable + ' run.py --n 3'), {'script': 'run.py', 'argv': ['run.py', '--n', '3']})
+        self.assertEqual(job_runner.python_command('#HYPER -q queue\n' + sys.executable + ' -m tool arg'), {'module': 'tool', 'argv': ['tool', 'arg']})
+
+    def test_anything_else_goes_through_the_shell(self):
+        for cmd in ('echo hello', sys.executable + ' run.py | tee out', sys.executable + ' run.py\n' + sys.executable + ' other.py',
+                    sys.executable + ' -c "print(1)"', sys.executable + ' run.py > out', 'python-not-there run.py'):
+            self.assertEqual(job_runner.python_command(cmd), None, cmd)
+
+
+class WarmRuntimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.runtime = job_runner.warm_runtime(['json'])
+        self.runtime.socket_path = os.path.join(self.directory.name, 'warm.sock')
+        self.runtime.start()
+        self.addCleanup(self.runtime.terminate)
+        for _ in range(100):
+            if self.runtime.ready():
+                break
+            time.sleep(0.05)
+        self.assertTrue(self.runtime.ready())
+
+    def script(self, body):
+        path = os.path.join(self.directory.name, 'job.py')
+        with open(path, 'w') as f:
+            f.write(body)
+        return path
+
+    def test_job_output_comes_through_the_passed_pipe(self):
+        path = self.script('import os, sys\nprint("hello", os.environ["JOB_VALUE"], sys.argv[1:])\nsys.stdout.flush()\nprint("oops", file=sys.stderr)\nsys.exit(3)\n')
+
+        proc = self.runtime.launch(sys.executable + ' ' + path + ' a b', dict(os.environ, JOB_VALUE='42'))
+
+        self.assertFalse(proc == None)
+        output = proc.stdout.read().decode()
+        self.assertEqual(proc.wait(10), 3)
+        self.assertIn("hello 42 ['a', 'b']", output)
+        self.assertIn('oops', output)
+        self.assertFalse(proc.pid == os.getpid())
+
+    def test_shell_commands_are_not_forked(self):
+        self.assertEqual(self.runtime.launch('echo hello', None), None)
+
+    def test_job_is_pinned_to_the_requested_cpus(self):
+        cpu = sorted(os.sched_getaffinity(0))[0]
+        path = self.script('import os\nprint(sorted(os.sched_getaffinity(0)))\n')
+
+        proc = self.runtime.launch(sys.executable + ' ' + path, None, [cpu])
+
+        self.assertEqual(proc.stdout.read().decode().strip(), str([cpu]))
+        self.assertEqual(proc.wait(10), 0)
+
+
+class AgentFilesTest(unittest.TestCase):
+
+    def test_missing_files_come_from_the_worker_bucket(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        open(os.path.join(directory.name, 'present.py'), 'w').close()
+        client = mock.MagicMock()
+        client.download_file.side_effect = lambda bucket, key, path: open(path, 'w').close()
+
+        with mock.patch.object(batch_processor, 'AGENT_DIR', directory.name), mock.patch.object(batch_processor.boto3, 'client', return_value=client):
+            batch_processor.fetch_agent_files(['present.py', 'missing.py'])
+
+        self.assertEqual([c.args[:2] for c in client.download_file.call_args_list], [('test-worker-us-east-1', 'missing.py')])
+        self.assertTrue(os.path.exists(os.path.join(directory.name, 'missing.py')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#  Copyright Amazon.com Inc. or its affiliates. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import time
+# taken before the heavier imports so the startup record shows what they cost
+AGENT_START = time.time()
+import boto3
+import argparse
+import uuid
+import os
+import logging
+import sys
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+JOB_HELPER = os.path.join(AGENT_DIR, 'job_helper.py')
+
+ENABLE_QLOG = os.getenv("ENABLE_QLOG", "True")
+
+# job handoff and slots
+EXECUTION_MODE = os.getenv("CYCLONE_EXECUTION_MODE", "state_machine")
+STATIC_MANIFEST = os.getenv("CYCLONE_STATIC_MANIFEST")
+ARRAY_INDEX = int(os.getenv("AWS_BATCH_JOB_ARRAY_INDEX", "0"))
+HANDOFF_MODE = os.getenv("CYCLONE_HANDOFF", "push")
+IDLE_TIMEOUT = int(os.getenv("CYCLONE_IDLE_TIMEOUT", "10"))
+CONTAINER_VCPUS = float(os.getenv("CYCLONE_VCPUS", "1"))
+JOB_VCPUS = float(os.getenv("CYCLONE_JOB_VCPUS", os.getenv("CYCLONE_VCPUS", "1")))
+PREFETCH = int(os.getenv("CYCLONE_PREFETCH", "0"))
+LEASE_SECONDS = int(os.getenv("CYCLONE_LEASE_SECONDS", "120"))
+BUNDLE_SIZE = int(os.getenv("CYCLONE_BUNDLE_SIZE", "1"))
+LINGER_MIN = int(os.getenv("CYCLONE_LINGER_MIN", "0"))
+LINGER_MAX = min(150, int(os.getenv("CYCLONE_LINGER_MAX", "0")))
+IDLE_VCPU_CAP = float(os.getenv("CYCLONE_IDLE_VCPU_CAP", "0"))
+BACKLOG_SAMPLE_SECONDS = 10
+
+# job output
+TAIL_LINES = 50
+READ_CHUNK_BYTES = 65536
+MAX_LINE_BYTES = 65536
+BUNDLE_TAIL_LINES = 10
+BUNDLE_RESULTS_BYTES = 100000
+SPOOL_DIR = os.getenv("CYCLONE_SPOOL_DIR", "/tmp/cyclone-log-spool")
+
+# interruptions, walltime and heartbeats
+SPOT_ENDPOINT = os.getenv("CYCLONE_SPOT_ENDPOINT", "http://169.254.169.254/latest/meta-data/spot/instance-action")
+SPOT_POLL_SECONDS = int(os.getenv("CYCLONE_SPOT_POLL_SECONDS", "5"))
+SPOT_GRACE_SECONDS = int(os.getenv("CYCLONE_SPOT_GRACE_SECONDS", "30"))
+WALLTIME_GRACE_SECONDS = int(os.getenv("CYCLONE_WALLTIME_GRACE_SECONDS", "10"))
+HEARTBEAT_SECONDS = int(os.getenv("CYCLONE_HEARTBEAT_SECONDS", "20"))
+METRICS_SECONDS = int(os.getenv("CYCLONE_METRICS_SECONDS", "20"))
+CANCEL_CHECK_SECONDS = int(os.getenv("CYCLONE_CANCEL_CHECK_SECONDS", "60"))
+SAMPLE_SECONDS = int(os.getenv("CYCLONE_SAMPLE_SECONDS", "5"))
+
+# staging, input cache and checkpoints
+STAGE_CONCURRENCY = int(os.getenv("CYCLONE_STAGE_CONCURRENCY", "8"))
+STAGE_LOCAL_ROOT = os.getenv("CYCLONE_STAGE_LOCAL_ROOT")
+INPUT_CACHE_DIR = os.getenv("CYCLONE_INPUT_CACHE")
+INPUT_CACHE_GB = float(os.getenv("CYCLONE_INPUT_CACHE_GB", "50"))
+CHECKPOINT_SECONDS = int(os.getenv("CYCLONE_CHECKPOINT_SECONDS", "300"))
+
+# job runtime
+CPUINFO_CACHE_DIR = os.getenv("CYCLONE_CPUINFO_CACHE", "/tmp/cyclone-cpuinfo")
+WARM_MODULES = [name.strip() for name in os.getenv("CYCLONE_WARM_MODULES", "").split(',') if len(name.strip()) > 0]
+STDOUT_ARCHIVE = os.getenv("CYCLONE_STDOUT_ARCHIVE", "False")
+ARCHIVE_BLOCK_LINES = 10000
+ARCHIVE_BLOCK_BYTES = 1024 * 1024
+ARCHIVE_CHUNK_BYTES = int(os.getenv("CYCLONE_ARCHIVE_CHUNK_MB", "16")) * 1024 * 1024
+ARCHIVE_FLUSH_SECONDS = int(os.getenv("CYCLONE_ARCHIVE_FLUSH_SECONDS", "30"))
+PROFILE_RATE = int(os.getenv("CYCLONE_PROFILE_RATE", "100"))
+PROFILE_UPLOAD_SECONDS = int(os.getenv("CYCLONE_PROFILE_UPLOAD_SECONDS", "60"))
+PROC_PROFILE_MAX_RATE = 20
+CPU_PINNING = os.getenv("CYCLONE_CPU_PINNING", "True")
+CPU_LOCK_DIR = os.getenv("CYCLONE_CPU_LOCK_DIR", os.path.join(INPUT_CACHE_DIR, 'cpus') if not INPUT_CACHE_DIR == None else None)
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", logging.ERROR)
+cyc_root_log = logging.getLogger()
+cyc_root_log.setLevel(LOG_LEVEL)
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(LOG_LEVEL)
+cyc_root_log.addHandler(handler)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sf_arn', nargs=1)
+parser.add_argument('--async_table', nargs=1)
+parser.add_argument('--sqs_job_definition', nargs=1)
+parser.add_argument('--region', nargs=1)
+parser.add_argument('--main_region', nargs=1)
+parser.add_argument('--stack_name', nargs=1)
+parser.add_argument('--slots', nargs=1, type=int, help='Number of jobs to run concurrently, defaults to container vCPUs divided by job vCPUs')
+args = parser.parse_args()
+
+sf_arn =  args.sf_arn[0]
+cyc_root_log.info('## Initiated worker with sf_arn: \r' + sf_arn)
+table =  args.async_table[0]
+cyc_root_log.info('## Initiated worker with table: \r' + table)
+jobDefinition =  args.sqs_job_definition[0]
+cyc_root_log.info('## Initiated worker with job definition: \r' + jobDefinition)
+region = args.region[0]
+cyc_root_log.info('## Initiated worker with region: \r' + region)
+main_region = args.main_region[0]
+cyc_root_log.info('## Initiated worker with main region: \r' + main_region)
+stack_name = args.stack_name[0]
+cyc_root_log.info('## Initiated worker with stack name: \r' + stack_name)
+if not args.slots == None:
+    slots = max(1, args.slots[0])
+else:
+    slots = max(1, int(CONTAINER_VCPUS // JOB_VCPUS))
+cyc_root_log.info('## Initiated worker with slots: \r' + str(slots))
+
+worker_id = str(uuid.uuid4())
+
+# clients are shared by all slots, size the connection pool so slots do not queue for connections
+client_config = Config(max_pool_connections=max(10, slots * 4))
+#dynamo_main = boto3.client('dynamodb', region_name=main_region)
+dynamo = boto3.client('dynamodb', region_name=region, config=client_config)
+sf = boto3.client('stepfunctions', region_name=region, config=client_config)
+kinesis = boto3.client('kinesis', region_name=region, config=client_config)
+# job definition queues live in the main region, used to release leases on prefetched jobs
+sqs_main = boto3.client('sqs', region_name=main_region, config=client_config)
+dynamo_main = boto3.client('dynamodb', region_name=main_region, config=client_config)
+s3 = boto3.client('s3', region_name=region, config=client_config)
+# job checkpoints are kept in the main region so a retry in any region finds them
+s3_main = boto3.client('s3', region_name=main_region, config=client_config)
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=16 * 1024 * 1024, max_concurrency=STAGE_CONCURRENCY)
@@ -22,6 +22,7 @@ import jsonpickle
 import uuid
 from datetime import datetime
 import decimal
+import gzip
 from botocore.exceptions import ClientError
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", logging.ERROR)
@@ -47,6 +48,62 @@ def replace_decimals(obj):
     else:
         return obj
 
+# Most lines returned by one GET_LINES call
+MAX_ARCHIVE_LINES = 20000
+# Most bytes of (JSON encoded) lines returned by one GET_LINES call, keeps the response under the 6 MB Lambda response limit.
+# Callers page with the returned end (next_start) when a range holds more than this
+MAX_ARCHIVE_BYTES = 5 * 1024 * 1024
+
+def read_archive_lines(s3, bucket, queue, job_id, start, count, tail):
+    """Lines [start, start + count) of the latest stdout archive of a job, or the last count lines with tail.
+    Only the gzip blocks holding those lines are fetched, with ranged GETs on the chunk objects. Stops at MAX_ARCHIVE_BYTES,
+    from the front of the range when reading forward and from its back with tail, the returned start and end give the lines sent"""
+    prefix = 'stdout/' + queue + '/' + job_id + '/'
+    indexes = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/index.json'):
+                indexes.append(obj)
+    if len(indexes) == 0:
+        raise ValueError('No stdout archive for job ' + job_id)
+    # runs are prefixed with their start time, the latest run is the last one
+    index_key = sorted(indexes, key=lambda obj: obj['Key'])[-1]['Key']
+    run = index_key[:-len('index.json')]
+    index = json.loads(s3.get_object(Bucket=bucket, Key=index_key)['Body'].read())
+    count = max(0, min(int(count), MAX_ARCHIVE_LINES))
+    start = max(0, index['lines'] - count) if tail else max(0, int(start))
+    end = min(index['lines'], start + count)
+    blocks = [b for b in index['blocks'] if b[3] + b[4] > start and b[3] < end]
+    if tail:
+        blocks.reverse()
+    lines = []
+    size = 0
+    full = False
+    for chunk, offset, length, first_line, line_count in blocks:
+        body = s3.get_object(Bucket=bucket, Key=run + 'chunk-%06d.gz' % chunk, Range='bytes=' + str(offset) + '-' + str(offset + length - 1))['Body'].read()
+        block = gzip.decompress(body).decode('utf-8').split('\n')[:line_count]
+        block = block[max(0, start - first_line):end - first_line]
+        for line in (reversed(block) if tail else block):
+            line_size = len(json.dumps(line)) + 2
+            if size + line_size > MAX_ARCHIVE_BYTES:
+                if len(lines) == 0:
+                    # a single line over the budget is cut, at most 6 encoded bytes per character
+                    lines.append(line[:MAX_ARCHIVE_BYTES // 6])
+                full = True
+                break
+            lines.append(line)
+            size += line_size
+        if full:
+            break
+    if tail:
+        lines.reverse()
+        start = end - len(lines)
+    else:
+        end = start + len(lines)
+    return {'start': start, 'end': end, 'next_start': end if end < index['lines'] else None, 'lines': lines,
+            'total_lines': index['lines'], 'complete': index['complete'], 'archive': run}
+
 def respond(err, res=None, id=None):
     res['job_id'] = id
     if not err:
@@ -130,6 +187,28 @@ def lambda_handler(event, context):
         
 
 
+    if operation == 'GET_LINES':
+        try:
+            s3 = boto3.client('s3')
+            payload = body['payload']
+            res = read_archive_lines(s3, payload['bucket'], body['TableName'], payload['id'], payload.get('start', 0), payload.get('count', 100), payload.get('tail', False))
+            return {
+                'statusCode': '200',
+                'body': json.dumps(res),
+                'headers': {
+                    'Content-Type': 'application/json',
+                },
+            }
+        except Exception as e:
+            logger.error('## Get lines operation failed\r' + jsonpickle.encode(e))
+            return {
+                'statusCode': '400',
+                'body': json.dumps({'error': str(e)}),
+                'headers': {
+                    'Content-Type': 'application/json',
+                },
+            }
+
     if 'TableName' not in body:
         logger.error('## Queue not found\r' + jsonpickle.encode(body['TableName']))
         return respond(ValueError('Did not find TableName (jobQueue name)'))
@@ -65,6 +65,8 @@ def lambda_handler(event, context):
                     time_stamp = record['dynamodb']['NewImage']['tRetry']['S']
                 else:
                     time_stamp = record['dynamodb']['NewImage']['tFailed']['S']
+            elif record['dynamodb']['NewImage']['Status']['S'] == 'TimedOut':
+                time_stamp = record['dynamodb']['NewImage']['tTimedOut']['S']
             elif 'tERROR' in record['dynamodb']['NewImage']:
                 time_stamp = record['dynamodb']['NewImage']['tERROR']['S']
             else:
@@ -28,36 +28,157 @@ logger = logging.getLogger()
 logger.setLevel(LOG_LEVEL)
 patch_all()
 
+# Limits of one send_message_batch and one put_records call, and attempts for the entries a call reports as failed
+SQS_BATCH_ENTRIES = 10
+SQS_BATCH_BYTES = 256 * 1024
+KINESIS_BATCH_RECORDS = 500
+KINESIS_BATCH_BYTES = 5 * 1024 * 1024
+SEND_ATTEMPTS = 3
+
+# Kept across warm invocations: clients per (service, region), queue urls per (region, queue name) and the region rotation per weights setting
+clients = {}
+queue_urls = {}
+rotations = {}
+
+def get_client(service, region):
+    if not (service, region) in clients:
+        clients[(service, region)] = boto3.client(service, region_name=region)
+    return clients[(service, region)]
+
+def get_queue_url(sqs, region, queue_name):
+    if not (region, queue_name) in queue_urls:
+        queue_urls[(region, queue_name)] = sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
+    return queue_urls[(region, queue_name)]
+
+def get_rotation(region_weights):
+    """Regions repeated by their weight, parsed once per value of REGION_DISTRIBUTION_WEIGHTS"""
+    if not region_weights in rotations:
+        weights = region_weights.replace("{", "").replace("}", "").replace(" ","").replace("'","").replace('"','').split(",")
+        dictionary = {}
+        for i in weights:
+            dictionary[i.split(":")[0].strip('\'').replace("\"", "")] = i.split(":")[1].strip('"\'')
+        rotation_regions = []
+        for key in dictionary:
+            for i in range(int(dictionary[key])):
+                rotation_regions.append(key)
+        rotations[region_weights] = rotation_regions
+    return rotations[region_weights]
+
+def batches(entries, max_entries, max_bytes, size):
+    # consecutive groups of entries that fit in one call
+    batch = []
+    total = 0
+    for entry in entries:
+        if len(batch) > 0 and (len(batch) == max_entries or total + size(entry) > max_bytes):
+            yield batch
+            batch = []
+            total = 0
+        batch.append(entry)
+        total += size(entry)
+    if len(batch) > 0:
+        yield batch
+
+def send_with_retries(send, entries):
+    # send returns the (entry, reason) pairs that did not go through, those are sent again, returns what still failed at the end
+    failures = []
+    for attempt in range(SEND_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(attempt)
+        try:
+            failures = send(entries)
+        except Exception as e:
+            failures = [(entry, e) for entry in entries]
+        if len(failures) == 0:
+            return []
+        logger.error('## Failed to send ' + str(len(failures)) + ' entries, attempt ' + str(attempt + 1) + '\r' + jsonpickle.encode(str(failures[0][1])))
+        entries = [entry for entry, _ in failures]
+    return failures
+
+def mark_error(dynamo, data, error, e):
+    try:
+        dynamo.update_item(
+            TableName=data['jobQueue'],
+            Key={'id': {'S': data['id']}},
+            UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
+            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
+            ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': datetime.now().isoformat()}},
+            ReturnValues="UPDATED_NEW"
+            )
+    except Exception as update_error:
+        logger.error('## Failed to mark job ' + data['id'] + ' with tERROR\r' + jsonpickle.encode(update_error))
+
+def send_to_queues(sqs, region, dynamo, jobs):
+    """Job messages to the job definition queues with send_message_batch, returns the jobs that were queued"""
+    by_definition = {}
+    for data in jobs:
+        by_definition.setdefault(data['jobDefinition'], []).append((data, jsonpickle.encode(data)))
+    sent = []
+    for queue_name, entries in by_definition.items():
+        error = 'ERROR Could not send to task definition queue: ' + queue_name
+        try:
+            queue_url = get_queue_url(sqs, region, queue_name)
+        except Exception as e:
+            for data, _ in entries:
+                mark_error(dynamo, data, error, e)
+            continue
+
+        def send(batch):
+            try:
+                response = sqs.send_message_batch(QueueUrl=queue_url, Entries=[{'Id': str(i), 'MessageBody': body} for i, (_, body) in enumerate(batch)])
+            except Exception:
+                # the queue may have been recreated under a new url, look it up again next time
+                queue_urls.pop((region, queue_name), None)
+                raise
+            return [(batch[int(failed['Id'])], failed.get('Message', failed.get('Code'))) for failed in response.get('Failed', [])]
+
+        for batch in batches(entries, SQS_BATCH_ENTRIES, SQS_BATCH_BYTES, lambda entry: len(entry[1].encode('utf-8'))):
+            failures = send_with_retries(send, batch)
+            failed_ids = set()
+            for (data, _), reason in failures:
+                failed_ids.add(data['id'])
+                mark_error(dynamo, data, error, reason)
+            sent.extend(data for data, _ in batch if not data['id'] in failed_ids)
+    return sent
+
+def request_workers(dynamo, jobs, delivery_stream_name):
+    """One worker request per job to the cluster stream of the region it was rotated to, with put_records per region"""
+    by_region = {}
+    for data, region in jobs:
+        by_region.setdefault(region, []).append((data, bytes(json.dumps(data, default=str), 'utf-8')))
+    error = 'ERROR Failed to request worker from cluster: ' + delivery_stream_name
+    for region, entries in by_region.items():
+        try:
+            kinesis = get_client('kinesis', region)
+        except Exception as e:
+            for data, _ in entries:
+                mark_error(dynamo, data, error, e)
+            continue
+
+        def send(batch):
+            response = kinesis.put_records(StreamName=delivery_stream_name, Records=[{'Data': body, 'PartitionKey': data['jobDefinition']} for data, body in batch])
+            return [(batch[i], record.get('ErrorMessage', record['ErrorCode'])) for i, record in enumerate(response['Records']) if 'ErrorCode' in record]
+
+        for batch in batches(entries, KINESIS_BATCH_RECORDS, KINESIS_BATCH_BYTES, lambda entry: len(entry[1]) + len(entry[0]['jobDefinition'])):
+            for (data, _), reason in send_with_retries(send, batch):
+                mark_error(dynamo, data, error, reason)
+
 def lambda_handler(event, context):
 
     logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
     logger.info('## EVENT\r' + jsonpickle.encode(event))
     logger.info('## CONTEXT\r' + jsonpickle.encode(context))
 
-    region_weights = os.environ.get('REGION_DISTRIBUTION_WEIGHTS')
     delivery_stream_name = os.environ.get('CLUSTER_MAPPING')
     main_region = os.environ.get('MAIN_REGION')
-    
-    region_weights = region_weights.replace("{", "").replace("}", "").replace(" ","").replace("'","").replace('"','').split(",")
-            
-    dictionary = {}
-
-    for i in region_weights:
-        dictionary[i.split(":")[0].strip('\'').replace("\"", "")] = i.split(":")[1].strip('"\'')
-
-    region_weights = dictionary
-
-    rotation_regions = []
-    for key in dictionary:
-        for i in range(int(region_weights[key])):
-            rotation_regions.append(key)
+    rotation_regions = get_rotation(os.environ.get('REGION_DISTRIBUTION_WEIGHTS'))
 
     logger.info('## Region rotation\r' + jsonpickle.encode(rotation_regions))
 
-    #kinesis = boto3.client('kinesis')
-    dynamo = boto3.client('dynamodb', region_name=main_region)
-    sqs = boto3.resource('sqs', region_name=main_region)
+    dynamo = get_client('dynamodb', main_region)
+    sqs = get_client('sqs', main_region)
 
+    # jobs to dispatch, each goes to its definition queue (static array jobs excepted) and gets a worker request in the next rotation region
+    dispatch = []
     c = random.randint(0, len(rotation_regions))
     for record in event.get('Records'):
         
@@ -65,108 +186,32 @@ def lambda_handler(event, context):
             data = ddb_json.loads(record['dynamodb']['NewImage'])
             status = data['Status']
 
+            if status == 'Waiting':
+                logger.info('## DATA\r' + jsonpickle.encode(data))
+            elif status == 'Failed' or status == 'Interrupted':
+                retries = data['RetriesAvailable']
+                # interrupted jobs did not fail, they go back to the queue whatever retries are left
+                if not (status == 'Interrupted' or retries > 0):
+                    continue
+                logger.info('## DATA\r' + jsonpickle.encode(data))
+                # retries of static array jobs go through the queue like any other job
+                data['Dispatch'] = 'dynamic'
+            else:
+                continue
+
             try:
                 region = rotation_regions[c]
             except Exception:
                 c = 0
                 region = rotation_regions[c]
+            c = c+1
+            dispatch.append((data, region))
+
+    # static array jobs are bound to array children by the kinesis batch lambda, they only need the worker request
+    queued = send_to_queues(sqs, main_region, dynamo, [data for data, _ in dispatch if not data.get('Dispatch', 'dynamic') == 'static'])
+    queued_ids = set(data['id'] for data in queued)
+    requests = [(data, region) for data, region in dispatch if data.get('Dispatch', 'dynamic') == 'static' or data['id'] in queued_ids]
+    request_workers(dynamo, requests, delivery_stream_name)
 
-            retry = 3
-            count = 1
-            while count <= retry:
-                try:
-                    if status == 'Waiting':
-                        logger.info('## DATA\r' + jsonpickle.encode(data))
-                        queue_name = data['jobDefinition']
-                        c = c+1 
-                        try:
-                            queue = sqs.get_queue_by_name(QueueName=queue_name)
-                            # Send a new job message to sqs
-                            sqs_response = queue.send_message(MessageBody=jsonpickle.encode(data))
-                        except Exception as e:
-                            error = 'ERROR Could not send to task definition queue: ' + queue_name
-                            update = dynamo.update_item(
-                                TableName=data['jobQueue'],
-                                Key={'id': {'S': data['id']}},
-                                UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
-                                ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
-                                ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': datetime.now().isoformat()}},
-                                ReturnValues="UPDATED_NEW"
-                                )
-                            raise ValueError(e)
-                        
-                        try:
-                            # Send to kinesis (should change to firehose)
-                            kinesis = boto3.client('kinesis', region_name=region)
-
-                            kinesis_response = kinesis.put_record(
-                                StreamName=delivery_stream_name,
-                                Data=bytes(json.dumps(data, default=str), 'utf-8'),
-                                PartitionKey=data['jobDefinition']
-                            )
-                        except Exception as e:
-                            error = 'ERROR Failed to request worker from cluster: ' + delivery_stream_name
-                            update = dynamo.update_item(
-                                TableName=data['jobQueue'],
-                                Key={'id': {'S': data['id']}},
-                                UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
-                                ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
-                                ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': datetime.now().isoformat()}},
-                                ReturnValues="UPDATED_NEW"
-                                )
-                            raise ValueError(e)
-
-                        logger.info('## JOB_ID\r' + jsonpickle.encode(data['id']) + '## SEND MESSAGES SQS RESPONSE\r' + jsonpickle.encode(sqs_response) + '## PUT RECORD BATCH RESPONSE\r' + jsonpickle.encode(kinesis_response))
-                        break
-                    elif status == 'Failed':
-                        retries = data['RetriesAvailable']
-                        if retries > 0:
-                            logger.info('## DATA\r' + jsonpickle.encode(data))
-                            queue_name = data['jobDefinition']
-                            c = c+1 
-                            try:
-                                queue = sqs.get_queue_by_name(QueueName=queue_name)
-                                # Send a new job message to sqs
-                                sqs_response = queue.send_message(MessageBody=jsonpickle.encode(data))
-                            except Exception as e:
-                                error = 'ERROR Could not send to task definition queue: ' + queue_name
-                                update = dynamo.update_item(
-                                    TableName=data['jobQueue'],
-                                    Key={'id': {'S': data['id']}},
-                                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
-                                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
-                                    ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': datetime.now().isoformat()}},
-                                    ReturnValues="UPDATED_NEW"
-                                    )
-                                raise ValueError(e)
-                            
-                            try:
-                                # Send to kinesis (should change to firehose)
-                                kinesis = boto3.client('kinesis', region_name=region)
-                                kinesis_response = kinesis.put_record(
-                                    StreamName=delivery_stream_name,
-                                    Data=bytes(json.dumps(data, default=str), 'utf-8'),
-                                    PartitionKey=data['jobDefinition']
-                                )
-                            except Exception as e:
-                                error = 'ERROR Failed to request worker from cluster: ' + delivery_stream_name
-                                update = dynamo.update_item(
-                                    TableName=data['jobQueue'],
-                                    Key={'id': {'S': data['id']}},
-                                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
-                                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
-                                    ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': datetime.now().isoformat()}},
-                                    ReturnValues="UPDATED_NEW"
-                                    )
-                                raise ValueError(e)
-                            break
-                        break
-                    break
-                except Exception as e:
-                    time.sleep(1)
-                    logger.error('## Failed to forward resource request\r' + jsonpickle.encode(e))
-                    if count == retry:
-                        raise ValueError('ALL RETRIES FAILED')
-                    count += 1
-
-    return
\ No newline at end of file
+    logger.info('## DISPATCHED\r' + jsonpickle.encode({'jobs': len(dispatch), 'queued': len(queued), 'worker_requests': len(requests)}))
+    return
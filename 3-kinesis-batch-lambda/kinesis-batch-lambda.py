@@ -19,6 +19,7 @@ from aws_xray_sdk.core import patch_all
 import logging
 import jsonpickle
 import base64
+import uuid
 from datetime import datetime
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", logging.ERROR)
@@ -26,6 +27,31 @@ logger = logging.getLogger()
 logger.setLevel(LOG_LEVEL)
 patch_all()
 
+# AWS Batch limit on array job size
+MAX_ARRAY_SIZE = 10000
+
+
+def array_order(job_id):
+    """Sort array job ids (array_id--index) by array and then by index"""
+    array_id, _, index = job_id.rpartition('--')
+    try:
+        return (array_id, int(index))
+    except ValueError:
+        return (job_id, 0)
+
+
+def mark_error(dynamo, queue, ids, error, e):
+    now = datetime.now().isoformat()
+    for id in ids:
+        dynamo.update_item(
+            TableName=queue,
+            Key={'id': {'S': id}},
+            UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q",
+            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tERROR'},
+            ExpressionAttributeValues={':p': {'S': str(error)}, ':r': {'S': str(e)}, ':q': {'S': now}},
+            ReturnValues="UPDATED_NEW"
+            )
+
 
 def lambda_handler(event, context):
 
@@ -40,6 +66,7 @@ def lambda_handler(event, context):
 
     batch = boto3.client('batch')
     ssm = boto3.client('ssm')
+    s3 = boto3.client('s3')
     dynamo = boto3.client('dynamodb', region_name=main_region)
     
     worker_script_s3_location =  's3://' + os.environ.get("WORKER_SCRIPT_S3KEY")
@@ -56,12 +83,19 @@ def lambda_handler(event, context):
 
     full_list =[]
     id_dict = {}
+    static_dict = {}
+    batchResponse = None
     for record in event.get("Records"):
         # Kinesis data is base64 encoded so decode here
         message_str = base64.b64decode(record['kinesis']['data']).decode("utf-8")
         message = json.loads(message_str)
         logger.info('## KINESIS MESSAGE\r' + jsonpickle.encode(message))
         jd_queue_string = message['jobDefinition'] + '__H__' + message['jobQueue']
+        if message.get('Dispatch', 'dynamic') == 'static':
+            if not jd_queue_string in static_dict:
+                static_dict[jd_queue_string] = []
+            static_dict[jd_queue_string].append(message['id'])
+            continue
         full_list.append(jd_queue_string)
         if not jd_queue_string in id_dict:
             id_dict[jd_queue_string] = []
@@ -136,6 +170,52 @@ def lambda_handler(event, context):
                     )
             raise ValueError(e)
 
+    # static array jobs: each array child gets a contiguous slice of a manifest instead of competing for jobs through SQS
+    bucket = stack_name + '-worker-' + region
+    for item, ids in static_dict.items():
+
+        job_def, queue = item.split('__H__')
+
+        try:
+            response = ssm.get_parameter(
+                Name=job_def,
+            )
+            per_child = max(1, int(round(float(response['Parameter']['Value']))))
+            per_child = max(per_child, -(-len(ids) // MAX_ARRAY_SIZE))
+            num = -(-len(ids) // per_child)
+
+            key = 'manifests/' + str(uuid.uuid4()) + '.json'
+            manifest = {'queue': queue, 'per_child': per_child, 'ids': sorted(ids, key=array_order)}
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest))
+
+            container_overrides = {
+                "command": ["./start.sh", worker_script_s3_location, sf_arn, async_table, job_def, region, main_region, stack_name],
+                "environment": [{"name": "CYCLONE_STATIC_MANIFEST", "value": 's3://' + bucket + '/' + key}]
+                }
+            if num >= 2:
+                batchResponse = batch.submit_job(jobName=item, 
+                                                    jobQueue=batchProcessingJobQueue, 
+                                                    jobDefinition=job_def,
+                                                    containerOverrides=container_overrides,
+                                                    arrayProperties={"size": num},
+                                                    tags={'jobQueue': queue}
+                                                    )
+            else:
+                batchResponse = batch.submit_job(jobName=item, 
+                                                    jobQueue=batchProcessingJobQueue, 
+                                                    jobDefinition=job_def,
+                                                    containerOverrides=container_overrides,
+                                                    tags={'jobQueue': queue}
+                                                    )
+            # the failed worker lambda sweep follows the array children to release slices of children that hang or never start
+            manifest.update({'array_job_id': batchResponse['jobId'], 'children': num})
+            s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest))
+        except Exception as e:
+            error = 'ERROR Failed to submit static array worker request to: ' + batchProcessingJobQueue + ' ' + region
+            logger.error(error + jsonpickle.encode(e))
+            mark_error(dynamo, queue, ids, error, e)
+            raise ValueError(e)
+
     logger.info('## BATCH SUBMIT JOB RESPONSE\r' + jsonpickle.encode(batchResponse))
     
     return True
@@ -30,13 +30,50 @@ main_region = os.environ.get('MAIN_REGION')
 
 SQS = boto3.client("sqs", region_name=main_region)
 dynamo = boto3.client('dynamodb')
+# wake queues are created by workers in the same region as this lambda
+NOTIFY = boto3.client("sqs")
+SF = boto3.client("stepfunctions")
+# SQS message size limit, larger commands are read by the worker from the async table instead
+NOTIFY_MAX_BYTES = 250000
+# Largest encoded bundle, the bundle and the results the worker writes next to it share one 400 KB async table item
+MAX_BUNDLE_BYTES = 120000
+# Visibility of the extra messages of a bundle until they are deleted, the state machine task heartbeat window so they come back if the handler dies
+BUNDLE_CLAIM_SECONDS = 60
+# longest linger a worker can ask for, leaves room for the rest of the handler within the lambda timeout
+MAX_LINGER_SECONDS = 150
 
-def get_job(event):
+def is_leased(event):
+    return not event["Input"].get("lease_seconds", "null") == "null"
+
+
+def linger_seconds(event):
+    """Seconds the worker keeps the slot open for a new job, sent with the last job result or the execution input"""
+    seconds = event["Input"].get("lastJob", {}).get("linger_seconds", event["Input"].get("linger_seconds", "null"))
+    if seconds == "null":
+        return 0
+    return max(0, min(MAX_LINGER_SECONDS, int(seconds)))
+
+
+def bundle_size(event):
+    """Jobs claimed per handoff, bundles are not leased so a prefetching worker gets single jobs"""
+    size = event["Input"].get("bundle_size", "null")
+    if size == "null" or is_leased(event):
+        return 1
+    return max(1, int(size))
+
+
+def get_job(event, wait_seconds=0):
     """
     Lambda handler
     """
 
     queue_url = SQS.get_queue_url(QueueName=event["Input"]["sqs_name"])
+    event['queue_url'] = queue_url["QueueUrl"]
+
+    # a prefetching worker holds the message under a lease instead of having it deleted here
+    visibility = 5
+    if is_leased(event):
+        visibility = int(event["Input"]["lease_seconds"])
 
     response = SQS.receive_message(
         QueueUrl=queue_url["QueueUrl"],
@@ -48,8 +85,8 @@ def get_job(event):
         MessageAttributeNames=[
             "All"
         ],
-        VisibilityTimeout=5,
-        WaitTimeSeconds=0,
+        VisibilityTimeout=visibility,
+        WaitTimeSeconds=wait_seconds,
     )
 
     try:
@@ -62,6 +99,27 @@ def get_job(event):
     return message
 
 
+def get_bundle(event, count):
+    """
+    Claim up to count more messages for a bundle, stops at the first empty receive
+    """
+
+    messages = []
+    while len(messages) < count:
+        response = SQS.receive_message(
+            QueueUrl=event['queue_url'],
+            MaxNumberOfMessages=min(10, count - len(messages)),
+            VisibilityTimeout=BUNDLE_CLAIM_SECONDS,
+            WaitTimeSeconds=0,
+        )
+        if len(response.get("Messages", [])) == 0:
+            break
+        messages.extend(response["Messages"])
+
+    logger.info('## GOT_BUNDLE_SQS\r' + jsonpickle.encode(len(messages)))
+    return messages
+
+
 def extract_job(event):
     """
     Lambda handler
@@ -73,7 +131,8 @@ def extract_job(event):
     job_details = {
         "job_id": message['id'],
         "commands": message['commands'],
-        "queue": message['jobQueue']
+        "queue": message['jobQueue'],
+        "walltime": str(message.get('walltime', 'null'))
     }
     logger.info('## EXTRACT_JOB_DETAILS\r' + jsonpickle.encode(job_details))
 
@@ -82,18 +141,70 @@ def extract_job(event):
 
 def grid_start_job(event):
     logger.info('## EVENT\r' + jsonpickle.encode(event))
+
+    # leased jobs stay on the definition queue until the worker starts them
+    leased = 'False'
+    receipt_handle = 'null'
+    if is_leased(event) and 'raw_message' in event and not event['job_details']['job_id'] == 'null':
+        leased = 'True'
+        receipt_handle = event['raw_message']['ReceiptHandle']
+
+    # the jobs of a bundle, the first one is also written as the slot's own job
+    bundle = 'null'
+    results = 'null'
+    if len(event.get('bundle', [])) > 1:
+        bundle = json.dumps(event['bundle'])
+        # no job of the bundle has started, the async stream lambda queues them again if the bundle fails now
+        results = json.dumps([{'id': job['job_id'], 'JobQueue': job['queue'], 'Status': 'Starting', 'Output': 'null'} for job in event['bundle']])
  
     response = dynamo.update_item(
         TableName=event['Input']['table'],
         Key={'uuid': {'S': event['Input']['uuid']}},
-        UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :s, #attr5 = :t, #attr6 = :u, #attr7 = :v, #attr8 = :x",
-        ExpressionAttributeNames={'#attr1': 'command', '#attr2': 'LeaveRunning', '#attr3': 'Callback', '#attr4': 'id', '#attr5': 'CurrentTime', '#attr6': 'JobQueue', '#attr7': 'Output', '#attr8': 'Status'},
-        ExpressionAttributeValues={':p': {'S': str(event['job_details']['commands'])}, ':r': {'S': str(event['Input']['LeaveRunning'])}, ':q': {'S': str(event['TaskToken'])}, ':s': {'S': str(event['job_details']['job_id'])}, ':t': {'S': datetime.now().isoformat()}, ':u': {'S': str(event['job_details']['queue'])}, ':v': {'S': str('null')}, ':x': {'S': str('Starting')}},
+        UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :s, #attr5 = :t, #attr6 = :u, #attr7 = :v, #attr8 = :x, #attr9 = :y, #attr10 = :z, #attr11 = :w, #attr12 = :b, #attr13 = :n, #attr14 = :m",
+        ExpressionAttributeNames={'#attr1': 'command', '#attr2': 'LeaveRunning', '#attr3': 'Callback', '#attr4': 'id', '#attr5': 'CurrentTime', '#attr6': 'JobQueue', '#attr7': 'Output', '#attr8': 'Status', '#attr9': 'Leased', '#attr10': 'ReceiptHandle', '#attr11': 'QueueUrl', '#attr12': 'Bundle', '#attr13': 'BundleResults', '#attr14': 'Walltime'},
+        ExpressionAttributeValues={':p': {'S': str(event['job_details']['commands'])}, ':r': {'S': str(event['Input']['LeaveRunning'])}, ':q': {'S': str(event['TaskToken'])}, ':s': {'S': str(event['job_details']['job_id'])}, ':t': {'S': datetime.now().isoformat()}, ':u': {'S': str(event['job_details']['queue'])}, ':v': {'S': str('null')}, ':x': {'S': str('Starting')}, ':y': {'S': leased}, ':z': {'S': receipt_handle}, ':w': {'S': str(event.get('queue_url', 'null'))}, ':b': {'S': bundle}, ':n': {'S': results}, ':m': {'S': str(event['job_details'].get('walltime', 'null'))}},
         ReturnValues="UPDATED_NEW"
         )
     logger.info('## DYNAMO_RESPONSE\r' + jsonpickle.encode(response))
 
+    notify_worker(event, leased, receipt_handle, bundle)
+
     return response
+
+
+def notify_worker(event, leased, receipt_handle, bundle):
+    """
+    Wake the worker waiting on the slot instead of letting it poll the async table
+    """
+
+    notify_url = event['Input'].get('notify_url', 'null')
+    if notify_url == 'null':
+        return
+
+    payload = {
+        "uuid": event['Input']['uuid'],
+        "command": str(event['job_details']['commands']),
+        "LeaveRunning": str(event['Input']['LeaveRunning']),
+        "Callback": str(event['TaskToken']),
+        "id": str(event['job_details']['job_id']),
+        "JobQueue": str(event['job_details']['queue']),
+        "Leased": leased,
+        "ReceiptHandle": receipt_handle,
+        "QueueUrl": str(event.get('queue_url', 'null')),
+        "Bundle": bundle,
+        "Walltime": str(event['job_details'].get('walltime', 'null'))
+    }
+    body = json.dumps(payload)
+    if len(body.encode('utf-8')) > NOTIFY_MAX_BYTES:
+        payload.pop('command')
+        payload.pop('Bundle')
+        body = json.dumps(payload)
+
+    try:
+        NOTIFY.send_message(QueueUrl=notify_url, MessageBody=body)
+    except Exception as e:
+        # the worker checks the async table before giving up so a lost wake up only costs latency
+        logger.error('## NOTIFY_WORKER ERROR\r' + jsonpickle.encode(str(e)))
     
 
 def delete_job(event):
@@ -110,6 +221,34 @@ def delete_job(event):
     )
 
 
+def release_bundle(event, messages):
+    """
+    Put messages that did not fit in the bundle back on the queue for the next claim
+    """
+
+    for i in range(0, len(messages), 10):
+        response = SQS.change_message_visibility_batch(
+            QueueUrl=event['queue_url'],
+            Entries=[{'Id': str(n), 'ReceiptHandle': m['ReceiptHandle'], 'VisibilityTimeout': 0} for n, m in enumerate(messages[i:i + 10])]
+        )
+        if len(response.get('Failed', [])) > 0:
+            logger.error('## RELEASE_BUNDLE ERROR\r' + jsonpickle.encode(response['Failed']))
+
+
+def delete_bundle(event, messages):
+    """
+    Delete the extra messages of a bundle once the bundle is written to the slot
+    """
+
+    for i in range(0, len(messages), 10):
+        response = SQS.delete_message_batch(
+            QueueUrl=event['queue_url'],
+            Entries=[{'Id': str(n), 'ReceiptHandle': m['ReceiptHandle']} for n, m in enumerate(messages[i:i + 10])]
+        )
+        if len(response.get('Failed', [])) > 0:
+            logger.error('## DELETE_BUNDLE ERROR\r' + jsonpickle.encode(response['Failed']))
+
+
 def lambda_handler(event, context):
 
     logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
@@ -118,15 +257,23 @@ def lambda_handler(event, context):
 
     token = event['TaskToken']
 
-    #get job
+    #get job, for a lingering worker keep long-polling until its linger time is up
+    linger_until = time.time() + linger_seconds(event)
     retry = 3
     count = 1
     while count <= retry:
         try:
-            event['raw_message'] = get_job(event)
+            event['raw_message'] = get_job(event, int(max(0, min(20, linger_until - time.time()))))
             break
         except:
             time.sleep(1)
+            if time.time() < linger_until:
+                # the state machine times out the task after 60 seconds without a heartbeat
+                try:
+                    SF.send_task_heartbeat(taskToken=token)
+                except Exception as e:
+                    logger.error('## HEARTBEAT ERROR\r' + jsonpickle.encode(str(e)))
+                continue
             if count == retry:
                 job_details = {
                     "job_id": "null",
@@ -165,6 +312,35 @@ def lambda_handler(event, context):
               logger.error('## EXTRACT_JOB_ERROR\r' + jsonpickle.encode('Could not extract job details'))
               return event
             count += 1
+
+    #claim more jobs for a bundle, kept out of the returned event so the state stays small
+    extra_messages = []
+    if bundle_size(event) > 1:
+        event['bundle'] = [event['job_details']]
+        bundle_bytes = len(json.dumps(event['bundle']))
+        overflow = []
+        try:
+            for message in get_bundle(event, bundle_size(event) - 1):
+                try:
+                    job = extract_job(message)
+                except Exception:
+                    extra_messages.append(message)
+                    logger.error('## EXTRACT_JOB_ERROR\r' + jsonpickle.encode(message))
+                    continue
+                job_bytes = len(json.dumps(job)) + 2
+                if bundle_bytes + job_bytes > MAX_BUNDLE_BYTES:
+                    overflow.append(message)
+                    continue
+                extra_messages.append(message)
+                event['bundle'].append(job)
+                bundle_bytes += job_bytes
+        except Exception as e:
+            logger.error('## GET_BUNDLE ERROR\r' + jsonpickle.encode(str(e)))
+        if len(overflow) > 0:
+            try:
+                release_bundle(event, overflow)
+            except Exception as e:
+                logger.error('## RELEASE_BUNDLE ERROR\r' + jsonpickle.encode(str(e)))
     
     #start job
     retry = 3
@@ -177,8 +353,21 @@ def lambda_handler(event, context):
             time.sleep(1)
             logger.error('## START_JOB\r' + jsonpickle.encode('Failed to start job (write to dynamo async table)'))
             if count == retry:
+                event.pop('bundle', None)
                 return event
             count += 1
+    event.pop('bundle', None)
+
+    #the rest of a bundle is deleted in batches, unparsable messages with them
+    if len(extra_messages) > 0:
+        try:
+            delete_bundle(event, extra_messages)
+        except Exception as e:
+            logger.error('## DELETE_BUNDLE ERROR\r' + jsonpickle.encode(str(e)))
+
+    #leased jobs are deleted by the worker when it starts running them
+    if is_leased(event):
+        return event
 
     #delete job
     retry = 3
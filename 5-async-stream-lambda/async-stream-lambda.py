@@ -13,6 +13,7 @@
 #  limitations under the License.
 
 import os
+import json
 import boto3
 from aws_xray_sdk.core import patch_all
 import logging
@@ -52,108 +53,165 @@ def lambda_handler(event, context):
             if job_id == 'null':
                 continue
 
-            retry = 3
-            count = 1
-            while count <= retry:
-                try:
-                    res = dynamo.get_item(
-                                TableName=table,
-                                Key={
-                                    'id': {
-                                        'S': job_id}},       
-                                AttributesToGet=[
-                                    'RetriesAvailable',
-                                    'Status'
-                                ])
-                    
-                    RetriesAvailable = int(res['Item']['RetriesAvailable']['N'])
-                    LastStatus = res['Item']['Status']['S']
-                    break
-                except:
-                    time.sleep(1)
-                    logger.error('## No matching job in queue table to update ' + jsonpickle.encode(job_id))
-                    if count == retry:
-                        raise ValueError('ALL RETRIES FAILED')
-                    count += 1
-            
-            if LastStatus == 'Successful':
+            # a prefetched job that never started is still leased on the definition queue and goes back to SQS by itself
+            if (Status == 'Failed' or Status == 'Interrupted') and data.get('Leased', 'False') == 'True':
+                logger.info('## Leased job released back to queue ' + jsonpickle.encode(job_id))
+                continue
+
+            # a bundle carries one result per job, each job keeps its own status and retries in its queue table
+            if not data.get('BundleResults', 'null') == 'null':
+                for entry in json.loads(data['BundleResults']):
+                    entry_status = entry['Status']
+                    if Status in ('Starting', 'Running'):
+                        # progress of a bundle still running, only the job that started is updated, results wait for the bundle status
+                        if not entry_status == 'Running':
+                            continue
+                    elif entry_status == 'Starting':
+                        # the bundle ended before this job started, it is queued again like an interrupted job and keeps its retries
+                        entry_status = 'Interrupted'
+                    elif Status == 'Failed' and entry_status == 'Running':
+                        # the state machine failed the bundle while this job ran, it fails with it
+                        entry_status = 'Failed'
+                    update_job(dynamo, entry['id'], entry_status, entry['Output'], entry['JobQueue'], time_stamp, data)
                 continue
-            
-            retry = 3
-            count = 1
-            while count <= retry:
-                try:
-                    if Status == 'Failed':
-                        if RetriesAvailable > 0:
-                            NewRetries = RetriesAvailable -1
-                            update = dynamo.update_item(
-                                TableName=table,
-                                Key={'id': {'S': job_id}},
-                                UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
-                                ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tRetry'},
-                                ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(NewRetries)}, ':t': {'S': time_stamp}},
-                                ReturnValues="UPDATED_NEW"
-                                )
-                            logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
-                            break
-                        else:
-                            update = dynamo.update_item(
-                                TableName=table,
-                                Key={'id': {'S': job_id}},
-                                UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
-                                ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tFailed'},
-                                ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(RetriesAvailable)}, ':t': {'S': time_stamp}},
-                                ReturnValues="UPDATED_NEW"
-                                )
-                            logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
-                            break
-                    elif Status == 'JobFailed':
-                        NewRetries = 0
-                        Status = 'Failed'
-                        update = dynamo.update_item(
+
+            update_job(dynamo, job_id, Status, Output, table, time_stamp, data)
+
+
+def update_job(dynamo, job_id, Status, Output, table, time_stamp, data):
+    retry = 3
+    count = 1
+    while count <= retry:
+        try:
+            res = dynamo.get_item(
+                        TableName=table,
+                        Key={
+                            'id': {
+                                'S': job_id}},       
+                        AttributesToGet=[
+                            'RetriesAvailable',
+                            'Status'
+                        ])
+
+            if not 'Item' in res:
+                # deleted with qdel, a running job is cancelled by its worker and nothing is left to update
+                logger.info('## Job no longer in queue table ' + jsonpickle.encode(job_id))
+                return
+
+            RetriesAvailable = int(res['Item']['RetriesAvailable']['N'])
+            LastStatus = res['Item']['Status']['S']
+            break
+        except:
+            time.sleep(1)
+            logger.error('## No matching job in queue table to update ' + jsonpickle.encode(job_id))
+            if count == retry:
+                raise ValueError('ALL RETRIES FAILED')
+            count += 1
+    
+    if LastStatus == 'Successful':
+        return
+    
+    retry = 3
+    count = 1
+    while count <= retry:
+        try:
+            if Status == 'Failed':
+                if RetriesAvailable > 0:
+                    NewRetries = RetriesAvailable -1
+                    update = dynamo.update_item(
+                        TableName=table,
+                        Key={'id': {'S': job_id}},
+                        UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
+                        ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tRetry'},
+                        ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(NewRetries)}, ':t': {'S': time_stamp}},
+                        ReturnValues="UPDATED_NEW"
+                        )
+                    logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                    break
+                else:
+                    update = dynamo.update_item(
+                        TableName=table,
+                        Key={'id': {'S': job_id}},
+                        UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
+                        ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tFailed'},
+                        ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(RetriesAvailable)}, ':t': {'S': time_stamp}},
+                        ReturnValues="UPDATED_NEW"
+                        )
+                    logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                    break
+            elif Status == 'JobFailed':
+                NewRetries = 0
+                Status = 'Failed'
+                update = dynamo.update_item(
+                    TableName=table,
+                    Key={'id': {'S': job_id}},
+                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
+                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tRetry'},
+                    ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(NewRetries)}, ':t': {'S': time_stamp}},
+                    ReturnValues="UPDATED_NEW"
+                    )
+                logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                break
+
+
+            elif Status == 'Interrupted':
+                # the worker was reclaimed, queued again by the dynamo stream without using a retry
+                update = dynamo.update_item(
+                    TableName=table,
+                    Key={'id': {'S': job_id}},
+                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
+                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tInterrupted'},
+                    ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
+                    ReturnValues="UPDATED_NEW"
+                    )
+                logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                break
+
+            elif Status == 'TimedOut':
+                # killed after its walltime, a hung job is not retried
+                update = dynamo.update_item(
+                    TableName=table,
+                    Key={'id': {'S': job_id}},
+                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
+                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tTimedOut'},
+                    ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
+                    ReturnValues="UPDATED_NEW"
+                    )
+                logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                break
+
+            elif Status == 'Running':
+                update = dynamo.update_item(
                             TableName=table,
                             Key={'id': {'S': job_id}},
-                            UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :q, #attr4 = :t",
-                            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'RetriesAvailable', '#attr4': 'tRetry'},
-                            ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':q': {'N': str(NewRetries)}, ':t': {'S': time_stamp}},
+                            UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
+                            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tRunning'},
+                            ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
                             ReturnValues="UPDATED_NEW"
                             )
-                        logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
-                        break
-
-
-                    elif Status == 'Running':
-                        update = dynamo.update_item(
-                                    TableName=table,
-                                    Key={'id': {'S': job_id}},
-                                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
-                                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tRunning'},
-                                    ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
-                                    ReturnValues="UPDATED_NEW"
-                                    )
-
-                        logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
-                        break
-
-                    elif Status == "Successful":
-                        update = dynamo.update_item(
-                                    TableName=table,
-                                    Key={'id': {'S': job_id}},
-                                    UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
-                                    ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tSuccessful'},
-                                    ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
-                                    ReturnValues="UPDATED_NEW"
-                                    )
-
-                        logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
-                        break
-                    else:
-                        logger.error('## UNHANDLED STATUS\r' + jsonpickle.encode(data))
-                        break
-                    break
-                except Exception:
-                    time.sleep(1)
-                    logger.error('## Failed to update main region queue table for: \r' + jsonpickle.encode(data))
-                    if count == retry:
-                        raise ValueError('ALL RETRIES FAILED')
-                    count += 1
\ No newline at end of file
+
+                logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                break
+
+            elif Status == "Successful":
+                update = dynamo.update_item(
+                            TableName=table,
+                            Key={'id': {'S': job_id}},
+                            UpdateExpression="set #attr1 = :p, #attr2 = :r, #attr3 = :t",
+                            ExpressionAttributeNames={'#attr1': 'Status', '#attr2': 'Output', '#attr3': 'tSuccessful'},
+                            ExpressionAttributeValues={':p': {'S': str(Status)}, ':r': {'S': str(Output)}, ':t': {'S': time_stamp}},
+                            ReturnValues="UPDATED_NEW"
+                            )
+
+                logger.info('## PUT MESSAGE DYNAMODB RESPONSE\r' + jsonpickle.encode(update))
+                break
+            else:
+                logger.error('## UNHANDLED STATUS\r' + jsonpickle.encode(data))
+                break
+            break
+        except Exception:
+            time.sleep(1)
+            logger.error('## Failed to update main region queue table for: \r' + jsonpickle.encode(data))
+            if count == retry:
+                raise ValueError('ALL RETRIES FAILED')
+            count += 1
\ No newline at end of file
@@ -20,6 +20,7 @@ from aws_xray_sdk.core import patch_all
 import logging
 from datetime import datetime
 import json
+import time
 import jsonpickle
 
 
@@ -32,6 +33,205 @@ main_region = os.environ.get('MAIN_REGION')
 
 dynamo_r = boto3.resource('dynamodb', region_name=main_region)
 dynamo_c = boto3.client('dynamodb', region_name=main_region)
+# wake queues live in the region of their worker, the same region as this lambda
+stack_name = os.environ.get('STACK_NAME')
+sqs = boto3.client('sqs')
+batch = boto3.client('batch')
+# Wake queues of workers that were not Batch jobs are swept once they are this old
+UNTRACKED_WAKE_QUEUE_SECONDS = 7 * 24 * 3600
+ACTIVE_JOB_STATES = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING']
+# Static array children that have not started this long after submission lose their slice to the queue
+STATIC_PICKUP_SECONDS = int(os.environ.get('STATIC_PICKUP_SECONDS', '900'))
+s3_local = boto3.client('s3')
+
+
+def delete_wake_queue(job_id):
+    """Remove the wake queue of a worker that died before it could delete its own"""
+    name = stack_name + '-wake-' + job_id.replace(':', '-')
+    try:
+        sqs.delete_queue(QueueUrl=sqs.get_queue_url(QueueName=name)['QueueUrl'])
+        logger.info('## DELETED WAKE QUEUE\r' + name)
+    except sqs.exceptions.QueueDoesNotExist:
+        pass
+    except Exception as e:
+        logger.error('## FAILED TO DELETE WAKE QUEUE\r' + jsonpickle.encode(str(e)))
+
+
+def sweep_wake_queues():
+    """Backstop run on a schedule, deletes the wake queues (tagged cyclone:worker) whose Batch job is no longer active"""
+    queues = {}
+    paginator = sqs.get_paginator('list_queues')
+    for page in paginator.paginate(QueueNamePrefix=stack_name + '-wake-'):
+        for url in page.get('QueueUrls', []):
+            tags = sqs.list_queue_tags(QueueUrl=url).get('Tags', {})
+            if 'cyclone:worker' in tags:
+                queues[url] = tags.get('cyclone:batch-job', 'null')
+
+    ids = list(set(job for job in queues.values() if not job == 'null'))
+    active = set()
+    for i in range(0, len(ids), 100):
+        for job in batch.describe_jobs(jobs=ids[i:i + 100])['jobs']:
+            if job['status'] in ACTIVE_JOB_STATES:
+                active.add(job['jobId'])
+
+    deleted = 0
+    for url, job in queues.items():
+        try:
+            if job == 'null':
+                created = sqs.get_queue_attributes(QueueUrl=url, AttributeNames=['CreatedTimestamp'])['Attributes']['CreatedTimestamp']
+                if time.time() - int(created) < UNTRACKED_WAKE_QUEUE_SECONDS:
+                    continue
+            elif job in active:
+                continue
+            sqs.delete_queue(QueueUrl=url)
+            deleted += 1
+        except sqs.exceptions.QueueDoesNotExist:
+            pass
+        except Exception as e:
+            logger.error('## FAILED TO SWEEP WAKE QUEUE ' + url + '\r' + jsonpickle.encode(str(e)))
+    logger.info('## SWEPT WAKE QUEUES\r' + jsonpickle.encode({'queues': len(queues), 'deleted': deleted}))
+
+
+def static_slice(event):
+    """Job ids a failed static array child was bound to, None for ordinary workers"""
+    manifest_url = None
+    for env in event['detail'].get('container', {}).get('environment', []):
+        if env['name'] == 'CYCLONE_STATIC_MANIFEST':
+            manifest_url = env['value']
+    if manifest_url == None:
+        return None
+
+    bucket, _, key = manifest_url.replace('s3://', '', 1).partition('/')
+    s3 = boto3.client('s3', region_name=bucket.rpartition('-worker-')[2])
+    manifest = json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+    index = int(event['detail'].get('arrayProperties', {}).get('index', 0))
+    per_child = int(manifest['per_child'])
+    return manifest['ids'][index * per_child:(index + 1) * per_child]
+
+
+def release_static_job(queue, id, now, expired_before=None):
+    """Send an unfinished static job through the queue, the dynamo stream picks up the change. With expired_before only a running
+    job whose claim ran out before then is taken back"""
+    try:
+        # not started yet, handing it to the dynamic path sends it to SQS
+        dynamo_c.update_item(
+            TableName=queue,
+            Key={'id': {'S': id}},
+            UpdateExpression="set #attr1 = :d",
+            ConditionExpression="#attr2 = :w AND #attr1 = :s",
+            ExpressionAttributeNames={'#attr1': 'Dispatch', '#attr2': 'Status'},
+            ExpressionAttributeValues={':d': {'S': 'dynamic'}, ':w': {'S': 'Waiting'}, ':s': {'S': 'static'}},
+            ReturnValues="UPDATED_NEW"
+            )
+        return
+    except dynamo_c.exceptions.ConditionalCheckFailedException:
+        pass
+    names = {'#attr1': 'Dispatch', '#attr2': 'Status', '#attr3': 'tRetry'}
+    values = {':d': {'S': 'dynamic'}, ':f': {'S': 'Failed'}, ':r': {'S': 'Running'}, ':s': {'S': 'static'}, ':q': {'S': now}}
+    condition = "#attr2 = :r AND #attr1 = :s"
+    if not expired_before == None:
+        names['#attr4'] = 'LeaseExpires'
+        values[':e'] = {'N': str(int(expired_before))}
+        condition = condition + " AND (attribute_not_exists(#attr4) OR #attr4 < :e)"
+    try:
+        # was running when the worker died or hung, failed jobs with retries left are sent to SQS again
+        dynamo_c.update_item(
+            TableName=queue,
+            Key={'id': {'S': id}},
+            UpdateExpression="set #attr2 = :f, #attr3 = :q, #attr1 = :d",
+            ConditionExpression=condition,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+            ReturnValues="UPDATED_NEW"
+            )
+    except dynamo_c.exceptions.ConditionalCheckFailedException:
+        pass
+
+
+def release_static_slice(queue, ids, now):
+    """Send the unfinished jobs of a failed static array child through the queue"""
+    for id in ids:
+        release_static_job(queue, id, now)
+
+
+def static_jobs(queue, ids):
+    """Status, dispatch and claim expiry of the jobs of a manifest, read 100 at a time"""
+    jobs = {}
+    for i in range(0, len(ids), 100):
+        request = {queue: {
+            'Keys': [{'id': {'S': id}} for id in ids[i:i + 100]],
+            'ProjectionExpression': '#attr1, #attr2, #attr3, #attr4',
+            'ExpressionAttributeNames': {'#attr1': 'id', '#attr2': 'Status', '#attr3': 'Dispatch', '#attr4': 'LeaseExpires'}
+        }}
+        while len(request) > 0:
+            res = dynamo_c.batch_get_item(RequestItems=request)
+            for item in res['Responses'].get(queue, []):
+                jobs[item['id']['S']] = item
+            request = res.get('UnprocessedKeys', {})
+            if len(request) > 0:
+                time.sleep(0.5)
+    return jobs
+
+
+def array_children(manifest):
+    """Batch status of each array child of a manifest, missing for children Batch no longer knows"""
+    if not 'array_job_id' in manifest:
+        return {}
+    if int(manifest['children']) < 2:
+        names = {manifest['array_job_id']: 0}
+    else:
+        names = {manifest['array_job_id'] + ':' + str(index): index for index in range(int(manifest['children']))}
+    ids = list(names)
+    children = {}
+    for i in range(0, len(ids), 100):
+        for job in batch.describe_jobs(jobs=ids[i:i + 100])['jobs']:
+            children[names[job['jobId']]] = job['status']
+    return children
+
+
+def sweep_static_manifests(now):
+    """Backstop for static arrays, the FAILED event only covers children that fail. Releases the jobs of children that are gone,
+    whose claims ran out (a hung or silently dead worker) or that have not started STATIC_PICKUP_SECONDS after submission.
+    Manifests whose jobs are all done or released are deleted"""
+    bucket = stack_name + '-worker-' + os.environ.get('AWS_REGION')
+    paginator = s3_local.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix='manifests/'):
+        for obj in page.get('Contents', []):
+            try:
+                manifest = json.loads(s3_local.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read())
+                queue = manifest['queue']
+                per_child = int(manifest['per_child'])
+                jobs = static_jobs(queue, manifest['ids'])
+                pending = [n for n, id in enumerate(manifest['ids']) if id in jobs and jobs[id].get('Dispatch', {'S': 'dynamic'})['S'] == 'static' and jobs[id]['Status']['S'] in ['Waiting', 'Running']]
+                if len(pending) == 0:
+                    s3_local.delete_object(Bucket=bucket, Key=obj['Key'])
+                    continue
+                age = time.time() - obj['LastModified'].timestamp()
+                children = array_children(manifest)
+                expired = set()
+                for n in pending:
+                    job = jobs[manifest['ids'][n]]
+                    if job['Status']['S'] == 'Running' and int(job.get('LeaseExpires', {'N': '0'})['N']) < time.time():
+                        expired.add(n // per_child)
+                released = 0
+                for n in pending:
+                    index = n // per_child
+                    status = children.get(index)
+                    if status in ['SUBMITTED', 'PENDING', 'RUNNABLE'] and age < STATIC_PICKUP_SECONDS:
+                        continue
+                    if status in ['STARTING', 'RUNNING'] and not index in expired:
+                        continue
+                    if status == None and 'array_job_id' in manifest and age < STATIC_PICKUP_SECONDS:
+                        continue
+                    # running jobs are only taken back once their claim has run out
+                    release_static_job(queue, manifest['ids'][n], now, expired_before=time.time())
+                    released += 1
+                if released > 0:
+                    logger.info('## RELEASED STATIC JOBS\r' + jsonpickle.encode({'manifest': obj['Key'], 'jobs': released}))
+            except Exception as e:
+                logger.error('## FAILED TO SWEEP STATIC MANIFEST ' + obj['Key'] + '\r' + jsonpickle.encode(str(e)))
+
+
 def lambda_handler(event, context):
 
     logger.info('## ENVIRONMENT VARIABLES\r' + jsonpickle.encode(dict(**os.environ)))
@@ -41,12 +241,24 @@ def lambda_handler(event, context):
     now = datetime.now().isoformat()
 
     del context
+    if event["source"] == "aws.events":
+        sweep_wake_queues()
+        sweep_static_manifests(now)
+        return event
     if event["source"] != "aws.batch":
         raise ValueError("Function only supports input from events with a source type of: aws.batch")
 
+    delete_wake_queue(event['detail']['jobId'])
+
     jobName = event['detail']['jobName']
     job_def, queue = jobName.split('__H__')
 
+    ids = static_slice(event)
+    if not ids == None:
+        logger.info('## RELEASING STATIC SLICE\r' + jsonpickle.encode(len(ids)))
+        release_static_slice(queue, ids, now)
+        return event
+
     table = dynamo_r.Table(queue)
     
     response = table.query(
@@ -55,7 +267,8 @@ def lambda_handler(event, context):
     )
 
     for item in response['Items']:
-        if item['Status'] == 'Waiting':
+        # static array jobs wait for their own array child, only that child failing releases them
+        if item['Status'] == 'Waiting' and not item.get('Dispatch', 'dynamic') == 'static':
             dynamo_c.update_item(
                     TableName=queue,
                     Key={'id': {'S': item['id']}},
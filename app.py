@@ -84,7 +84,7 @@ Queues(app, queue_stack_name, env=core.Environment(account= account, region=main
 ####### task definition stack in main region
 print('Load Task Definitions for main region '+ main_region['region'])
 taskdef_stack_name = stack_name + '-taskDefinitions-' + main_region['region']
-JobDefinitions(app, taskdef_stack_name, env=core.Environment(account= account, region=main_region['region']), is_main_region=main_region['main_region'], stack_name=stack_name).add_dependency(main_region_clusters)
+JobDefinitions(app, taskdef_stack_name, env=core.Environment(account= account, region=main_region['region']), is_main_region=main_region['main_region'], stack_name=stack_name, main_region=main_region['region']).add_dependency(main_region_clusters)
 
 ####### images stack in main region
 print('Load Images for main region '+ main_region['region'])
@@ -116,7 +116,7 @@ for region in all_regions:
         ####### task definition stack in hub region
         print('Load Task Definitions for hub region '+ region['region'])
         taskdef_stack_name = stack_name + '-taskDefinitions-' + region['region']
-        JobDefinitions(app, taskdef_stack_name, env=core.Environment(account=account, region=region['region']), is_main_region=region['main_region'], stack_name=stack_name).add_dependency(main_region_clusters)
+        JobDefinitions(app, taskdef_stack_name, env=core.Environment(account=account, region=region['region']), is_main_region=region['main_region'], stack_name=stack_name, main_region=main_region['region']).add_dependency(main_region_clusters)
 
         ####### images stack in main region
         print('Load Images for hub region '+ region['region'])
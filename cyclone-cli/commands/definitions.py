@@ -97,6 +97,19 @@ def list_definitions(obj, name):
 @click.option('--image-uri', required=False, default='', prompt='OPTIONAL Image uri if using remote image', help='OPTIONAL Image uri if using remote image')
 @click.option('--jobs-to-workers-ratio', required=True, default=1, show_default=True, prompt='REQUIRED+IMPORTANT Ratio to control how many workers get spun up for a given number of jobs submitted, use --help', help='IMPORTANT Ratio to control how many workers get spun up for a given number of jobs submitted. Number of jobs submitted per minute (or 1000) will be divided by this ratio to decide how many additional workers to spin up for those jobs. Ratio 1 means 1 worker for every job and 50 means 1 worker created for every 50 tasks where jobs will then run in series on workers.')
 @click.option('--vcpus', required=True, default=1, show_default=True, prompt='REQUIRED Number of vCPUs to use for tasks', help='REQUIRED Number of vCPUs to use for tasks')
+@click.option('--job-vcpus', required=False, default='', prompt='OPTIONAL vCPUs per job if workers should run several jobs side by side', help='OPTIONAL vCPUs each job needs. Workers run vcpus / job-vcpus jobs concurrently, leave empty to run one job at a time per worker')
+@click.option('--prefetch-depth', required=False, default='', prompt='OPTIONAL Number of jobs a worker claims ahead of the one it is running', help='OPTIONAL Number of jobs each worker slot claims ahead of the running one so back to back short jobs start without a gap. Claimed jobs are leased and go back to the queue if the worker dies')
+@click.option('--bundle-size', required=False, default='', prompt='OPTIONAL Number of jobs handed to a worker at once for very short jobs', help='OPTIONAL Number of jobs handed to a worker in one handoff and run one after the other, for sub second jobs where the handoff costs more than the job. Each job keeps its own status and retries. Not combined with prefetch-depth')
+@click.option('--execution-mode', required=False, default='state_machine', type=click.Choice(['state_machine','direct'], case_sensitive=False), prompt='OPTIONAL Execution mode, state_machine or direct', help='OPTIONAL state_machine hands every job to workers through the state machine, direct has workers take jobs straight from the definition queue and write job status to the queue table')
+@click.option('--linger-min-seconds', required=False, default='', prompt='OPTIONAL Seconds an idle worker waits for a new job when the queue is empty and quiet', help='OPTIONAL Seconds an idle worker slot waits for a new job (on top of the 10 second idle timeout) when the queue is empty and jobs arrive steadily')
+@click.option('--linger-max-seconds', required=False, default='', prompt='OPTIONAL Longest an idle worker stays warm for bursty jobs, max 150', help='OPTIONAL Longest an idle worker slot stays warm for the next job when jobs arrive in bursts or the queue backlog grows, up to 150 seconds. Leave empty to turn lingering off')
+@click.option('--idle-vcpu-cap', required=False, default='', prompt='OPTIONAL Most vCPUs lingering workers of a Batch queue may hold', help='OPTIONAL Most vCPUs all lingering worker slots of a Batch queue may hold at once, leave empty for no cap')
+@click.option('--input-cache-path', required=False, default='', prompt='OPTIONAL Container path of a host volume mount to cache staged inputs in', help='OPTIONAL Container path of one of the mount-points (backed by a host volume) where workers cache #HYPER -i inputs, shared by all worker containers on an instance')
+@click.option('--input-cache-gb', required=False, default='', prompt='OPTIONAL Size budget of the input cache in GB, default 50', help='OPTIONAL Size budget of the input cache in GB, least recently used inputs are evicted above it. Default 50')
+@click.option('--warm-python-modules', required=False, default='', prompt='OPTIONAL Comma separated Python modules to keep imported for short Python jobs', help='OPTIONAL Comma separated Python modules workers import once in a warm interpreter, jobs that only run python script.py or python -m module are forked from it without paying for the imports. Leave empty to run every job through the shell')
+@click.option('--cpu-pinning', required=False, default='True', type=click.Choice(['True','False'], case_sensitive=False), prompt='OPTIONAL Pin jobs to their own cores and size their thread pools to job vCPUs', help='OPTIONAL Pin each job to free cores matching its vCPUs and set OMP_NUM_THREADS, MKL_NUM_THREADS and similar to match. Cores are coordinated across worker containers through the input cache volume. False turns both off')
+@click.option('--stdout-archive', required=False, default='False', type=click.Choice(['True','False'], case_sensitive=False), prompt='OPTIONAL Archive job stdout in compressed S3 objects instead of the log stream', help='OPTIONAL Write job stdout to compressed S3 objects read back by line range with qlog --lines or --tail, cheaper than the log stream for jobs with a lot of output. qlog -t STDOUT shows nothing for these jobs')
+@click.option('--cancel-check-seconds', required=False, default='', prompt='OPTIONAL Seconds between worker checks for running jobs deleted with qdel, default 60', help='OPTIONAL Seconds between worker checks that running jobs are still in their queue, a job deleted with qdel is killed within this time. Each check is one DynamoDB read per 100 running jobs of a worker. Default 60')
 @click.option('--memory-limit-mib', required=False, default=1024, prompt='OPTIONAL Set memory limit (mib) for tasks', help='OPTIONAL Set memory limit for tasks')
 @click.option('--linux-parameters', required=False, default='', prompt='OPTIONAL Specify linux parameters, see --help for details', help='OPTIONAL Set linux parameters with e.g {"init_process_enabled": "True", "shared_memory_size": 10}')
 @click.option('--ulimits', required=False, default=[], prompt='OPTIONAL Specify ulimits, see --help for details', help='OPTIONAL Set ulimits as list of jsons e.g [{"hard_limit":123, "UlimitName": "CORE", "soft_limit": 123}]')
@@ -111,7 +124,7 @@ def list_definitions(obj, name):
 @click.option('--log-driver', required=False, default='', type=click.Choice(['','AWSLOGS', 'FLUENTD', 'GELF', 'JOURNALD', 'JSON_FILE', 'LOGENTRIES', 'SPLUNK', 'SYSLOG'], case_sensitive=False), prompt='OPTIONAL Set a log driver', help='OPTIONAL Set a log driver to use, default is what is configured on docker daemon')
 @click.option('--log-options', required=False, default='', prompt='OPTIONAL Specify options for log driver e.g {"max-size": "10m", "max-file": "3" }', help='OPTIONAL Specify options for log driver e.g {"max-size": "10m", "max-file": "3" }')
 @click.option('--enable-qlog', required=False, default='True', type=click.Choice(['True','False'], case_sensitive=False), prompt='OPTIONAL Enable cyclone log collection for qlog', help='OPTIONAL Enable cyclone log collection for qlog, turning this off can save cost if using another logging mechanism')
-def add_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri, vcpus, memory_limit_mib, linux_parameters, ulimits, mount_points, host_volumes, gpu_count, environment, privileged, user, jobs_to_workers_ratio, timeout_minutes, iam_policies, log_driver, log_options, enable_qlog):
+def add_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri, vcpus, job_vcpus, prefetch_depth, bundle_size, execution_mode, linger_min_seconds, linger_max_seconds, idle_vcpu_cap, input_cache_path, input_cache_gb, warm_python_modules, cpu_pinning, stdout_archive, cancel_check_seconds, memory_limit_mib, linux_parameters, ulimits, mount_points, host_volumes, gpu_count, environment, privileged, user, jobs_to_workers_ratio, timeout_minutes, iam_policies, log_driver, log_options, enable_qlog):
     """Add a definition to your environment, definitions will span all enabled regions."""
     iam_policies = str(iam_policies).replace("'",'"')
     environment = str(environment).replace("'",'"')
@@ -127,6 +140,19 @@ def add_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri,
         "cyclone_image_name": cyclone_image_name,
         "image_uri": image_uri,
         "vcpus": vcpus,
+        "job_vcpus": job_vcpus,
+        "prefetch_depth": prefetch_depth,
+        "bundle_size": bundle_size,
+        "execution_mode": execution_mode,
+        "linger_min_seconds": linger_min_seconds,
+        "linger_max_seconds": linger_max_seconds,
+        "idle_vcpu_cap": idle_vcpu_cap,
+        "input_cache_path": input_cache_path,
+        "input_cache_gb": input_cache_gb,
+        "warm_python_modules": warm_python_modules,
+        "cpu_pinning": cpu_pinning,
+        "stdout_archive": stdout_archive,
+        "cancel_check_seconds": cancel_check_seconds,
         "memory_limit_mib": memory_limit_mib,
         "linux_parameters": linux_parameters,
         "ulimits": ulimits,
@@ -164,6 +190,19 @@ def add_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri,
 @click.option('--cyclone-image-name', required=False, help='OPTIONAL Cyclone Image Name if using this')
 @click.option('--image-uri', required=False, help='Image uri in ECR to use')
 @click.option('--vcpus', required=False, help='REQUIRED Number of vCPUs to use for tasks')
+@click.option('--job-vcpus', required=False, help='OPTIONAL vCPUs each job needs. Workers run vcpus / job-vcpus jobs concurrently')
+@click.option('--prefetch-depth', required=False, help='OPTIONAL Number of jobs each worker slot claims ahead of the running one')
+@click.option('--bundle-size', required=False, help='OPTIONAL Number of jobs handed to a worker in one handoff, for very short jobs')
+@click.option('--execution-mode', required=False, type=click.Choice(['state_machine','direct'], case_sensitive=False), help='OPTIONAL state_machine or direct, direct workers take jobs straight from the definition queue')
+@click.option('--linger-min-seconds', required=False, help='OPTIONAL Seconds an idle worker slot waits for a new job when the queue is empty and jobs arrive steadily')
+@click.option('--linger-max-seconds', required=False, help='OPTIONAL Longest an idle worker slot stays warm for bursty jobs, up to 150 seconds')
+@click.option('--idle-vcpu-cap', required=False, help='OPTIONAL Most vCPUs all lingering worker slots of a Batch queue may hold at once')
+@click.option('--input-cache-path', required=False, help='OPTIONAL Container path of a host volume mount where workers cache #HYPER -i inputs')
+@click.option('--input-cache-gb', required=False, help='OPTIONAL Size budget of the input cache in GB')
+@click.option('--warm-python-modules', required=False, help='OPTIONAL Comma separated Python modules workers keep imported in a warm interpreter for plain python jobs')
+@click.option('--cpu-pinning', required=False, type=click.Choice(['True','False'], case_sensitive=False), help='OPTIONAL Pin jobs to their own cores and size their thread pools to job vCPUs, False turns both off')
+@click.option('--stdout-archive', required=False, type=click.Choice(['True','False'], case_sensitive=False), help='OPTIONAL Archive job stdout in compressed S3 objects read back with qlog --lines or --tail')
+@click.option('--cancel-check-seconds', required=False, help='OPTIONAL Seconds between worker checks for running jobs deleted with qdel')
 @click.option('--memory-limit-mib', required=False, help='OPTIONAL Set memory limit for tasks')
 @click.option('--linux-parameters', required=False, help='OPTIONAL Set linux parameters with e.g {"init_process_enabled": "True", "shared_memory_size": 10}')
 @click.option('--ulimits', required=False, help='OPTIONAL Set ulimits as list of jsons e.g [{"hard_limit":123, "UlimitName": "CORE", "soft_limit": 123}]')
@@ -179,7 +218,7 @@ def add_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri,
 @click.option('--log-driver', required=False, type=click.Choice(['','AWSLOGS', 'FLUENTD', 'GELF', 'JOURNALD', 'JSON_FILE', 'LOGENTRIES', 'SPLUNK', 'SYSLOG'], case_sensitive=False), help='OPTIONAL Set user to use in container')
 @click.option('--log-options', required=False, help='OPTIONAL Specify options for log driver e.g {"max-size": "10m", "max-file": "3" }')
 @click.option('--enable-qlog', required=False, type=click.Choice(['True','False'], case_sensitive=False), help='OPTIONAL Enable cyclone log collection for qlog, turning this off can save cost if using another logging mechanism')
-def update_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri, vcpus, memory_limit_mib, linux_parameters, ulimits, mount_points, host_volumes, gpu_count, environment, privileged, user, jobs_to_workers_ratio, timeout_minutes, iam_policies, log_driver, log_options, enable_qlog):
+def update_definition(obj, name, use_cyclone_image, cyclone_image_name, image_uri, vcpus, job_vcpus, prefetch_depth, bundle_size, execution_mode, linger_min_seconds, linger_max_seconds, idle_vcpu_cap, input_cache_path, input_cache_gb, warm_python_modules, cpu_pinning, stdout_archive, cancel_check_seconds, memory_limit_mib, linux_parameters, ulimits, mount_points, host_volumes, gpu_count, environment, privileged, user, jobs_to_workers_ratio, timeout_minutes, iam_policies, log_driver, log_options, enable_qlog):
     """Update specific configurations for an existing definition"""
 
     params_old = get(obj.url, obj.key, obj.name +'_jobDefinitions_table', name)
@@ -192,6 +231,32 @@ def update_definition(obj, name, use_cyclone_image, cyclone_image_name, image_ur
         params_old['image_uri'] = image_uri
     if not vcpus == None:
         params_old['vcpus'] = vcpus
+    if not job_vcpus == None:
+        params_old['job_vcpus'] = job_vcpus
+    if not prefetch_depth == None:
+        params_old['prefetch_depth'] = prefetch_depth
+    if not bundle_size == None:
+        params_old['bundle_size'] = bundle_size
+    if not execution_mode == None:
+        params_old['execution_mode'] = execution_mode
+    if not linger_min_seconds == None:
+        params_old['linger_min_seconds'] = linger_min_seconds
+    if not linger_max_seconds == None:
+        params_old['linger_max_seconds'] = linger_max_seconds
+    if not idle_vcpu_cap == None:
+        params_old['idle_vcpu_cap'] = idle_vcpu_cap
+    if not input_cache_path == None:
+        params_old['input_cache_path'] = input_cache_path
+    if not input_cache_gb == None:
+        params_old['input_cache_gb'] = input_cache_gb
+    if not warm_python_modules == None:
+        params_old['warm_python_modules'] = warm_python_modules
+    if not cpu_pinning == None:
+        params_old['cpu_pinning'] = cpu_pinning
+    if not stdout_archive == None:
+        params_old['stdout_archive'] = stdout_archive
+    if not cancel_check_seconds == None:
+        params_old['cancel_check_seconds'] = cancel_check_seconds
     if not memory_limit_mib== None:
         params_old['memory_limit_mib'] = memory_limit_mib
     if not linux_parameters== None:
@@ -49,6 +49,7 @@ class client(object):
 @click.option('-j', '--job-name', required=False, default=None, help='Job name batch deletion')
 def cli(ctx, queue, job_id, job_name):
     """Enter job id to delete or enter a job name to do a batch deletion. If you have a lot of jobs in queue you can run the qdel commands multiple times to have multiple lambdas deleting a job name in background. 
+    Jobs that are already running are killed by their worker at its next cancel check, within the cancel_check_seconds of their job definition (60 seconds by default) of being deleted.
     """
     host_name = None
     try:
@@ -34,6 +34,10 @@ def get_config(json_dir):
 def get_timestamp(elem):
     return datetime.fromisoformat(elem['time_stamp'])
 
+def get_lines(url, header, queue, payload):
+    post = requests.post(url, data=json.dumps({"operation": "GET_LINES", "TableName": queue, "payload": payload}), headers=header)
+    return post.json()
+
 class client(object):
     def __init__(self, host_name=None):
         host = get_config("./host_credentials/{}".format(host_name))
@@ -49,9 +53,12 @@ class client(object):
 @click.pass_context
 @click.option('-i', '--job-id', required=True, default=None, help='Job_Id for job to query')
 @click.option('-q', '--queue', required=True, default=None, help='Queue that job is in')
-@click.option('-t', '--log-type', required=False, type=click.Choice(['', 'STDOUT','METRICS', 'SYSTEM'], case_sensitive=False), default='', help='Log type to query, options are SYSTEM / STDOUT / METRICS)')
-def cli(ctx, job_id, queue, log_type):
+@click.option('-t', '--log-type', required=False, type=click.Choice(['', 'STDOUT','METRICS', 'SYSTEM', 'STARTUP', 'PROFILE'], case_sensitive=False), default='', help='Log type to query, options are SYSTEM / STDOUT / METRICS / STARTUP / PROFILE)')
+@click.option('--lines', required=False, default=None, help='Lines FIRST:COUNT of the stdout archive of jobs whose definition has stdout_archive on, e.g. 1000000:100')
+@click.option('--tail', required=False, default=None, type=int, help='Last N lines of the stdout archive of jobs whose definition has stdout_archive on')
+def cli(ctx, job_id, queue, log_type, lines, tail):
     """qlog command allows you to query progressive log stream from jobs including SYSTEM logs for debugging, STDOUT logs from job execution and METRIC logs for vCPU and vRAM consumption at 10s intervals.
+    PROFILE prints the collapsed stacks of jobs run with #HYPER -P, ready for flamegraph.pl.
     """
     host_name = None
     try:
@@ -80,6 +87,43 @@ def cli(ctx, job_id, queue, log_type):
 
     url = ctx.obj.url
     header = {"x-api-key" : ctx.obj.key}
+
+    if not lines == None or not tail == None:
+        # archived stdout is read by line range, only the blocks holding those lines are fetched. A response holds at most
+        # a few MB of lines, longer ranges are read in pages from the end of the previous one
+        payload = {"bucket": bucket_name, "id": job_id}
+        last = None
+        if not tail == None:
+            last = get_lines(url, header, queue, dict(payload, tail=True, count=tail))
+            if 'error' in last:
+                click.echo('FAILED - ' + last['error'])
+                return
+            # a long tail comes back short, read the lines it left out from the front
+            first = max(0, last['total_lines'] - tail)
+            count = last['start'] - first
+        else:
+            first, _, count = lines.partition(':')
+            first = max(0, int(first) - 1)
+            count = int(count or 100)
+        j = last
+        while count > 0:
+            j = get_lines(url, header, queue, dict(payload, start=first, count=count))
+            if 'error' in j:
+                click.echo('FAILED - ' + j['error'])
+                return
+            for line in j['lines']:
+                click.echo(line)
+            if j['next_start'] == None or j['end'] <= first:
+                break
+            count -= j['end'] - first
+            first = j['end']
+        if not last == None:
+            for line in last['lines']:
+                click.echo(line)
+        if not j['complete']:
+            click.echo('## job still writing, ' + str(j['total_lines']) + ' lines archived so far', err=True)
+        return
+
     post = requests.post(url, data=message, headers=header)
 
     j = post.json()
@@ -100,7 +144,14 @@ def cli(ctx, job_id, queue, log_type):
 
     logs_sorted = sorted(log_full, key=get_timestamp, reverse=False)
     for line in logs_sorted:
-        click.echo(line['log_type'] + ' | ' + line['time_stamp'] + ' | ' + str(line['data']))
+        if log_type.upper() == 'PROFILE' and line['log_type'] == 'PROFILE':
+            # only the stacks so the output can be piped straight into flamegraph.pl
+            click.echo(line['data']['stacks'])
+        elif line['log_type'] == 'PROFILE':
+            summary = {k: v for k, v in line['data'].items() if not k == 'stacks'}
+            click.echo(line['log_type'] + ' | ' + line['time_stamp'] + ' | ' + str(summary) + ' (stacks with -t PROFILE)')
+        else:
+            click.echo(line['log_type'] + ' | ' + line['time_stamp'] + ' | ' + str(line['data']))
     
     return
 
@@ -67,7 +67,7 @@ class client(object):
 @click.option('-i', '--job-id', required=False, default=None, help='Job id to query')
 @click.option('-j', '--job-name', required=False, default=None, help='Job id to query')
 @click.option('-q', '--queue', required=True, default=None, help='Queue name to query')
-@click.option('-f', '--filter-status', required=False, default=None, type=click.Choice(['Waiting','Running','Successful','Failed', 'Error'], case_sensitive=False), help='Filter for job status - Waiting / Running / Successful / Failed')
+@click.option('-f', '--filter-status', required=False, default=None, type=click.Choice(['Waiting','Running','Successful','Failed', 'TimedOut', 'Error'], case_sensitive=False), help='Filter for job status - Waiting / Running / Successful / Failed / TimedOut')
 @click.option('-o', '--only-job-id-out', required=False, default='False', type=click.Choice(['True','False'], case_sensitive=False), help='Set True to only output job ids, can be used to pipe to other commands like qdel')
 def cli(ctx, job_id, job_name, queue, filter_status, only_job_id_out):
     """qstat lets you query jobs in your queue for status updates, output and errors. 
@@ -154,6 +154,7 @@ def cli(ctx, job_id, job_name, queue, filter_status, only_job_id_out):
         counts['Running'] = 0
         counts['Successful'] = 0
         counts['Failed'] = 0
+        counts['TimedOut'] = 0
         counts['Error'] = 0
         counts = print_queue_short(items, filter_status, only_job_id_out, counts)
 
@@ -207,6 +208,7 @@ def cli(ctx, job_id, job_name, queue, filter_status, only_job_id_out):
         counts['Running'] = 0
         counts['Successful'] = 0
         counts['Failed'] = 0
+        counts['TimedOut'] = 0
         counts['Error'] = 0
         counts = print_queue_short(items, filter_status, only_job_id_out, counts)
 
@@ -50,8 +50,10 @@ class client(object):
 @click.option('-c', '--commands', required=False, default=None, help='Name for job group being submitted (each task gets assigned unique id)')
 @click.option('-p', '--params', required=False, default=None, help='You can specify --params as a string with {"string_1":"new_string_1, "string_2":"new_string_2}. This will do a string replacement on the bash script you specify)')
 @click.option('-a', '--array', required=False, default=None, help='You can specify a text file where each line has parameter replacement e.g {"string_1":"new_string_1, "string_2":"new_string_2}. Each line represents an array job. Array jobs will have job IDs uuid--1, uuid--2, uuid--n. See array_example.txt for example input file.')
+@click.option('-t', '--walltime', required=False, default=None, help='Walltime of each job as seconds or [HH:]MM:SS, a job still running after it is killed with status TimedOut and the worker moves on. Overrides #HYPER -t')
+@click.option('-s', '--static', is_flag=True, default=False, help='With --array, bind the array jobs to workers up front: each worker runs a fixed slice of the array instead of taking jobs one by one from the queue. Retries and jobs of failed workers still go through the queue.')
 @click.argument('filename', type=click.Path(exists=True))
-def cli(ctx, job_name, queue, retries, definition, commands, filename, params, array):
+def cli(ctx, job_name, queue, retries, definition, commands, filename, params, array, static, walltime):
     """Submit jobs using "qsub file_name.sh" (DON'T INCLUDE "hyper") using the file format shown in qsub_example_file.sh found in repo root directory.
     You can also override configurations in the file when submitting jobs via the qsub command option parameters.
     You can query job status with qstat and delete jobs in queue with qdel. You can view logs with qlog. Use "nano qsub_example_file.sh" to see the file format for job submits and update configurations.
@@ -96,6 +98,8 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
 
     if array == None:
 
+        inputs = []
+        outputs = []
         lines = message['Item']['commands'].splitlines()
         for line in lines:
             if '#HYPER -n' in line:
@@ -106,6 +110,14 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
                 message['Item']['RetriesAvailable'] = line.replace('#HYPER -r ', '')
             elif '#HYPER -d' in line:
                 message['Item']['jobDefinition'] = line.replace('#HYPER -d ', '')
+            elif line.startswith('#HYPER -i '):
+                inputs.append(line.replace('#HYPER -i ', '').strip())
+            elif line.startswith('#HYPER -o '):
+                outputs.append(line.replace('#HYPER -o ', '').strip())
+            elif line.strip() == '#HYPER -k' or line.startswith('#HYPER -k '):
+                message['Item']['checkpoint'] = line.replace('#HYPER -k', '').strip() or 'True'
+            elif line.startswith('#HYPER -t '):
+                message['Item']['walltime'] = line.replace('#HYPER -t ', '').strip()
 
         if not job_name == None:
             message['Item']['jobName'] = job_name
@@ -117,6 +129,8 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
             message['Item']['jobDefinition'] = definition
         if not commands == None:
             message['Item']['commands'] = commands
+        if not walltime == None:
+            message['Item']['walltime'] = walltime
 
         for k, v in message['Item'].items():
             if v == None:
@@ -125,6 +139,11 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
 
         
         message['Item']['RetriesAvailable'] = int(message['Item']['RetriesAvailable'])
+        # staged by the worker before and after the job runs, kept on the job for qstat
+        if len(inputs) > 0:
+            message['Item']['inputs'] = inputs
+        if len(outputs) > 0:
+            message['Item']['outputs'] = outputs
         message['TableName'] = message['Item']['jobQueue']
         message['Item'] = [message['Item']]
 
@@ -151,6 +170,8 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
             for k,v in job.items():
                 item['commands'] = item['commands'].replace(k,v)
 
+            inputs = []
+            outputs = []
             lines = item['commands'].splitlines()
             for line in lines:
                 if '#HYPER -n' in line:
@@ -161,6 +182,14 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
                     item['RetriesAvailable'] = line.replace('#HYPER -r ', '')
                 elif '#HYPER -d' in line:
                     item['jobDefinition'] = line.replace('#HYPER -d ', '')
+                elif line.startswith('#HYPER -i '):
+                    inputs.append(line.replace('#HYPER -i ', '').strip())
+                elif line.startswith('#HYPER -o '):
+                    outputs.append(line.replace('#HYPER -o ', '').strip())
+                elif line.strip() == '#HYPER -k' or line.startswith('#HYPER -k '):
+                    item['checkpoint'] = line.replace('#HYPER -k', '').strip() or 'True'
+                elif line.startswith('#HYPER -t '):
+                    item['walltime'] = line.replace('#HYPER -t ', '').strip()
 
             if not job_name == None:
                 item['jobName'] = job_name
@@ -170,6 +199,8 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
                 item['jobDefinition'] = definition
             if not commands == None:
                 item['commands'] = commands
+            if not walltime == None:
+                item['walltime'] = walltime
 
             for k, v in item.items():
                 if v == None:
@@ -177,6 +208,12 @@ def cli(ctx, job_name, queue, retries, definition, commands, filename, params, a
                     return print('Aborted')
 
             item['RetriesAvailable'] = int(item['RetriesAvailable'])
+            if len(inputs) > 0:
+                item['inputs'] = inputs
+            if len(outputs) > 0:
+                item['outputs'] = outputs
+            if static:
+                item['Dispatch'] = 'static'
             items.append(item)
 
         
@@ -54,6 +54,21 @@ class HyperBatchCore(core.Stack):
                                         removal_policy=core.RemovalPolicy.DESTROY
         )
 
+        # vCPUs held by idle workers lingering for the next job, one item per lingering slot that expires on its own
+        dynamodb.Table(self, id='WarmPoolTable',
+                        partition_key=dynamodb.Attribute(
+                        name='pool', type=dynamodb.AttributeType.STRING
+                        ),
+                        sort_key=dynamodb.Attribute(
+                        name='holder', type=dynamodb.AttributeType.STRING
+                        ),
+                        time_to_live_attribute='expires',
+                        billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+                        table_name=self.stack_name + '_warm_pool',
+                        encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                        removal_policy=core.RemovalPolicy.DESTROY
+        )
+
         ssm.StringParameter(self, str(stack_name + '-t-param'),
             allowed_pattern=".*",
             description="job definition attribute",
@@ -78,6 +93,10 @@ class HyperBatchCore(core.Stack):
                     "kinesis:SubscribeToShard",
                     "kinesis:PutRecord"
                 ]),
+                # per-worker wake queues used to hand jobs to workers without polling
+                iam.PolicyStatement(resources=[f'arn:aws:sqs:{self.region}:{self.account}:{stack_name}-wake-*'], actions=['sqs:SendMessage']),
+                # keeps the state machine task alive while the get start delete lambda long-polls for a lingering worker
+                iam.PolicyStatement(resources=['*'], actions=['states:SendTaskHeartbeat']),
             ],
             policy_name=self.stack_name + '-async-logKinesis-access'
             )
@@ -241,7 +260,7 @@ class HyperBatchCore(core.Stack):
             result_path= '$.UpdateFailOutput'
         );
 
-        LookAtResult = sfn.Choice(self, 'LookAtResult').when(sfn.Condition.is_present('$.lastJob.Error'),  UpdateFail).when(sfn.Condition.string_equals('$.lastJob.LeaveRunning', 'False'), CleanUpDynamo).when(sfn.Condition.string_equals('$.lastJob.Status', 'Successful'), GetStartDelete).when(sfn.Condition.string_equals('$.lastJob.Status', 'JobFailed'), GetStartDelete).otherwise(UpdateFail)
+        LookAtResult = sfn.Choice(self, 'LookAtResult').when(sfn.Condition.is_present('$.lastJob.Error'),  UpdateFail).when(sfn.Condition.string_equals('$.lastJob.LeaveRunning', 'False'), CleanUpDynamo).when(sfn.Condition.string_equals('$.lastJob.Status', 'Successful'), GetStartDelete).when(sfn.Condition.string_equals('$.lastJob.Status', 'JobFailed'), GetStartDelete).when(sfn.Condition.string_equals('$.lastJob.Status', 'TimedOut'), GetStartDelete).when(sfn.Condition.string_equals('$.lastJob.Status', 'Cancelled'), GetStartDelete).otherwise(UpdateFail)
 
         ContinueOrFinish = sfn.Choice(self, 'ContinueOrFinish').when(sfn.Condition.string_equals('$.lastJob.Error', 'States.Timeout'), CleanUpDynamo).otherwise(GetStartDelete)
 
@@ -274,6 +293,18 @@ class HyperBatchCore(core.Stack):
             tracing=_lambda.Tracing.DISABLED,
         )
         failed_worker_lambda.add_environment("MAIN_REGION", main_region)
+        failed_worker_lambda.add_environment("STACK_NAME", stack_name)
+
+        # the failed worker lambda deletes the wake queue of a worker that died, and sweeps the ones it missed and the static array manifests
+        iam.Policy(self, 'wake-queue-cleanup-policy', roles=[async_stream_lambda_role],
+            statements=[
+                iam.PolicyStatement(resources=[f'arn:aws:sqs:{self.region}:{self.account}:{stack_name}-wake-*'], actions=['sqs:GetQueueUrl', 'sqs:DeleteQueue', 'sqs:ListQueueTags', 'sqs:GetQueueAttributes']),
+                iam.PolicyStatement(resources=['*'], actions=['sqs:ListQueues', 'batch:DescribeJobs']),
+                iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-worker-{self.region}'], actions=['s3:ListBucket']),
+                iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-worker-{self.region}/manifests/*'], actions=['s3:DeleteObject']),
+            ],
+            policy_name=self.stack_name + '-wake-queue-cleanup'
+            )
 
         rule = events.Rule(self, "rule",
             event_pattern=events.EventPattern(
@@ -285,6 +316,13 @@ class HyperBatchCore(core.Stack):
 
         rule.add_target(targets.LambdaFunction(failed_worker_lambda))
 
+        # sweeps leftover wake queues and the static array jobs of workers that hung or never started
+        sweep_rule = events.Rule(self, "wake-sweep-rule",
+            schedule=events.Schedule.rate(core.Duration.minutes(5))
+        )
+
+        sweep_rule.add_target(targets.LambdaFunction(failed_worker_lambda))
+
 
   def create_dependencies_layer(self, project_name, layer_name: str) -> _lambda.LayerVersion:
         requirements_file = "lambda-requirements.txt"
@@ -90,6 +90,11 @@ class Clusters(core.Stack):
                     iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-images-{self.region}',f'arn:aws:s3:::{stack_name}-images-{self.region}/*'], actions=[
                         "s3:*",
                     ]),
+                    # manifests of static array jobs, written by the kinesis batch lambda and read by the failed worker lambda
+                    iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-worker-*/manifests/*'], actions=[
+                        "s3:GetObject",
+                        "s3:PutObject"
+                    ]),
                     iam.PolicyStatement(resources=[f'arn:aws:kms:{self.region}:{self.account}:key/*'], actions=[
                         "kms:Decrypt"
                     ]),
@@ -287,12 +292,13 @@ class Clusters(core.Stack):
             encryption= s3.BucketEncryption.S3_MANAGED,
             block_public_access=s3.BlockPublicAccess.BLOCK_ALL,
         #    server_access_logs_prefix='access-logs',
-            enforce_ssl=True
+            enforce_ssl=True,
+            lifecycle_rules=[s3.LifecycleRule(prefix='manifests/', expiration=core.Duration.days(14)), s3.LifecycleRule(prefix='checkpoints/', expiration=core.Duration.days(14))]
             )
 
         s3deploy.BucketDeployment(self, str(stack_name +'-s3deploy'),
 
-            sources=[s3deploy.Source.asset("0-worker-agent")],
+            sources=[s3deploy.Source.asset("0-worker-agent", exclude=['tests', '__pycache__'])],
             destination_bucket=worker_script_bucket
         )
 
@@ -477,7 +483,8 @@ class Clusters(core.Stack):
                         "kinesis:SubscribeToShard",
                         "kinesis:DescribeStream",
                         "kinesis:ListStreams",
-                        "kinesis:PutRecord"
+                        "kinesis:PutRecord",
+                        "kinesis:PutRecords"
                     ]),
                 ],
                 policy_name=self.stack_name + '-cluster-stream-access'
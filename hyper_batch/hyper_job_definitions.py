@@ -40,9 +40,12 @@ def bool_convert(string):
 job_definitions_config = get_config("./hyper_batch/configuration/job_definitions.json")
 job_definitions = job_definitions_config['jobDefinitions']
 
+queue_config = get_config("./hyper_batch/configuration/queues.json")
+queue_config = queue_config['queues']
+
 class JobDefinitions(core.Stack):
 
-  def __init__(self, scope: Construct, id: str, *, is_main_region: str=None, stack_name: str=None, **kwargs) -> None:
+  def __init__(self, scope: Construct, id: str, *, is_main_region: str=None, stack_name: str=None, main_region: str=None, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         if is_main_region == 'True':
@@ -70,7 +73,8 @@ class JobDefinitions(core.Stack):
                 iam.PolicyStatement(resources=[f'arn:aws:kinesis:{self.region}:{self.account}:stream/{stack_name}_log_stream'], actions=[
                     "kinesis:DescribeStreamSummary",
                     "kinesis:SubscribeToShard",
-                    "kinesis:PutRecord"
+                    "kinesis:PutRecord",
+                    "kinesis:PutRecords"
                     ]),
                 iam.PolicyStatement(
                     actions=[
@@ -92,11 +96,54 @@ class JobDefinitions(core.Stack):
                     resources=[f'arn:aws:states:{self.region}:{self.account}:stateMachine:{stack_name}*']),
                 iam.PolicyStatement(
                     actions=["s3:*"],
-                    resources=[f'arn:aws:s3:::{stack_name}-worker-{self.region}*'])
+                    resources=[f'arn:aws:s3:::{stack_name}-worker-{self.region}*']),
+                iam.PolicyStatement(
+                    actions=[
+                        "sqs:CreateQueue",
+                        "sqs:DeleteQueue",
+                        "sqs:TagQueue",
+                        "sqs:ReceiveMessage",
+                        "sqs:DeleteMessage"
+                    ],
+                    resources=[f'arn:aws:sqs:{self.region}:{self.account}:{stack_name}-wake-*']),
+                iam.PolicyStatement(
+                    actions=[
+                        "sqs:ChangeMessageVisibility",
+                        "sqs:DeleteMessage",
+                        "sqs:GetQueueUrl",
+                        "sqs:GetQueueAttributes"
+                    ],
+                    resources=[f'arn:aws:sqs:*:{self.account}:' + job_definition['jobDefinitionName']]),
+                # job checkpoints live in the main region worker bucket so a retry in any region can restore them
+                iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-worker-{main_region}/checkpoints/*'], actions=['s3:GetObject', 's3:PutObject', 's3:DeleteObject']),
+                iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-worker-{main_region}'], actions=['s3:ListBucket']),
+                # profiles of #HYPER -P jobs are written next to the job's logs, archived stdout under stdout/
+                iam.PolicyStatement(resources=[f'arn:aws:s3:::{stack_name}-images-{main_region}/logs/*', f'arn:aws:s3:::{stack_name}-images-{main_region}/stdout/*'], actions=['s3:PutObject']),
+                # reservations of lingering slots against the idle vCPU cap
+                iam.PolicyStatement(resources=[f'arn:aws:dynamodb:{self.region}:{self.account}:table/{stack_name}-core*_warm_pool'], actions=['dynamodb:Query', 'dynamodb:DeleteItem'])
                 ],
                 policy_name=self.stack_name + '-worker-access'
             )
 
+            # direct mode and static array workers write job status to the queue tables in the main region themselves, all workers read them to notice jobs deleted with qdel
+            # and write child jobs that running jobs submit through the worker
+            direct_statements = []
+            if job_definition.get('execution_mode') == 'direct':
+                direct_statements.append(iam.PolicyStatement(
+                        actions=[
+                            "sqs:ReceiveMessage",
+                            "sqs:GetQueueUrl"
+                        ],
+                        resources=[f'arn:aws:sqs:{main_region}:{self.account}:' + job_definition['jobDefinitionName']]))
+            if len(queue_config) > 0:
+                direct_statements.append(iam.PolicyStatement(
+                    actions=['dynamodb:GetItem', 'dynamodb:BatchGetItem', 'dynamodb:UpdateItem', 'dynamodb:BatchWriteItem', 'dynamodb:PutItem'],
+                    resources=[f'arn:aws:dynamodb:{main_region}:{self.account}:table/' + queue['queue_name'] for queue in queue_config]))
+            if len(direct_statements) > 0:
+                iam.Policy(self, job_definition['jobDefinitionName'] + 'worker-direct-access', roles=[ecsInstanceRole], statements=direct_statements,
+                    policy_name=self.stack_name + '-worker-direct-access'
+                )
+
 
 
             if job_definition['use_cyclone_image'] == "True":
@@ -193,6 +240,44 @@ class JobDefinitions(core.Stack):
             job_definition['environment']['CYCLONE_REGION'] = self.region
             if job_definition['enable_qlog'] == "False" or job_definition['enable_qlog'] == False:
                 job_definition['environment']['ENABLE_QLOG'] = "False"
+            # workers run container vcpus / job_vcpus jobs side by side, job_vcpus defaults to vcpus (one job at a time)
+            job_definition['environment']['CYCLONE_VCPUS'] = str(job_definition['vcpus'] or 1)
+            if job_definition.get('job_vcpus'):
+                job_definition['environment']['CYCLONE_JOB_VCPUS'] = str(job_definition['job_vcpus'])
+            if job_definition.get('prefetch_depth'):
+                job_definition['environment']['CYCLONE_PREFETCH'] = str(int(job_definition['prefetch_depth']))
+            if job_definition.get('bundle_size'):
+                job_definition['environment']['CYCLONE_BUNDLE_SIZE'] = str(int(job_definition['bundle_size']))
+            if job_definition.get('execution_mode') == 'direct':
+                job_definition['environment']['CYCLONE_EXECUTION_MODE'] = 'direct'
+            # idle slots linger between min and max seconds for the next job, all lingering slots of the Batch queue hold at most idle_vcpu_cap vCPUs
+            if job_definition.get('linger_max_seconds'):
+                job_definition['environment']['CYCLONE_LINGER_MAX'] = str(int(job_definition['linger_max_seconds']))
+            if job_definition.get('linger_min_seconds'):
+                job_definition['environment']['CYCLONE_LINGER_MIN'] = str(int(job_definition['linger_min_seconds']))
+            if job_definition.get('idle_vcpu_cap'):
+                job_definition['environment']['CYCLONE_IDLE_VCPU_CAP'] = str(job_definition['idle_vcpu_cap'])
+            # staged inputs are cached on a host volume shared by the containers of an instance, input_cache_path is the container path of one of the mount_points
+            if job_definition.get('input_cache_path'):
+                cache_mounts = [point.get('container_path') for point in job_definition['mount_points']] if type(job_definition['mount_points']) == list else []
+                if not job_definition['input_cache_path'] in cache_mounts:
+                    print(f"ERROR: input_cache_path {job_definition['input_cache_path']} is not a mount point container_path, the cache is only shared when it is on a host volume")
+                job_definition['environment']['CYCLONE_INPUT_CACHE'] = str(job_definition['input_cache_path'])
+                if job_definition.get('input_cache_gb'):
+                    job_definition['environment']['CYCLONE_INPUT_CACHE_GB'] = str(job_definition['input_cache_gb'])
+            # plain python jobs are forked from a warm interpreter with these modules imported, a list or comma separated string
+            if job_definition.get('warm_python_modules'):
+                modules = job_definition['warm_python_modules']
+                job_definition['environment']['CYCLONE_WARM_MODULES'] = ','.join(modules) if type(modules) == list else str(modules)
+            # job stdout goes to gzip objects in S3 read back by line range with qlog --lines/--tail instead of through the log stream
+            if str(job_definition.get('stdout_archive')) == 'True':
+                job_definition['environment']['CYCLONE_STDOUT_ARCHIVE'] = 'True'
+            # running jobs are checked against their queue table this often, a job deleted with qdel is killed within it
+            if job_definition.get('cancel_check_seconds'):
+                job_definition['environment']['CYCLONE_CANCEL_CHECK_SECONDS'] = str(int(job_definition['cancel_check_seconds']))
+            # jobs are pinned to their own cores with thread pools sized to job_vcpus unless cpu_pinning is False
+            if str(job_definition.get('cpu_pinning')) == 'False':
+                job_definition['environment']['CYCLONE_CPU_PINNING'] = 'False'
 
             container_def = batch.JobDefinitionContainer(
                 image=container,
@@ -240,6 +325,6 @@ class JobDefinitions(core.Stack):
         
         if is_main_region == 'True':
             if len(job_definitions) > 0:
-                iam.Policy(self, 'sqs-access', roles=[async_stream_lambda_role, dynamo_stream_lambda_role], statements=[iam.PolicyStatement(resources=sqs_arns, actions=['sqs:SendMessage', "sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:GetQueueUrl"])], policy_name=self.stack_name + '-jobDef-access')
+                iam.Policy(self, 'sqs-access', roles=[async_stream_lambda_role, dynamo_stream_lambda_role], statements=[iam.PolicyStatement(resources=sqs_arns, actions=['sqs:SendMessage', "sqs:ReceiveMessage", "sqs:DeleteMessage", "sqs:ChangeMessageVisibility", "sqs:GetQueueUrl"])], policy_name=self.stack_name + '-jobDef-access')
 
 
@@ -446,7 +446,7 @@ class Queues(core.Stack):
         if len(queue_config) > 0:
             iam.Policy(self, 'queue-access', roles=[async_stream_lambda_role, kinesis_batch_lambda_role, dynamo_stream_lambda_role],
                 statements=[
-                    iam.PolicyStatement(resources=table_arns, actions=['dynamodb:UpdateItem', 'dynamodb:GetItem']),
+                    iam.PolicyStatement(resources=table_arns, actions=['dynamodb:UpdateItem', 'dynamodb:GetItem', 'dynamodb:BatchGetItem']),
                     iam.PolicyStatement(resources=['*'], actions=['xray:PutTraceSegments', 'xray:PutTelemetryRecords'])
                 ],
                 policy_name=self.stack_name + '-queue-access')
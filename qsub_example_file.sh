@@ -4,6 +4,12 @@
 #HYPER -q sample-queue-1
 #HYPER -r 2
 #HYPER -d sample-def-1
+## OPTIONAL staging: -i <s3 url> [local path] is downloaded before the job runs, -o <s3 url> [local path] is uploaded after it succeeds
+## a url ending in / is a prefix and the local path a directory, e.g.
+## #HYPER -i s3://my-bucket/inputs/ inputs
+## #HYPER -o s3://my-bucket/results/example-job-name.csv results.csv
+## OPTIONAL -t [HH:]MM:SS or seconds, walltime after which the job is killed with status TimedOut
+## OPTIONAL -k [dir] checkpoints the directory in $CYCLONE_CHECKPOINT_DIR while the job runs, a retry restores it first
 ## END HYPER SETTINGS
 ## BEGIN ACTUAL CODE
 for i in $(seq 60)